@@ -0,0 +1,177 @@
+"""
+Python API for driving snappy from a long-lived process, e.g. an
+orchestrator, instead of starting a `snappy` process for each operation.
+
+Each call accepts any number of datasets and returns the plan that has been
+executed, instead of only logging what has been done. Nothing is printed
+unless the embedding application configures `logging`.
+"""
+
+from __future__ import annotations
+
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator, Sequence
+
+from snappy.config import KeepSpec
+from snappy.plan import Plan
+from snappy.snappy import cli_command, default_prune_jobs, \
+    _get_selected_datasets
+from snappy.utils import UserError
+from snappy.zfs import Dataset, Snapshot, Bookmark, SnapshotTable, \
+    ZfsBackend, ZfsBackendType, create_backend, use_backend, \
+    iter_snapshots_and_bookmarks
+
+
+# The backend is global to the process, so calls of all engines are
+# serialized.
+_engine_lock = threading.Lock()
+
+
+@dataclass
+class DatasetInventory:
+    snapshots: SnapshotTable[Snapshot]
+    bookmarks: SnapshotTable[Bookmark]
+
+
+class Engine:
+    """
+    Runs snappy operations using a backend which is created once and kept for
+    the lifetime of the engine. The datasets are locked during each call, as
+    when running `snappy`.
+
+    Failures are reported by raising UserError, or LockTimeoutError if the
+    datasets are in use by another run.
+    """
+
+    def __init__(
+            self, backend: ZfsBackend | ZfsBackendType = ZfsBackendType.cli,
+            *, prefix: str | None = None, lock_timeout: float | None = None,
+            prune_jobs: int = default_prune_jobs,
+            checksum_streams: bool = False, high_frequency: bool = False) \
+            -> None:
+        if isinstance(backend, ZfsBackendType):
+            backend = create_backend(backend)
+
+        self.backend = backend
+        self.prefix = prefix
+        self.lock_timeout = lock_timeout
+        self.prune_jobs = prune_jobs
+        self.checksum_streams = checksum_streams
+        self.high_frequency = high_frequency
+
+    @contextmanager
+    def _use_backend(self) -> Iterator[None]:
+        with _engine_lock, use_backend(self.backend):
+            yield
+
+    def _run(
+            self, datasets: Sequence[Dataset], *, recursive: bool,
+            exclude: Sequence[Dataset], take_snapshot: bool,
+            keep_specs: Sequence[KeepSpec] | None,
+            send_targets: Sequence[Dataset], send_base: Dataset | None,
+            replicate: bool, dry_run: bool) \
+            -> Plan:
+        if exclude and not recursive:
+            raise UserError('Excluding datasets requires recursive=True.')
+
+        if send_targets and send_base is None and len(datasets) != 1:
+            raise UserError(
+                'A send base is required to send more than one dataset.')
+
+        with self._use_backend():
+            return cli_command(
+                datasets=list(datasets),
+                recursive=recursive,
+                exclude=list(exclude),
+                prefix=self.prefix,
+                take_snapshot=take_snapshot,
+                pre_snapshot_script=None,
+                keep_specs=None if keep_specs is None else list(keep_specs),
+                send_targets=list(send_targets),
+                send_base=send_base,
+                do_snapshot=True,
+                do_send=True,
+                dry_run=dry_run,
+                replicate=replicate,
+                checksum_streams=self.checksum_streams,
+                high_frequency=self.high_frequency,
+                lock_timeout=self.lock_timeout,
+                prune_jobs=self.prune_jobs)
+
+    def snapshot(
+            self, datasets: Sequence[Dataset], *, recursive: bool = False,
+            exclude: Sequence[Dataset] = ()) \
+            -> Plan:
+        """
+        Create a snapshot of each of the datasets.
+        """
+        return self._run(
+            datasets, recursive=recursive, exclude=exclude,
+            take_snapshot=True, keep_specs=None, send_targets=[],
+            send_base=None, replicate=False, dry_run=False)
+
+    def send(
+            self, datasets: Sequence[Dataset], send_targets: Sequence[Dataset],
+            *, send_base: Dataset | None = None, recursive: bool = False,
+            exclude: Sequence[Dataset] = (),
+            keep_specs: Sequence[KeepSpec] | None = None,
+            replicate: bool = False) \
+            -> Plan:
+        """
+        Send the existing snapshots of the datasets to each of the targets
+        and, if `keep_specs` is given, prune the targets.
+        """
+        return self._run(
+            datasets, recursive=recursive, exclude=exclude,
+            take_snapshot=False, keep_specs=keep_specs,
+            send_targets=send_targets, send_base=send_base,
+            replicate=replicate, dry_run=False)
+
+    def prune(
+            self, datasets: Sequence[Dataset], keep_specs: Sequence[KeepSpec],
+            *, recursive: bool = False, exclude: Sequence[Dataset] = ()) \
+            -> Plan:
+        """
+        Destroy the snapshots of the datasets which are not kept according to
+        the keep specifications.
+        """
+        return self._run(
+            datasets, recursive=recursive, exclude=exclude,
+            take_snapshot=False, keep_specs=keep_specs, send_targets=[],
+            send_base=None, replicate=False, dry_run=False)
+
+    def plan(
+            self, datasets: Sequence[Dataset], *, recursive: bool = False,
+            exclude: Sequence[Dataset] = (), take_snapshot: bool = True,
+            keep_specs: Sequence[KeepSpec] | None = None,
+            send_targets: Sequence[Dataset] = (),
+            send_base: Dataset | None = None, replicate: bool = False) \
+            -> Plan:
+        """
+        Return what a run with the specified options would do, including
+        estimates of the sizes of the sent data, without doing it.
+        """
+        return self._run(
+            datasets, recursive=recursive, exclude=exclude,
+            take_snapshot=take_snapshot, keep_specs=keep_specs,
+            send_targets=send_targets, send_base=send_base,
+            replicate=replicate, dry_run=True)
+
+    def inventory(
+            self, datasets: Sequence[Dataset], *, recursive: bool = False,
+            exclude: Sequence[Dataset] = ()) \
+            -> dict[Dataset, DatasetInventory]:
+        """
+        Return the snapshots and bookmarks of each selected dataset, ordered
+        by createtxg.
+        """
+        with self._use_backend():
+            selected_datasets, _ = _get_selected_datasets(
+                list(datasets), recursive, list(exclude))
+
+            return {
+                dataset: DatasetInventory(snapshots, bookmarks)
+                for dataset, snapshots, bookmarks
+                in iter_snapshots_and_bookmarks(selected_datasets)}
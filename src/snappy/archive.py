@@ -0,0 +1,392 @@
+"""
+Archives of send streams in a plain directory, for send targets that are not
+ZFS pools, e.g. bulk storage mounted over the network.
+
+The archive of a dataset is a directory containing a manifest and the streams
+of the sent snapshots, each split into chunk files of a limited size. The
+manifest lists the streams in the order in which they were sent, together
+with the guids of their snapshot and incremental base, which replaces listing
+the snapshots of a target dataset. As `@` can't appear in dataset names, the
+names of these files never collide with the directories of the archives of
+child datasets.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import ExitStack
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from subprocess import CalledProcessError
+from typing import IO, Any, Optional
+
+import dacite
+
+from snappy.utils import UserError, StreamChecksum, create_hasher, \
+    format_size, write_all
+from snappy.zfs import Dataset, Snapshot, Bookmark, SnapshotTable, \
+    send_stream, receive_stream, list_snapshots
+
+
+manifest_name = '@manifest.json'
+
+# Maximum size of a single chunk file.
+chunk_size = 1024 ** 3
+
+# Size of the blocks in which streams are read and written.
+_block_size = 8 * 1024 * 1024
+
+# Number of blocks written concurrently, and the maximum number of blocks
+# which have been read but not yet written.
+_write_jobs = 4
+_max_pending_blocks = 2 * _write_jobs
+
+
+@dataclass
+class ArchivedChunk:
+    file: str
+    size: int
+
+
+@dataclass
+class ArchivedStream:
+    snapshot: str
+    guid: int
+
+    # Guid of the incremental base, None for a full stream, which starts a new
+    # chain of streams.
+    base_guid: Optional[int]
+    size: int
+    checksum: str
+    chunks: list[ArchivedChunk]
+
+
+@dataclass
+class Manifest:
+    # The dataset the streams were sent from.
+    dataset: str
+    streams: list[ArchivedStream]
+
+
+def is_archive_target(target: str) -> bool:
+    """
+    Return whether a send target is a directory instead of a dataset, which
+    is the case for absolute paths.
+    """
+    return target.startswith('/')
+
+
+def read_manifest(directory: Path) -> Manifest | None:
+    """
+    Return the manifest of the archive in `directory`, or None if there is
+    none.
+    """
+    path = directory / manifest_name
+
+    try:
+        data = json.loads(path.read_text())
+
+        return dacite.from_dict(Manifest, data)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, dacite.DaciteError) as e:
+        raise UserError(f'Error reading archive manifest `{path}\': {e}')
+
+
+def _fsync_directory(directory: Path) -> None:
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_manifest(directory: Path, manifest: Manifest) -> None:
+    path = directory / manifest_name
+    temp_path = directory / f'{manifest_name}.tmp'
+
+    # Replace the manifest atomically so that it always lists complete
+    # streams only.
+    with open(temp_path, 'w') as file:
+        json.dump(asdict(manifest), file, indent=2)
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(temp_path, path)
+    _fsync_directory(directory)
+
+
+def get_archived_snapshots(targets: list[Dataset]) \
+        -> dict[Dataset, SnapshotTable[Snapshot]]:
+    """
+    Return the snapshots archived in those of the directories in `targets`
+    which contain an archive, in the order in which they were sent.
+    """
+    res = {}
+
+    for target in targets:
+        manifest = read_manifest(Path(target))
+
+        if manifest is not None:
+            table = SnapshotTable(Snapshot, target)
+
+            for i, stream in enumerate(manifest.streams, 1):
+                table.append(stream.snapshot, stream.guid, i)
+
+            res[target] = table
+
+    return res
+
+
+def _read_block(stream: IO[bytes], size: int) -> bytes:
+    """
+    Read `size` bytes from the stream, or fewer only at its end.
+    """
+    parts = []
+
+    while size:
+        data = stream.read(size)
+
+        if not data:
+            break
+
+        parts.append(data)
+        size -= len(data)
+
+    return b''.join(parts)
+
+
+def _write_block(fd: int, data: bytes, offset: int) -> None:
+    while data:
+        written = os.pwrite(fd, data, offset)
+        data = data[written:]
+        offset += written
+
+
+def _preallocate(fd: int, size: int) -> None:
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError:
+        # Not supported by all filesystems. The chunk is then allocated while
+        # writing it.
+        pass
+
+
+def _write_chunks(stream: IO[bytes], directory: Path, name: str) \
+        -> tuple[list[ArchivedChunk], StreamChecksum]:
+    """
+    Write the stream to chunk files in `directory` and return the chunks and
+    the checksum of the stream.
+
+    The stream is read sequentially while blocks that have been read are
+    written concurrently, so that reading the stream and the latency of the
+    storage overlap.
+    """
+    hasher = create_hasher()
+    size = 0
+    chunks: list[ArchivedChunk] = []
+    fds: list[int] = []
+    pending_blocks = threading.BoundedSemaphore(_max_pending_blocks)
+    futures: list[Future[None]] = []
+    errors: list[BaseException] = []
+
+    def block_written(future: Future[None]) -> None:
+        pending_blocks.release()
+        error = future.exception()
+
+        if error is not None:
+            errors.append(error)
+
+    with ExitStack() as stack:
+        with ThreadPoolExecutor(max_workers=_write_jobs) as executor:
+            while not errors:
+                if chunks and chunks[-1].size < chunk_size:
+                    remaining_size = chunk_size - chunks[-1].size
+                else:
+                    remaining_size = chunk_size
+
+                data = _read_block(stream, min(_block_size, remaining_size))
+
+                if not data:
+                    break
+
+                if remaining_size == chunk_size:
+                    chunk = ArchivedChunk(f'@{name}.{len(chunks):04}', 0)
+
+                    # Chunks left over from an aborted run, which are not
+                    # listed in the manifest, are overwritten.
+                    fd = os.open(
+                        directory / chunk.file,
+                        os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+                    stack.callback(os.close, fd)
+                    _preallocate(fd, chunk_size)
+                    chunks.append(chunk)
+                    fds.append(fd)
+
+                chunk = chunks[-1]
+                hasher.update(data)
+                pending_blocks.acquire()
+
+                future = executor.submit(
+                    _write_block, fds[-1], data, chunk.size)
+
+                future.add_done_callback(block_written)
+                futures.append(future)
+                chunk.size += len(data)
+                size += len(data)
+
+        for future in futures:
+            future.result()
+
+        for fd, chunk in zip(fds, chunks):
+            # Release the space preallocated beyond the end of the stream.
+            os.ftruncate(fd, chunk.size)
+            os.fsync(fd)
+
+    return chunks, StreamChecksum(hasher.name, hasher.hexdigest(), size)
+
+
+def _get_guid(table: SnapshotTable[Any], name: str) -> int:
+    index = table.find_name(name)
+
+    if index is None:
+        raise UserError(f'`{table.dataset}\' has no snapshot or bookmark '
+                        f'named `{name}\'.')
+
+    return table.guids[index]
+
+
+def archive_snapshot(
+        incremental_base: Bookmark | Snapshot | None, snapshot: Snapshot,
+        directory: Path, snapshots: SnapshotTable[Snapshot],
+        bookmarks: SnapshotTable[Bookmark]) \
+        -> StreamChecksum:
+    """
+    Write the stream of `snapshot`, incrementally from `incremental_base` if
+    it is not None, to the archive in `directory` and add it to the manifest.
+    The guids recorded in the manifest are looked up in `snapshots` and
+    `bookmarks`, which are those of the source dataset.
+    """
+    logging.info(f'Archiving snapshot: {snapshot} to {directory}')
+
+    if incremental_base is None:
+        base_guid = None
+    elif isinstance(incremental_base, Bookmark):
+        base_guid = _get_guid(bookmarks, incremental_base.name)
+    else:
+        base_guid = _get_guid(snapshots, incremental_base.name)
+
+    try:
+        directory.mkdir(parents=True, exist_ok=True)
+        manifest = read_manifest(directory) \
+            or Manifest(snapshot.dataset, [])
+
+        with send_stream(incremental_base, snapshot) as stream:
+            chunks, checksum = _write_chunks(stream, directory, snapshot.name)
+
+        manifest.streams.append(ArchivedStream(
+            snapshot=snapshot.name,
+            guid=_get_guid(snapshots, snapshot.name),
+            base_guid=base_guid,
+            size=checksum.size,
+            checksum=str(checksum),
+            chunks=chunks))
+
+        _write_manifest(directory, manifest)
+    except OSError as e:
+        raise UserError(f'Error writing to archive `{directory}\': {e}')
+
+    logging.info(
+        f'Archived {snapshot}: {format_size(checksum.size)} in '
+        f'{len(chunks)} chunk(s), {checksum.algorithm} {checksum.value}')
+
+    return checksum
+
+
+def _restore_stream(
+        directory: Path, stream: ArchivedStream, target: Snapshot) \
+        -> None:
+    logging.info(
+        f'Restoring snapshot: {target} ({format_size(stream.size)})')
+
+    algorithm, _, _ = stream.checksum.partition(':')
+    hasher = create_hasher(algorithm)
+
+    # `zfs receive` completes as soon as it has read the whole stream, so the
+    # most recently read block is only written once the next one has been
+    # read, and the last one once the stream has been verified.
+    pending_data = b''
+
+    with receive_stream(target) as pipe:
+        for chunk in stream.chunks:
+            path = directory / chunk.file
+            size = 0
+
+            with open(path, 'rb', buffering=0) as file:
+                while data := file.read(_block_size):
+                    hasher.update(data)
+                    write_all(pipe, pending_data)
+                    pending_data = data
+                    size += len(data)
+
+            if size != chunk.size:
+                raise UserError(
+                    f'Chunk `{path}\' has a size of {size} bytes instead of '
+                    f'{chunk.size} bytes.')
+
+        # Leaving the context with an exception aborts receiving the stream.
+        checksum = StreamChecksum(hasher.name, hasher.hexdigest(), stream.size)
+
+        if str(checksum) != stream.checksum:
+            raise UserError(
+                f'Checksum of the stream of {stream.snapshot} in `{directory}\' '
+                f'does not match the manifest.')
+
+        write_all(pipe, pending_data)
+
+
+def restore_archive(directory: Path, target: Dataset) -> None:
+    """
+    Receive the most recent chain of streams in the archive in `directory`
+    into `target`, skipping those which have already been received.
+    """
+    manifest = read_manifest(directory)
+
+    if manifest is None:
+        raise UserError(f'No archive found in `{directory}\'.')
+
+    full_indices = [
+        i for i, x in enumerate(manifest.streams) if x.base_guid is None]
+
+    if not full_indices:
+        raise UserError(f'Archive in `{directory}\' contains no full stream.')
+
+    streams = manifest.streams[full_indices[-1]:]
+
+    try:
+        target_guids = set(list_snapshots(target, quiet=True).guids)
+    except CalledProcessError:
+        # The target is created when receiving the full stream.
+        target_guids = set()
+
+    received_indices = [
+        i for i, x in enumerate(streams) if x.guid in target_guids]
+
+    if received_indices:
+        streams = streams[received_indices[-1] + 1:]
+
+    if not streams:
+        logging.info(f'All snapshots have already been restored to {target}.')
+
+    try:
+        for stream in streams:
+            _restore_stream(
+                directory, stream, Snapshot(target, stream.snapshot))
+    except OSError as e:
+        raise UserError(f'Error reading from archive `{directory}\': {e}')
@@ -2,18 +2,23 @@ from __future__ import annotations
 
 import argparse
 import logging
-import shlex
 import sys
 from argparse import Namespace
+from datetime import timedelta
 from pathlib import Path
 from subprocess import CalledProcessError
 from typing import TypeVar, Callable, Sequence
 
-from snappy.config import get_default_config_path, parse_keep_spec, KeepSpec
-from snappy.snappy import auto_command, cli_command, \
-    default_snapshot_name_prefix, AutoAction
-from snappy.utils import BetterHelpFormatter, UserError
-from snappy.zfs import Dataset
+from snappy.config import get_default_config_path, parse_keep_spec, \
+    KeepSpec, parse_size, parse_interval, ScanPolicy
+from snappy.plan import PlanFormat, format_plans
+from snappy.send import stream_checksum_property
+from snappy.snappy import auto_command, cli_command, restore_command, \
+    default_snapshot_name_prefix, default_prune_jobs, AutoAction, \
+    throttled_send_rate
+from snappy.utils import BetterHelpFormatter, UserError, format_cmdline, \
+    format_size
+from snappy.zfs import Dataset, ZfsBackendType, set_backend
 
 
 T = TypeVar('T')
@@ -36,7 +41,10 @@ def _parse_args() -> Namespace:
         nargs='*',
         type=Dataset,
         metavar='DATASETS',
-        help='Datasets on which to create and prune snapshots.')
+        help='Datasets on which to create and prune snapshots. Components of '
+             'a dataset name may be glob patterns, e.g. `tank/vm/*/swap\'. If '
+             'a name starts with `re:\', its components are regular '
+             'expressions instead.')
 
     parser.add_argument(
         '-r',
@@ -52,7 +60,7 @@ def _parse_args() -> Namespace:
         action='append',
         default=[],
         help='Exclude a dataset and its children when enumerating datasets '
-             'recursively.')
+             'recursively. Accepts the same patterns as DATASETS.')
 
     parser.add_argument(
         '-p',
@@ -69,8 +77,94 @@ def _parse_args() -> Namespace:
         help='Disables creating snapshots. Instead, only prune and/or send '
              'snapshots.')
 
+    parser.add_argument(
+        '--min-written',
+        type=parse_size,
+        metavar='SIZE',
+        help='Only create snapshots of datasets to which at least SIZE bytes, '
+             'e.g. `10M\', have been written since their most recent '
+             'snapshot. Keep specifications then treat each snapshot as '
+             'standing in for the skipped ones until the next snapshot, so '
+             'this option should also be given when only pruning.')
+
+    parser.add_argument(
+        '--max-snapshot-age',
+        type=parse_interval,
+        metavar='INTERVAL',
+        help='With --min-written, also create a snapshot of datasets whose '
+             'most recent snapshot is older than INTERVAL, e.g. `1d\'.')
+
+    parser.add_argument(
+        '--high-frequency',
+        action='store_true',
+        help='Include milliseconds in the names of created snapshots, so that '
+             'snapshots can be taken more than once per second, and send a '
+             'backlog of snapshots in a single stream.')
+
+    parser.add_argument(
+        '--on-scan',
+        type=ScanPolicy,
+        default=ScanPolicy.ignore,
+        dest='scan_policy',
+        metavar='POLICY',
+        help='What to do with sends and pruning on pools which are being '
+             'scrubbed or resilvered, which is checked using a single `zpool '
+             'status\' call. `ignore\' proceeds as usual. `throttle\' '
+             f'limits sends from or to those pools to '
+             f'{format_size(throttled_send_rate)}/s and destroys expired '
+             f'snapshots on them one dataset at a time. `defer\' skips '
+             f'sending from or to those pools and pruning on them and reports '
+             f'the deferred datasets. Snapshots are created in any case. '
+             f'Defaults to `ignore\'.')
+
+    parser.add_argument(
+        '--zfs-backend',
+        type=ZfsBackendType,
+        default=ZfsBackendType.cli,
+        metavar='BACKEND',
+        help='How ZFS operations are performed. `cli\' runs the `zfs\' '
+             'command for each operation. `lzc\' creates and destroys '
+             'snapshots and bookmarks in-process using libzfs_core, which '
+             'requires the pyzfs Python bindings. Defaults to `cli\'.')
+
+    parser.add_argument(
+        '--plan',
+        nargs='?',
+        const=PlanFormat.table,
+        type=PlanFormat,
+        dest='plan_format',
+        metavar='FORMAT',
+        help='Only print what would be done, including the estimated amount '
+             'of data to send, without changing anything. FORMAT is either '
+             '`table\' or `json\'. Defaults to `table\'.')
+
+    parser.add_argument(
+        '--lock-timeout',
+        type=float,
+        metavar='SECONDS',
+        help='How long to wait for other runs operating on the same datasets '
+             'to finish. Defaults to waiting indefinitely, or not at all with '
+             '--skip-if-busy.')
+
+    parser.add_argument(
+        '--skip-if-busy',
+        action='store_true',
+        help='Do nothing and exit successfully if other runs operating on the '
+             'same datasets don\'t finish in time. With --auto, only the '
+             'affected entries of the configuration file are skipped.')
+
     prune_group = parser.add_argument_group('pruning')
 
+    prune_group.add_argument(
+        '--prune-jobs',
+        type=int,
+        default=default_prune_jobs,
+        metavar='N',
+        help=f'Maximum number of datasets on the same pool whose expired '
+             f'snapshots are destroyed concurrently. Defaults to '
+             f'{default_prune_jobs}. When sending, the snapshots of each '
+             f'target are destroyed while the following datasets are sent.')
+
     prune_group.add_argument(
         '-k',
         '--keep',
@@ -80,17 +174,40 @@ def _parse_args() -> Namespace:
         help='Prune snapshots according to this list of keep specifications.\n'
              'See https://github.com/Feuermurmel/snappy#pruning.')
 
+    prune_group.add_argument(
+        '--max-capacity',
+        type=int,
+        metavar='PERCENT',
+        help='After pruning according to the keep specifications, also '
+             'destroy the oldest snapshots on each pool filled above PERCENT '
+             'until destroying them is estimated to bring it below. The most '
+             'recent snapshot of each dataset is always kept. Requires '
+             '--keep.')
+
     send_group = parser.add_argument_group('sending snapshots')
 
     send_group.add_argument(
         '-s',
         '--send-to',
         type=Dataset,
-        dest='send_target',
+        action='append',
+        dest='send_targets',
         metavar='TARGET',
         help='Send the snapshots of the DATASETS into child filesystem of this '
              'target filesystem. If specified, pruning will happen on the '
-             'target datasets instead of the source datasets.')
+             'target datasets instead of the source datasets.\n'
+             '\n'
+             'Can be given multiple times to send to several targets. Each '
+             'snapshot is then read from the source once for all targets '
+             'which have the same incremental base. If receiving fails on one '
+             'of the targets, sending to the others continues. Not supported '
+             'with --replicate.\n'
+             '\n'
+             'If TARGET is an absolute path, the streams are instead written '
+             'to chunk files in a directory at that path, with a manifest '
+             'listing them, from which they can be restored using '
+             '--restore-from. Pruning and --replicate are not supported in '
+             'this case.')
 
     send_group.add_argument(
         '-b',
@@ -102,6 +219,45 @@ def _parse_args() -> Namespace:
              'single source dataset can be sent at a time, which is sent '
              'directly to TARGET.')
 
+    send_group.add_argument(
+        '--replicate',
+        action='store_true',
+        help='Send each subtree of which all datasets are selected using a '
+             'single replication stream (`zfs send -R\'). The most recently '
+             'sent snapshot is kept on the source as the base of the next '
+             'stream. Subtrees whose datasets or targets differ in their '
+             'snapshots are sent dataset by dataset. Requires --recursive.')
+
+    send_group.add_argument(
+        '--keep-bookmarks',
+        type=list_arg(parse_keep_spec),
+        dest='bookmark_keep_specs',
+        metavar='KEEP_SPECIFICATIONS',
+        help='Keep the bookmarks of sent snapshots on the source which are '
+             'selected by this list of keep specifications, instead of only '
+             'the bookmark of the most recently sent snapshot. Any of them '
+             'can be used as the base of an incremental send if the more '
+             'recent snapshots are missing on the target. Requires '
+             '--send-to.')
+
+    send_group.add_argument(
+        '--checksum-streams',
+        action='store_true',
+        help='Pass the sent streams through snappy to count their bytes and '
+             'compute a checksum (xxh3 if the xxhash module is installed, '
+             'crc32 otherwise), which is recorded in the user property '
+             f'`{stream_checksum_property}\' of each received snapshot. Also '
+             'detects if the sending process fails.')
+
+    send_group.add_argument(
+        '--restore-from',
+        type=Path,
+        metavar='DIRECTORY',
+        help='Instead of creating snapshots, receive the streams written to '
+             'DIRECTORY by sending to it into the single dataset given as '
+             'DATASETS. Streams of snapshots which already exist on the '
+             'dataset are skipped.')
+
     auto_group = parser.add_argument_group('running from config file')
 
     auto_group.add_argument(
@@ -128,18 +284,64 @@ def _parse_args() -> Namespace:
         help=f'Path to the configuration file to use. Requires --auto. '
              f'Defaults to `{get_default_config_path()}\'.')
 
+    auto_group.add_argument(
+        '--from-properties',
+        action='store_true',
+        help='Instead of a configuration file, read the configuration from '
+             'the user properties of DATASETS and their descendants. Requires '
+             '--auto.\n'
+             'See https://github.com/Feuermurmel/snappy'
+             '#configuration-using-properties.')
+
     args = parser.parse_args()
 
     def check(condition: bool, message: str) -> None:
         if not condition:
             parser.error(message)
 
+    check(args.prune_jobs >= 1, '--prune-jobs must be at least 1.')
+
     if args.auto_actions:
-        check(not args.datasets and not args.recursive and args.prefix is None
+        if args.from_properties:
+            check(args.datasets and args.config_path is None,
+                  '--from-properties requires DATASETS and conflicts with '
+                  '--config.')
+        else:
+            check(not args.datasets,
+                  '--auto conflicts with DATASETS unless --from-properties is '
+                  'given.')
+
+        check(not args.recursive and args.prefix is None
               and args.take_snapshot and not args.keep_specs
-              and args.send_target is None and args.send_base is None,
-              '--auto conflicts with DATASETS, --recursive, --prefix, '
-              '--no-snapshot, --keep, --send-to, and --send-base.')
+              and args.send_targets is None and args.send_base is None
+              and not args.replicate and not args.checksum_streams
+              and args.restore_from is None and args.min_written is None
+              and args.max_snapshot_age is None and args.max_capacity is None
+              and not args.high_frequency
+              and args.bookmark_keep_specs is None
+              and args.scan_policy is ScanPolicy.ignore,
+              '--auto conflicts with --recursive, --prefix, --no-snapshot, '
+              '--keep, --send-to, --send-base, --replicate, '
+              '--checksum-streams, --restore-from, --min-written, '
+              '--max-snapshot-age, --max-capacity, --high-frequency, '
+              '--keep-bookmarks, and --on-scan.')
+    elif args.restore_from is not None:
+        check(len(args.datasets) == 1 and not args.recursive
+              and args.prefix is None and args.take_snapshot
+              and args.keep_specs is None and args.send_targets is None
+              and args.send_base is None and not args.replicate
+              and not args.checksum_streams and args.plan_format is None
+              and args.min_written is None and args.max_snapshot_age is None
+              and args.max_capacity is None and not args.high_frequency
+              and not args.from_properties
+              and args.bookmark_keep_specs is None
+              and args.scan_policy is ScanPolicy.ignore,
+              '--restore-from requires a single dataset and conflicts with '
+              '--recursive, --prefix, --no-snapshot, --keep, --send-to, '
+              '--send-base, --replicate, --checksum-streams, --plan, '
+              '--min-written, --max-snapshot-age, --max-capacity, '
+              '--high-frequency, --from-properties, --keep-bookmarks, and '
+              '--on-scan.')
     else:
         check(args.datasets,
               'DATASETS is required unless --auto is given.')
@@ -150,18 +352,45 @@ def _parse_args() -> Namespace:
         check(args.config_path is None,
               '--config requires --auto, --auto-send, or --auto-snapshot.')
 
+        check(not args.from_properties,
+              '--from-properties requires --auto.')
+
         check(args.take_snapshot or args.keep_specs is not None
-              or args.send_target,
+              or args.send_targets,
               '--no-snapshot requires at least one of --keep and --send-to.')
 
-        if args.send_target is None:
+        check(args.recursive or not args.replicate,
+              '--replicate requires --recursive.')
+
+        check(args.min_written is not None or args.max_snapshot_age is None,
+              '--max-snapshot-age requires --min-written.')
+
+        check(args.max_capacity is None or args.keep_specs is not None,
+              '--max-capacity requires --keep.')
+
+        check(args.max_capacity is None or 0 < args.max_capacity < 100,
+              '--max-capacity must be between 0 and 100.')
+
+        if args.send_targets is None:
             check(args.send_base is None,
                   '--send-base requires --send-to.')
+
+            check(not args.replicate,
+                  '--replicate requires --send-to.')
+
+            check(not args.checksum_streams,
+                  '--checksum-streams requires --send-to.')
+
+            check(args.bookmark_keep_specs is None,
+                  '--keep-bookmarks requires --send-to.')
         else:
             check(len(args.datasets) < 2 or args.send_base is not None,
                   '--send-to requires --send-base if more than one dataset is '
                   'specified')
 
+            check(len(args.send_targets) < 2 or not args.replicate,
+                  '--replicate does not support multiple --send-to.')
+
     return args
 
 
@@ -170,12 +399,30 @@ def _parse_args() -> Namespace:
 def main(
         datasets: list[Dataset], recursive: bool, exclude: list[Dataset],
         prefix: str | None, take_snapshot: bool,
-        keep_specs: list[KeepSpec] | None, send_target: Dataset | None,
+        keep_specs: list[KeepSpec] | None,
+        send_targets: list[Dataset] | None,
         send_base: Dataset | None, auto_actions: Sequence[AutoAction] | None,
-        config_path: Path | None) \
+        config_path: Path | None, from_properties: bool,
+        zfs_backend: ZfsBackendType,
+        plan_format: PlanFormat | None, lock_timeout: float | None,
+        skip_if_busy: bool, prune_jobs: int, replicate: bool,
+        checksum_streams: bool, restore_from: Path | None,
+        min_written: int | None, max_snapshot_age: timedelta | None,
+        max_capacity: int | None, high_frequency: bool,
+        bookmark_keep_specs: list[KeepSpec] | None,
+        scan_policy: ScanPolicy) \
         -> None:
+    set_backend(zfs_backend)
+    dry_run = plan_format is not None
+
+    if restore_from is not None:
+        target, = datasets
+        restore_command(restore_from, target, lock_timeout)
+
+        return
+
     if auto_actions is None:
-        cli_command(
+        plan = cli_command(
             datasets=datasets,
             recursive=recursive,
             exclude=exclude,
@@ -183,12 +430,31 @@ def main(
             take_snapshot=take_snapshot,
             pre_snapshot_script=None,
             keep_specs=keep_specs,
-            send_target=send_target,
+            send_targets=send_targets or [],
             send_base=send_base,
             do_snapshot=True,
-            do_send=True)
+            do_send=True,
+            dry_run=dry_run,
+            lock_timeout=lock_timeout,
+            skip_if_busy=skip_if_busy,
+            prune_jobs=prune_jobs,
+            replicate=replicate,
+            checksum_streams=checksum_streams,
+            min_written=min_written,
+            max_snapshot_age=max_snapshot_age,
+            max_capacity=max_capacity,
+            high_frequency=high_frequency,
+            bookmark_keep_specs=bookmark_keep_specs,
+            scan_policy=scan_policy)
+
+        plans = [plan]
     else:
-        auto_command(config_path, auto_actions)
+        plans = auto_command(
+            config_path, auto_actions, dry_run, lock_timeout, skip_if_busy,
+            prune_jobs, datasets if from_properties else None)
+
+    if plan_format is not None:
+        print(format_plans(plans, plan_format))
 
 
 def entry_point() -> None:
@@ -200,12 +466,8 @@ def entry_point() -> None:
         logging.error(f'error: {e}')
         sys.exit(1)
     except CalledProcessError as e:
-        cmdline_str = e.cmd
-
-        if not isinstance(e.cmd, (str, bytes)):
-            cmdline_str = shlex.join(cmdline_str)
-
-        logging.error(f'error: Internal command failed: {cmdline_str}')
+        logging.error(
+            f'error: Internal command failed: {format_cmdline(e.cmd)}')
         sys.exit(1)
     except KeyboardInterrupt:
         logging.error('Operation interrupted.')
@@ -4,8 +4,9 @@ import re
 from argparse import ArgumentTypeError
 from dataclasses import dataclass, field
 from datetime import timedelta
+from enum import Enum
 from pathlib import Path
-from typing import Union, Optional
+from typing import Union, Optional, NewType, Callable, TypeVar
 
 import dacite
 import toml
@@ -13,7 +14,36 @@ from typing_extensions import TypeAlias
 
 from snappy.test_utils import mockable_fn
 from snappy.utils import UserError
-from snappy.zfs import Dataset
+from snappy.zfs import Dataset, get_inherited_properties
+
+
+T = TypeVar('T')
+
+# User properties from which the configuration can be read instead of from a
+# config file.
+snapshot_property = 'snappy:snapshot'
+keep_property = 'snappy:keep'
+send_to_property = 'snappy:send-to'
+prefix_property = 'snappy:prefix'
+
+_property_names = \
+    [snapshot_property, keep_property, send_to_property, prefix_property]
+
+
+class ScanPolicy(Enum):
+    """
+    How sends and pruning are handled on pools which are being scrubbed or
+    resilvered.
+    """
+    # Proceed as usual.
+    ignore = 'ignore'
+
+    # Destroy expired snapshots on those pools one dataset at a time.
+    throttle = 'throttle'
+
+    # Skip sending from and to those pools and pruning on them until the
+    # scan has finished.
+    defer = 'defer'
 
 
 @dataclass
@@ -29,9 +59,32 @@ class SnapshotConfig:
     prefix: Optional[str] = None
     take_snapshot: bool = True
     pre_snapshot_script: Optional[str] = None
+    snapshot_hooks: list[SnapshotHook] = field(default_factory=list)
     prune_keep: Optional[list[KeepSpec]] = None
-    send_target: Optional[Dataset] = None
+    send_target: Optional[SendTargets] = None
     send_base: Optional[Dataset] = None
+    replicate: bool = False
+    checksum_streams: bool = False
+    min_written: Optional[ByteSize] = None
+    max_snapshot_age: Optional[timedelta] = None
+    max_capacity: Optional[int] = None
+    high_frequency: bool = False
+    bookmark_keep: Optional[list[KeepSpec]] = None
+    on_scan: ScanPolicy = ScanPolicy.ignore
+
+
+@dataclass
+class SnapshotHook:
+    """
+    Commands run immediately before and after a snapshot of a dataset is
+    created, e.g. to freeze and thaw an application storing data on it.
+    """
+    dataset: Dataset
+    freeze: str
+    thaw: Optional[str] = None
+
+    # Seconds after which each of the commands is killed.
+    timeout: float = 60
 
 
 @dataclass
@@ -47,6 +100,12 @@ class IntervalKeepSpec:
 
 KeepSpec: TypeAlias = Union[MostRecentKeepSpec, IntervalKeepSpec]
 
+# A number of bytes, which can be given with a unit in config files.
+ByteSize = NewType('ByteSize', int)
+
+# One or more send targets, a single one can be given as a string.
+SendTargets = NewType('SendTargets', list[Dataset])
+
 
 # A bit of a hack that works both with dacite and argparse to produce sensible
 # error messages.
@@ -70,6 +129,8 @@ _units = {
     'd': timedelta(days=1),
     'w': timedelta(weeks=1)}
 
+_size_units = 'KMGTPE'
+
 
 def parse_keep_spec(value: str) -> KeepSpec:
     match = re.fullmatch('([0-9]*)([^:]*?)(?::(.*))?', value)
@@ -116,7 +177,61 @@ def parse_keep_spec(value: str) -> KeepSpec:
         return IntervalKeepSpec(number * unit, count)
 
 
-_dacite_type_hooks = {KeepSpec: parse_keep_spec}
+def parse_interval(value: str) -> timedelta:
+    match = re.fullmatch('([0-9]+)(.*)', value)
+
+    if not match:
+        raise ValidationError(f'Invalid interval `{value}\'.')
+
+    number_str, unit_str = match.groups()
+    unit = _units.get(unit_str)
+
+    if unit is None:
+        raise ValidationError(f'Unknown unit `{unit_str}\'.')
+
+    if int(number_str) <= 0:
+        raise ValidationError('Interval must be non-zero.')
+
+    return int(number_str) * unit
+
+
+def parse_size(value: str | int) -> ByteSize:
+    """
+    Parse a number of bytes, optionally followed by one of the units the `zfs`
+    command uses, e.g. `1.5G'.
+    """
+    match = re.fullmatch(
+        '([0-9]+(?:\\.[0-9]*)?)([kmgtpe]?)b?', str(value), re.IGNORECASE)
+
+    if not match:
+        raise ValidationError(f'Invalid size `{value}\'.')
+
+    number_str, unit_str = match.groups()
+    exponent = _size_units.index(unit_str.upper()) + 1 if unit_str else 0
+
+    return ByteSize(int(float(number_str) * 1024 ** exponent))
+
+
+def parse_scan_policy(value: str) -> ScanPolicy:
+    try:
+        return ScanPolicy(value)
+    except ValueError:
+        raise ValidationError(
+            f'Expected one of {", ".join(i.value for i in ScanPolicy)}.')
+
+
+def parse_send_targets(value: str | list[str]) -> SendTargets:
+    if isinstance(value, str):
+        value = [value]
+
+    return SendTargets([Dataset(i) for i in value])
+
+
+# TOML distinguishes between integers and floats but we don't.
+_dacite_type_hooks = {
+    KeepSpec: parse_keep_spec, float: float, ByteSize: parse_size,
+    timedelta: parse_interval, SendTargets: parse_send_targets,
+    ScanPolicy: parse_scan_policy}
 
 
 def get_default_config_path() -> Path:
@@ -143,6 +258,39 @@ def _validate_config(config: Config, config_path: Path) -> None:
               'Key `pre_snapshot_script\' requires that `take_snapshot\' is '
               'set to true')
 
+        check(not i.snapshot_hooks or i.take_snapshot,
+              'Key `snapshot_hooks\' requires that `take_snapshot\' is set to '
+              'true')
+
+        check(all(j.timeout > 0 for j in i.snapshot_hooks),
+              'The `timeout\' of a snapshot hook must be positive.')
+
+        check(i.send_target is None or i.send_target,
+              '`send_target\' cannot be an empty list.')
+
+        check(not i.replicate or i.send_target is None
+              or len(i.send_target) < 2,
+              'Key `replicate\' is not supported with multiple send targets.')
+
+        check(i.max_capacity is None or i.prune_keep,
+              'Key `max_capacity\' requires that `prune_keep\' is set.')
+
+        check(i.max_capacity is None or 0 < i.max_capacity < 100,
+              '`max_capacity\' must be between 0 and 100.')
+
+        check(i.bookmark_keep is None or i.bookmark_keep,
+              '`bookmark_keep\' cannot be an empty list.')
+
+        check(i.bookmark_keep is None or i.send_target is not None,
+              'Key `bookmark_keep\' requires that `send_target\' is set.')
+
+        check(i.max_snapshot_age is None or i.min_written is not None,
+              'Key `max_snapshot_age\' requires that `min_written\' is set.')
+
+        check(not i.replicate or (i.recursive and i.send_target is not None),
+              'Key `replicate\' requires that `recursive\' is set to true and '
+              '`send_target\' is set.')
+
         if i.send_target is None:
             check(i.send_base is None,
                   'Key `send_target\' is required if `send_base\' is set.')
@@ -165,3 +313,77 @@ def load_config(path: Path) -> Config:
     _validate_config(config, path)
 
     return config
+
+
+def _parse_on_off(value: str) -> bool:
+    if value not in ['on', 'off']:
+        raise ValidationError('Expected `on\' or `off\'.')
+
+    return value == 'on'
+
+
+def _parse_optional_list(value: str, parse_fn: Callable[[str], T]) \
+        -> list[T] | None:
+    if value == 'none':
+        return None
+
+    return [parse_fn(i) for i in value.split(',')]
+
+
+def load_property_config(roots: list[Dataset]) -> Config:
+    """
+    Read the configuration from the user properties set on or inherited by
+    the roots and their descendants. Datasets with the same effective
+    properties are grouped into a single entry.
+    """
+    properties_by_dataset = get_inherited_properties(roots, _property_names)
+
+    entries: dict[tuple[str | None, ...], SnapshotConfig] = {}
+
+    for dataset, properties in properties_by_dataset.items():
+        def get(name: str, parse_fn: Callable[[str], T]) -> T | None:
+            property = properties.get(name)
+
+            if property is None:
+                return None
+
+            try:
+                return parse_fn(property.value)
+            except ValidationError as e:
+                raise UserError(
+                    f'Invalid value of property `{name}\' on '
+                    f'`{property.source}\': {e}')
+
+        take_snapshot = get(snapshot_property, _parse_on_off)
+        keep = get(
+            keep_property, lambda x: _parse_optional_list(x, parse_keep_spec))
+        send_to = get(
+            send_to_property, lambda x: _parse_optional_list(x, Dataset))
+
+        # Only the prefix being set, e.g. inherited from a parent, doesn't
+        # select a dataset.
+        if not take_snapshot and keep is None and send_to is None:
+            continue
+
+        # Datasets are sent relative to the dataset on which the target is
+        # set.
+        send_base = None if send_to is None \
+            else properties[send_to_property].source
+
+        values = {k: v.value for k, v in properties.items()}
+        key = (*map(values.get, _property_names), send_base)
+
+        entry = entries.get(key)
+
+        if entry is None:
+            entries[key] = SnapshotConfig(
+                datasets=[dataset],
+                prefix=get(prefix_property, str),
+                take_snapshot=take_snapshot is not False,
+                prune_keep=keep,
+                send_target=None if send_to is None else SendTargets(send_to),
+                send_base=send_base)
+        else:
+            entry.datasets.append(dataset)
+
+    return Config(list(entries.values()))
@@ -0,0 +1,596 @@
+"""
+In-memory implementation of ZfsBackend, used by tests that don't need a real
+pool. It models only the parts of ZFS that snappy relies on: the hierarchy of
+datasets, snapshots and bookmarks with their guid and createtxg, and how
+receiving a stream relates snapshots on the target to those on the source.
+"""
+
+from __future__ import annotations
+
+import io
+import itertools
+import json
+import zlib
+from contextlib import contextmanager, suppress
+from dataclasses import dataclass, field
+from subprocess import CalledProcessError
+from typing import NoReturn, Iterator, IO
+
+from snappy.utils import StreamChecksum
+from snappy.zfs import ZfsBackend, Dataset, Snapshot, Bookmark, SnapshotTable, \
+    SnapshotInfo, SnapshotRange, InheritedProperty, iter_parents, \
+    property_dataset_types
+
+
+@dataclass
+class _FakeSnapshot:
+    name: str
+    guid: int
+    createtxg: int
+
+
+@dataclass
+class _FakeDataset:
+    snapshots: list[_FakeSnapshot] = field(default_factory=list)
+    bookmarks: list[_FakeSnapshot] = field(default_factory=list)
+
+
+def _fail(*cmdline: object) -> NoReturn:
+    raise CalledProcessError(1, ['zfs', *map(str, cmdline)])
+
+
+def _find(items: list[_FakeSnapshot], name: str) -> _FakeSnapshot | None:
+    for i in items:
+        if i.name == name:
+            return i
+
+    return None
+
+
+def _fake_checksum(checksum: bool, snapshots: list[_FakeSnapshot]) \
+        -> StreamChecksum | None:
+    """
+    Return a checksum of a stream containing the snapshots.
+    """
+    if not checksum:
+        return None
+
+    data = b''.join(i.guid.to_bytes(8, 'big') for i in snapshots)
+
+    return StreamChecksum('crc32', f'{zlib.crc32(data):08x}', len(data))
+
+
+class FakeZfsBackend(ZfsBackend):
+    def __init__(self) -> None:
+        self.datasets: dict[Dataset, _FakeDataset] = {}
+
+        # Names of the backend methods called, in order. Allows tests to check
+        # how many operations were performed.
+        self.calls: list[str] = []
+
+        # User properties set on snapshots.
+        self.user_properties: dict[tuple[Snapshot, str], str] = {}
+
+        # Value of the `written` property of datasets, set by tests. Reset
+        # when a snapshot of the dataset is created.
+        self.written: dict[Dataset, int] = {}
+
+        # Values of other properties of datasets, set by tests.
+        self.properties: dict[Dataset, dict[str, str]] = {}
+
+        # Space only referenced by each snapshot, set by tests.
+        self.snapshot_sizes: dict[Snapshot, int] = {}
+
+        # Kind of the scan in progress on pools, set by tests.
+        self.scans: dict[Dataset, str] = {}
+
+        # Rate limits passed to the operations sending streams, in order.
+        self.send_rate_limits: list[int | None] = []
+
+        # Datasets changed since their most recent snapshot, set by tests.
+        # Receiving into them without -F fails.
+        self.modified: set[Dataset] = set()
+
+        self._txgs = itertools.count(1)
+        self._guids = itertools.count(1000)
+
+    # Helpers used by tests to set up and inspect the state of the fake.
+
+    def create_dataset(self, dataset: str) -> None:
+        parent, sep, _ = dataset.rpartition('/')
+
+        assert dataset not in self.datasets
+        assert not sep or parent in self.datasets
+
+        self.datasets[Dataset(dataset)] = _FakeDataset()
+
+    def get_snapshots(self, dataset: str) -> list[str]:
+        return [i.name for i in self.datasets[Dataset(dataset)].snapshots]
+
+    def get_bookmarks(self, dataset: str) -> list[str]:
+        return [i.name for i in self.datasets[Dataset(dataset)].bookmarks]
+
+    def _get_dataset(self, dataset: Dataset, *cmdline: object) -> _FakeDataset:
+        fake_dataset = self.datasets.get(dataset)
+
+        if fake_dataset is None:
+            _fail(*cmdline)
+
+        return fake_dataset
+
+    def _get_snapshot(self, snapshot: Snapshot, *cmdline: object) \
+            -> _FakeSnapshot:
+        fake_snapshot = _find(
+            self._get_dataset(snapshot.dataset, *cmdline).snapshots,
+            snapshot.name)
+
+        if fake_snapshot is None:
+            _fail(*cmdline)
+
+        return fake_snapshot
+
+    # Implementation of ZfsBackend.
+
+    def iter_children(self, dataset: Dataset, *, quiet: bool) \
+            -> Iterator[Dataset]:
+        self.calls.append('iter_children')
+        self._get_dataset(dataset, 'list', dataset)
+
+        for i in sorted(self.datasets):
+            if i == dataset or i.startswith(f'{dataset}/'):
+                yield i
+
+    def iter_snapshots_and_bookmarks(
+            self, datasets: list[Dataset], *, snapshots: bool,
+            bookmarks: bool, quiet: bool) \
+            -> Iterator[tuple[
+                Dataset, SnapshotTable[Snapshot], SnapshotTable[Bookmark]]]:
+        self.calls.append('iter_snapshots_and_bookmarks')
+        missing_datasets = [i for i in datasets if i not in self.datasets]
+
+        for i in datasets:
+            fake_dataset = self.datasets.get(i)
+
+            if fake_dataset is not None:
+                snapshot_table = SnapshotTable(Snapshot, i)
+                bookmark_table = SnapshotTable(Bookmark, i)
+
+                for j in fake_dataset.snapshots if snapshots else []:
+                    snapshot_table.append(j.name, j.guid, j.createtxg)
+
+                for j in fake_dataset.bookmarks if bookmarks else []:
+                    bookmark_table.append(j.name, j.guid, j.createtxg)
+
+                yield i, snapshot_table, bookmark_table
+
+        # Like `zfs list`, report missing datasets only after listing the
+        # existing ones.
+        if missing_datasets:
+            _fail('list', *missing_datasets)
+
+    def get_snapshot_info(self, snapshot: Snapshot) -> SnapshotInfo | None:
+        self.calls.append('get_snapshot_info')
+        fake_dataset = self.datasets.get(snapshot.dataset)
+
+        if fake_dataset is None:
+            return None
+
+        fake_snapshot = _find(fake_dataset.snapshots, snapshot.name)
+
+        if fake_snapshot is None:
+            return None
+
+        return SnapshotInfo(
+            snapshot, fake_snapshot.guid, fake_snapshot.createtxg)
+
+    def get_properties(
+            self, datasets: list[Dataset], properties: list[str]) \
+            -> dict[Dataset, dict[str, str]]:
+        self.calls.append('get_properties')
+
+        def get_value(dataset: Dataset, property: str) -> str:
+            if property == 'written':
+                return str(self.written.get(dataset, 0))
+
+            # No data is stored, sizes not set by the test are zero.
+            return self.properties.get(dataset, {}).get(property, '0')
+
+        return {
+            i: {j: get_value(i, j) for j in properties}
+            for i in datasets if i in self.datasets}
+
+    def get_inherited_properties(
+            self, roots: list[Dataset], properties: list[str]) \
+            -> dict[Dataset, dict[str, InheritedProperty]]:
+        self.calls.append('get_inherited_properties')
+        res: dict[Dataset, dict[str, InheritedProperty]] = {}
+
+        for root in roots:
+            self._get_dataset(root, 'get', '-r', root)
+
+        # Like `zfs get -r`, list the snapshots and bookmarks of each dataset,
+        # which inherit its user properties, unless excluded by type.
+        items = [
+            (name, type, dataset)
+            for dataset, fake_dataset in sorted(self.datasets.items())
+            for name, type in [
+                (dataset, 'filesystem'),
+                *((f'{dataset}@{i.name}', 'snapshot')
+                  for i in fake_dataset.snapshots),
+                *((f'{dataset}#{i.name}', 'bookmark')
+                  for i in fake_dataset.bookmarks)]]
+
+        for name, type, dataset in items:
+            if type not in property_dataset_types \
+                    or not any(i in roots for i in iter_parents(dataset)):
+                continue
+
+            for property in properties:
+                source = next(
+                    (i for i in iter_parents(dataset)
+                     if property in self.properties.get(i, {})), None)
+
+                if source is not None:
+                    res.setdefault(Dataset(name), {})[property] = \
+                        InheritedProperty(
+                            self.properties[source][property], source)
+
+        return res
+
+    def get_scanning_pools(self, pools: list[Dataset]) -> dict[Dataset, str]:
+        self.calls.append('get_scanning_pools')
+
+        return {i: self.scans[i] for i in pools if i in self.scans}
+
+    def estimate_send_size(
+            self, incremental_base: Bookmark | Snapshot | None,
+            source: Snapshot, *, intermediates: bool, replicate: bool) \
+            -> int:
+        self.calls.append('estimate_send_size')
+        self._get_snapshot(source, 'send', '--dryrun', source)
+
+        return 0
+
+    def create_snapshots(
+            self, snapshots: list[Snapshot],
+            recursive_snapshots: list[Snapshot]) \
+            -> None:
+        self.calls.append('create_snapshots')
+
+        for i in recursive_snapshots:
+            self._get_dataset(i.dataset, 'snapshot', '-r', i)
+
+            snapshots = snapshots + [
+                Snapshot(j, i.name) for j in sorted(self.datasets)
+                if j == i.dataset or j.startswith(f'{i.dataset}/')]
+
+        # Check everything first, the operation is atomic.
+        for i in snapshots:
+            fake_dataset = self._get_dataset(i.dataset, 'snapshot', i)
+
+            if _find(fake_dataset.snapshots, i.name) is not None:
+                _fail('snapshot', i)
+
+        createtxg = next(self._txgs)
+
+        for i in snapshots:
+            self.datasets[i.dataset].snapshots.append(
+                _FakeSnapshot(i.name, next(self._guids), createtxg))
+            self.written.pop(i.dataset, None)
+            self.modified.discard(i.dataset)
+
+    def create_bookmarks(self, bookmarks: dict[Bookmark, Snapshot]) -> None:
+        self.calls.append('create_bookmarks')
+
+        for bookmark, snapshot in bookmarks.items():
+            fake_snapshot = self._get_snapshot(snapshot, 'bookmark', snapshot)
+            fake_dataset = self.datasets[bookmark.dataset]
+
+            if _find(fake_dataset.bookmarks, bookmark.name) is not None:
+                _fail('bookmark', snapshot, bookmark)
+
+            fake_dataset.bookmarks.append(_FakeSnapshot(
+                bookmark.name, fake_snapshot.guid, fake_snapshot.createtxg))
+
+    def destroy_snapshots(
+            self, snapshots: list[Snapshot | SnapshotRange],
+            recursive_snapshots: list[Snapshot]) \
+            -> None:
+        self.calls.append('destroy_snapshots')
+
+        for i in recursive_snapshots:
+            self._get_snapshot(i, 'destroy', '-r', i)
+
+            for j in sorted(self.datasets):
+                if j == i.dataset or j.startswith(f'{i.dataset}/'):
+                    fake_snapshot = _find(self.datasets[j].snapshots, i.name)
+
+                    if fake_snapshot is not None:
+                        self.datasets[j].snapshots.remove(fake_snapshot)
+
+        for snapshot in snapshots:
+            if isinstance(snapshot, SnapshotRange):
+                self._destroy_range(snapshot)
+            else:
+                self.datasets[snapshot.dataset].snapshots.remove(
+                    self._get_snapshot(snapshot, 'destroy', snapshot))
+
+    def _destroy_range(self, snapshot_range: SnapshotRange) -> None:
+        # Like `zfs destroy`, destroy everything between the first and last
+        # snapshot, regardless of the names in between.
+        fake_snapshots = self._get_dataset(
+            snapshot_range.dataset, 'destroy', snapshot_range).snapshots
+        first, last = (
+            fake_snapshots.index(self._get_snapshot(
+                Snapshot(snapshot_range.dataset, i), 'destroy', snapshot_range))
+            for i in [snapshot_range.names[0], snapshot_range.names[-1]])
+
+        del fake_snapshots[first:last + 1]
+
+    def estimate_destroy_size(self, snapshots: list[Snapshot]) -> int:
+        self.calls.append('estimate_destroy_size')
+
+        for i in snapshots:
+            self._get_snapshot(i, 'destroy', '-nvp', i)
+
+        return sum(self.snapshot_sizes.get(i, 0) for i in snapshots)
+
+    def destroy_bookmarks(self, bookmarks: list[Bookmark]) -> None:
+        self.calls.append('destroy_bookmarks')
+
+        for i in bookmarks:
+            fake_dataset = self._get_dataset(i.dataset, 'destroy', i)
+            fake_bookmark = _find(fake_dataset.bookmarks, i.name)
+
+            if fake_bookmark is None:
+                _fail('destroy', i)
+
+            fake_dataset.bookmarks.remove(fake_bookmark)
+
+    def rename_dataset(self, dataset: Dataset, new_name: Dataset) -> None:
+        self.calls.append('rename_dataset')
+        self._get_dataset(dataset, 'rename', dataset, new_name)
+
+        if new_name in self.datasets:
+            _fail('rename', dataset, new_name)
+
+        for i in list(self.datasets):
+            if i == dataset or i.startswith(f'{dataset}/'):
+                renamed = Dataset(new_name + i.removeprefix(dataset))
+                self.datasets[renamed] = self.datasets.pop(i)
+
+    def rollback_snapshot(self, snapshot: Snapshot) -> None:
+        self.calls.append('rollback_snapshot')
+        fake_snapshot = self._get_snapshot(snapshot, 'rollback', snapshot)
+
+        if self.datasets[snapshot.dataset].snapshots[-1] is not fake_snapshot:
+            _fail('rollback', snapshot)
+
+        self.modified.discard(snapshot.dataset)
+
+    def set_user_property(
+            self, snapshot: Snapshot, property: str, value: str) \
+            -> None:
+        self.calls.append('set_user_property')
+        self._get_snapshot(snapshot, 'set', f'{property}={value}', snapshot)
+        self.user_properties[snapshot, property] = value
+
+    def _get_base_guid(
+            self, incremental_base: Bookmark | Snapshot | None,
+            *cmdline: object) \
+            -> int | None:
+        if incremental_base is None:
+            return None
+
+        source_dataset = self._get_dataset(incremental_base.dataset, *cmdline)
+
+        if isinstance(incremental_base, Snapshot):
+            base = _find(source_dataset.snapshots, incremental_base.name)
+        else:
+            base = _find(source_dataset.bookmarks, incremental_base.name)
+
+        if base is None:
+            _fail(*cmdline)
+
+        return base.guid
+
+    def _receive_snapshot(
+            self, target: Snapshot, guid: int, base_guid: int | None,
+            force: bool, *cmdline: object) \
+            -> None:
+        target_dataset = self.datasets.get(target.dataset)
+
+        if base_guid is None:
+            # A full stream can only be received into a dataset without
+            # snapshots.
+            if target_dataset is not None and target_dataset.snapshots:
+                _fail(*cmdline)
+
+            parent, _, _ = target.dataset.rpartition('/')
+
+            if parent and parent not in self.datasets:
+                _fail(*cmdline)
+
+            target_dataset = self.datasets[target.dataset] = _FakeDataset()
+        else:
+            if target_dataset is None:
+                _fail(*cmdline)
+
+            target_base_indices = [
+                i for i, x in enumerate(target_dataset.snapshots)
+                if x.guid == base_guid]
+
+            if not target_base_indices:
+                _fail(*cmdline)
+
+            # With -F, changes and snapshots after the incremental base are
+            # destroyed. Without it, there must not be any.
+            if not force and (
+                    target.dataset in self.modified
+                    or target_base_indices[0] + 1
+                    < len(target_dataset.snapshots)):
+                _fail(*cmdline)
+
+            del target_dataset.snapshots[target_base_indices[0] + 1:]
+            self.modified.discard(target.dataset)
+
+        target_dataset.snapshots.append(
+            _FakeSnapshot(target.name, guid, next(self._txgs)))
+
+    def send_receive_snapshot(
+            self, incremental_base: Bookmark | Snapshot | None,
+            source: Snapshot, target: Snapshot, *, checksum: bool,
+            intermediates: bool, rate_limit: int | None, force: bool) \
+            -> StreamChecksum | None:
+        self.calls.append('send_receive_snapshot')
+        self.send_rate_limits.append(rate_limit)
+        force_args = ['-F'] if force else []
+        cmdline = ['send', source, '|', 'zfs', 'receive', *force_args, target]
+        source_snapshot = self._get_snapshot(source, *cmdline)
+        base_guid = self._get_base_guid(incremental_base, *cmdline)
+
+        if intermediates:
+            if not isinstance(incremental_base, Snapshot):
+                _fail(*cmdline)
+
+            source_snapshots = self.datasets[source.dataset].snapshots
+            start = source_snapshots.index(
+                self._get_snapshot(incremental_base, *cmdline)) + 1
+            sent_snapshots = source_snapshots[
+                start:source_snapshots.index(source_snapshot) + 1]
+        else:
+            sent_snapshots = [source_snapshot]
+
+        for i in sent_snapshots:
+            self._receive_snapshot(
+                Snapshot(target.dataset, i.name), i.guid, base_guid, force,
+                *cmdline)
+
+            # The target is only checked before receiving the first one.
+            base_guid = i.guid
+            force = True
+
+        return _fake_checksum(checksum, sent_snapshots)
+
+    def send_receive_snapshot_fan_out(
+            self, incremental_base: Bookmark | Snapshot | None,
+            source: Snapshot, targets: list[Snapshot], *, checksum: bool,
+            rate_limit: int | None, force: list[bool]) \
+            -> tuple[StreamChecksum | None, dict[Snapshot, CalledProcessError]]:
+        self.calls.append('send_receive_snapshot_fan_out')
+        self.send_rate_limits.append(rate_limit)
+        source_snapshot = self._get_snapshot(source, 'send', source)
+        base_guid = self._get_base_guid(incremental_base, 'send', source)
+        errors = {}
+
+        for i, j in zip(targets, force):
+            try:
+                self._receive_snapshot(
+                    i, source_snapshot.guid, base_guid, j, 'receive', i)
+            except CalledProcessError as e:
+                errors[i] = e
+
+        return _fake_checksum(checksum, [source_snapshot]), errors
+
+    def send_receive_replication(
+            self, incremental_base: Snapshot | None, source: Snapshot,
+            target: Dataset, *, checksum: bool, rate_limit: int | None) \
+            -> StreamChecksum | None:
+        self.calls.append('send_receive_replication')
+        self.send_rate_limits.append(rate_limit)
+        cmdline = ['send', '-R', source, '|', 'zfs', 'receive', target]
+        self._get_snapshot(source, *cmdline)
+
+        sent_snapshots = []
+
+        # Parents are handled before their children.
+        for i in sorted(self.datasets):
+            if i != source.dataset and not i.startswith(f'{source.dataset}/'):
+                continue
+
+            source_snapshots = self.datasets[i].snapshots
+            source_snapshot = _find(source_snapshots, source.name)
+
+            # Descendants without the snapshot are not included in the stream.
+            if source_snapshot is None:
+                continue
+
+            end = source_snapshots.index(source_snapshot) + 1
+            target_dataset_name = \
+                Dataset(target + i.removeprefix(source.dataset))
+            target_dataset = self.datasets.get(target_dataset_name)
+
+            if target_dataset is None:
+                # Datasets that don't exist on the target yet are sent in full,
+                # even in an incremental stream.
+                parent, _, _ = target_dataset_name.rpartition('/')
+
+                if parent and parent not in self.datasets:
+                    _fail(*cmdline)
+
+                start = 0
+                target_dataset = self.datasets[target_dataset_name] = \
+                    _FakeDataset()
+            else:
+                if incremental_base is None:
+                    _fail(*cmdline)
+
+                base = _find(source_snapshots, incremental_base.name)
+
+                # Without -F, the base needs to be the most recent snapshot of
+                # the target, which must not have been changed since.
+                if base is None or not target_dataset.snapshots \
+                        or target_dataset.snapshots[-1].guid != base.guid \
+                        or target_dataset_name in self.modified:
+                    _fail(*cmdline)
+
+                start = source_snapshots.index(base) + 1
+
+            for j in source_snapshots[start:end]:
+                target_dataset.snapshots.append(
+                    _FakeSnapshot(j.name, j.guid, next(self._txgs)))
+
+            sent_snapshots.extend(source_snapshots[start:end])
+
+        return _fake_checksum(checksum, sent_snapshots)
+
+    @contextmanager
+    def send_stream(
+            self, incremental_base: Bookmark | Snapshot | None,
+            source: Snapshot) \
+            -> Iterator[IO[bytes]]:
+        self.calls.append('send_stream')
+        source_snapshot = self._get_snapshot(source, 'send', source)
+        base_guid = self._get_base_guid(incremental_base, 'send', source)
+
+        # The stream only describes the snapshot, which is enough to receive
+        # it again.
+        yield io.BytesIO(json.dumps(
+            {'guid': source_snapshot.guid, 'base_guid': base_guid}).encode())
+
+    @contextmanager
+    def receive_stream(self, target: Snapshot) -> Iterator[IO[bytes]]:
+        self.calls.append('receive_stream')
+        stream = io.BytesIO()
+        cmdline = ['receive', '-F', target]
+
+        try:
+            yield stream
+        except BaseException:
+            # Like `zfs receive`, the snapshot is received as soon as the
+            # whole stream has been written, even if the writer fails
+            # afterwards.
+            with suppress(ValueError, KeyError, CalledProcessError):
+                data = json.loads(stream.getvalue())
+                self._receive_snapshot(
+                    target, data['guid'], data['base_guid'], True, *cmdline)
+
+            raise
+
+        try:
+            data = json.loads(stream.getvalue())
+        except ValueError:
+            _fail(*cmdline)
+
+        self._receive_snapshot(
+            target, data['guid'], data['base_guid'], True, *cmdline)
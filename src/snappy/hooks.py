@@ -0,0 +1,99 @@
+"""
+Commands that quiesce applications while their datasets are snapshotted. All
+freeze commands are run concurrently immediately before the snapshots are
+created and the thaw commands immediately afterwards, to keep the time during
+which the applications are stalled as short as possible.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import signal
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from subprocess import CalledProcessError, TimeoutExpired
+from typing import Iterator, Sequence
+
+from snappy.config import SnapshotHook
+from snappy.utils import UserError
+
+
+def _run_hook_command(command: str, timeout: float) -> None:
+    # The command runs in its own session, so that the processes started by
+    # the shell are killed together with it when it times out.
+    with subprocess.Popen(
+            command, shell=True, start_new_session=True) as process:
+        try:
+            returncode = process.wait(timeout)
+        except TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            raise
+
+    if returncode:
+        raise CalledProcessError(returncode, command)
+
+
+def _run_hook_commands(
+        action: str, commands: Sequence[tuple[SnapshotHook, str]]) \
+        -> None:
+    """
+    Run the commands concurrently and raise UserError if any of them failed,
+    after all of them have finished.
+    """
+    if not commands:
+        return
+
+    with ThreadPoolExecutor(max_workers=len(commands)) as executor:
+        futures = [
+            executor.submit(_run_hook_command, command, hook.timeout)
+            for hook, command in commands]
+
+    failed_hooks = []
+
+    for (hook, _), future in zip(commands, futures):
+        try:
+            future.result()
+        except CalledProcessError as e:
+            logging.error(
+                f'{action.capitalize()} hook of {hook.dataset} failed with '
+                f'exit code {e.returncode}.')
+            failed_hooks.append(hook)
+        except TimeoutExpired:
+            logging.error(
+                f'{action.capitalize()} hook of {hook.dataset} timed out after '
+                f'{hook.timeout:g} seconds.')
+            failed_hooks.append(hook)
+
+    if failed_hooks:
+        raise UserError(
+            f'{len(failed_hooks)} {action} hook(s) failed, see above.')
+
+
+@contextmanager
+def freeze_datasets(hooks: Sequence[SnapshotHook]) -> Iterator[None]:
+    """
+    Run the freeze commands of the hooks, then the thaw commands when the
+    context is left. The thaw commands are run even if freezing failed, as
+    some of the freeze commands may have succeeded.
+    """
+    if not hooks:
+        yield
+        return
+
+    start_time = time.monotonic()
+
+    try:
+        _run_hook_commands('freeze', [(i, i.freeze) for i in hooks])
+
+        yield
+    finally:
+        try:
+            _run_hook_commands(
+                'thaw', [(i, i.thaw) for i in hooks if i.thaw is not None])
+        finally:
+            logging.info(
+                f'Datasets were frozen for '
+                f'{time.monotonic() - start_time:.3f} seconds.')
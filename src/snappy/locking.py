@@ -0,0 +1,107 @@
+"""
+Locks that prevent concurrent runs from operating on the same datasets.
+
+A lock file is used for every dataset. A run takes an exclusive lock on each
+dataset it modifies, which covers the dataset's whole subtree, and a shared
+lock on each of their ancestors. Thus, two runs can't modify overlapping
+subtrees at the same time, but runs on unrelated datasets proceed in parallel.
+"""
+
+from __future__ import annotations
+
+import fcntl
+import logging
+import time
+from contextlib import contextmanager, ExitStack
+from pathlib import Path
+from typing import Iterable, Iterator, IO
+from urllib.parse import quote
+
+from snappy.utils import UserError
+from snappy.zfs import Dataset, iter_parents
+
+
+lock_dir = Path('/run/snappy')
+
+# Interval at which acquiring a lock is retried when using a timeout.
+_poll_interval = 0.1
+
+
+class LockTimeoutError(UserError):
+    pass
+
+
+def _get_lock_path(dataset: Dataset) -> Path:
+    return lock_dir / f'{quote(dataset, safe="")}.lock'
+
+
+def _lock_file(
+        file: IO[str], dataset: Dataset, exclusive: bool,
+        deadline: float | None) \
+        -> None:
+    operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+
+    try:
+        fcntl.flock(file, operation | fcntl.LOCK_NB)
+        return
+    except BlockingIOError:
+        pass
+
+    logging.info(f'Waiting for another run to release the lock on {dataset}.')
+
+    if deadline is None:
+        fcntl.flock(file, operation)
+        return
+
+    while True:
+        remaining_time = deadline - time.monotonic()
+
+        if remaining_time <= 0:
+            raise LockTimeoutError(
+                f'Timed out waiting for the lock on `{dataset}\'.')
+
+        time.sleep(min(_poll_interval, remaining_time))
+
+        try:
+            fcntl.flock(file, operation | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            pass
+
+
+@contextmanager
+def lock_datasets(
+        exclusive: Iterable[Dataset], shared: Iterable[Dataset],
+        timeout: float | None) \
+        -> Iterator[None]:
+    """
+    Hold an exclusive lock on the subtrees of the datasets in `exclusive` and
+    a shared lock on the subtrees of the datasets in `shared`. Raise
+    LockTimeoutError if not all locks could be acquired within `timeout`
+    seconds. Wait indefinitely if `timeout` is None.
+    """
+    modes = dict.fromkeys(exclusive, True)
+
+    for i in shared:
+        modes.setdefault(i, False)
+
+    for i in list(modes):
+        for j in list(iter_parents(i))[1:]:
+            modes.setdefault(j, False)
+
+    try:
+        lock_dir.mkdir(parents=True, exist_ok=True)
+    except OSError as e:
+        raise UserError(
+            f'Could not create lock directory `{lock_dir}\': {e.strerror}')
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    with ExitStack() as stack:
+        # Locks are always acquired in the same order, parents before their
+        # children, so that concurrent runs can't deadlock.
+        for dataset, is_exclusive in sorted(modes.items()):
+            file = stack.enter_context(open(_get_lock_path(dataset), 'a'))
+            _lock_file(file, dataset, is_exclusive, deadline)
+
+        yield
@@ -0,0 +1,116 @@
+"""
+Implementation of ZfsBackend on top of libzfs_core, using the pyzfs bindings.
+Operations are performed in-process using ioctls, without starting a `zfs`
+process for each of them.
+"""
+
+from __future__ import annotations
+
+from contextlib import contextmanager
+from subprocess import CalledProcessError
+from typing import Iterator, Sequence
+
+from snappy.utils import UserError
+from snappy.zfs import CliBackend, Dataset, Snapshot, Bookmark, \
+    SnapshotRange, get_pool_name, SnapshotOrBookmarkT
+
+try:
+    import libzfs_core
+except ImportError:
+    libzfs_core = None
+
+
+@contextmanager
+def _translate_errors(operation: str, *args: object) -> Iterator[None]:
+    """
+    Report errors raised by libzfs_core in the same way as errors from the
+    `zfs` command, so that they are handled the same way by the caller.
+    """
+    try:
+        yield
+    except libzfs_core.exceptions.ZFSError as e:
+        raise CalledProcessError(e.errno, [operation, *map(str, args)]) from e
+    except NotImplementedError as e:
+        # pyzfs declares some functions which are missing from the
+        # libzfs_core of the installed ZFS version.
+        raise UserError(
+            f'The lzc backend requires {operation}(), which is not supported '
+            f'by the installed version of libzfs_core.') from e
+
+
+def _encode(value: object) -> bytes:
+    return str(value).encode()
+
+
+def _group_by_pool(refs: Sequence[SnapshotOrBookmarkT]) \
+        -> dict[Dataset, list[SnapshotOrBookmarkT]]:
+    res: dict[Dataset, list[SnapshotOrBookmarkT]] = {}
+
+    for i in refs:
+        res.setdefault(get_pool_name(i.dataset), []).append(i)
+
+    return res
+
+
+class LzcBackend(CliBackend):
+    """
+    Operations which change the set of snapshots and bookmarks are batched
+    into a single ioctl per pool, which is also atomic.
+
+    Listing datasets, snapshots and bookmarks, renaming datasets and sending
+    and receiving snapshots is still done using the `zfs` command. The
+    functions to list datasets and snapshots and to read their properties are
+    not available in released versions of libzfs_core, and `zfs list` reads
+    the properties of all snapshots in a single process. libzfs_core doesn't
+    handle unmounting and remounting filesystems when renaming them and can't
+    include properties in a send stream.
+    """
+
+    def __init__(self) -> None:
+        if libzfs_core is None:
+            raise UserError(
+                'The lzc backend requires the Python bindings for '
+                'libzfs_core (pyzfs), which are not installed.')
+
+    def _create_pool_snapshots(
+            self, snapshots: list[Snapshot],
+            recursive_snapshots: list[Snapshot]) \
+            -> None:
+        # lzc_snapshot() can't create recursive snapshots, but passing all
+        # descendants explicitly doesn't suffer from limits on the length of
+        # the command line.
+        snapshots = snapshots + [
+            Snapshot(j, i.name) for i in recursive_snapshots
+            for j in self.iter_children(i.dataset, quiet=False)]
+
+        with _translate_errors('lzc_snapshot', *snapshots):
+            libzfs_core.lzc_snapshot([_encode(i) for i in snapshots])
+
+    def create_bookmarks(self, bookmarks: dict[Bookmark, Snapshot]) -> None:
+        for pool_bookmarks in _group_by_pool(list(bookmarks)).values():
+            with _translate_errors('lzc_bookmark', *pool_bookmarks):
+                libzfs_core.lzc_bookmark(
+                    {_encode(i): _encode(bookmarks[i]) for i in pool_bookmarks})
+
+    def destroy_snapshots(
+            self, snapshots: list[Snapshot | SnapshotRange],
+            recursive_snapshots: list[Snapshot]) \
+            -> None:
+        # lzc_destroy_snaps() ignores snapshots which don't exist, so we can
+        # pass the snapshot name for all descendants.
+        expanded_snapshots = [
+            *(j for i in snapshots
+              for j in (i.snapshots if isinstance(i, SnapshotRange) else [i])),
+            *(Snapshot(j, i.name) for i in recursive_snapshots
+              for j in self.iter_children(i.dataset, quiet=False))]
+
+        for pool_snapshots in _group_by_pool(expanded_snapshots).values():
+            with _translate_errors('lzc_destroy_snaps', *pool_snapshots):
+                libzfs_core.lzc_destroy_snaps(
+                    [_encode(i) for i in pool_snapshots], False)
+
+    def destroy_bookmarks(self, bookmarks: list[Bookmark]) -> None:
+        for pool_bookmarks in _group_by_pool(bookmarks).values():
+            with _translate_errors('lzc_destroy_bookmarks', *pool_bookmarks):
+                libzfs_core.lzc_destroy_bookmarks(
+                    [_encode(i) for i in pool_bookmarks])
@@ -0,0 +1,572 @@
+"""
+Description of the changes a run makes, which is computed before any of them
+are made. This allows showing what a run would do without doing it, and
+executing the changes without having to inspect the datasets again.
+"""
+
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass, field, replace
+from enum import Enum
+from typing import Any, Container, Iterator, TypeVar
+
+from snappy.utils import format_size
+from snappy.zfs import Dataset, Snapshot, Bookmark, SnapshotRange, \
+    iter_parents
+
+
+_T = TypeVar('_T', Snapshot, Bookmark)
+
+
+def _rename(items: list[_T], old_name: str, new_name: str) -> list[_T]:
+    return [
+        replace(i, name=new_name) if i.name == old_name else i for i in items]
+
+
+class PlanFormat(Enum):
+    table = 'table'
+    json = 'json'
+
+
+@dataclass
+class SendStep:
+    """
+    Sending the snapshots of a single dataset to its target.
+    """
+    source: Dataset
+    target: Dataset
+
+    # Bookmark of the most recent snapshot on the target, if any. The snapshot
+    # itself, if it was sent using a replication stream.
+    incremental_base: Bookmark | Snapshot | None
+
+    # Whether the target exists but is unrelated to the source and needs to be
+    # renamed before sending.
+    move_target_away: bool
+
+    # Bookmarks left over from an aborted run.
+    stale_bookmarks: list[Bookmark]
+
+    # The snapshots to send, oldest first. May include snapshots which are
+    # only created by the same plan.
+    snapshots_to_send: list[Snapshot]
+
+    # Snapshots on the source to destroy after sending, including snapshots
+    # which have been sent by an aborted run.
+    snapshots_to_destroy: list[Snapshot]
+
+    # Estimated size of the sent streams in bytes, if it has been estimated.
+    estimated_size: int | None = None
+
+    # Whether `target` is the directory of an archive the streams are written
+    # to instead of a dataset.
+    archive: bool = False
+
+    # Whether all snapshots after the first are sent in a single stream
+    # including the intermediate snapshots, instead of one stream each.
+    intermediates: bool = False
+
+    # Bookmarks with the prefix, existing or created by this step, which are
+    # kept according to the bookmark keep specifications.
+    kept_bookmarks: list[Bookmark] = field(default_factory=list)
+
+    # Whether the snapshot of `incremental_base` has only been looked up on
+    # the target, which may still have more recent snapshots.
+    base_probed: bool = False
+
+    # Bookmarks of `snapshots_to_send` which already exist, e.g. because they
+    # have been kept after an aborted run, and aren't created again.
+    existing_bookmarks: list[Bookmark] = field(default_factory=list)
+
+    @property
+    def streams(self) \
+            -> list[tuple[Bookmark | Snapshot | None, Snapshot, bool]]:
+        """
+        The incremental base and the snapshot of each stream, in the order in
+        which they are sent, and whether the stream includes the intermediate
+        snapshots.
+        """
+        if self.intermediates and len(self.snapshots_to_send) > 2:
+            first, *_, last = self.snapshots_to_send
+
+            # A stream with intermediate snapshots can't start at a bookmark.
+            return [(self.incremental_base, first, False),
+                    (first, last, True)]
+
+        bases: list[Bookmark | Snapshot | None] = [
+            self.incremental_base,
+            *(Bookmark(self.source, i.name)
+              for i in self.snapshots_to_send[:-1])]
+
+        return [(i, j, False) for i, j in zip(bases, self.snapshots_to_send)]
+
+    @property
+    def new_bookmarks(self) -> list[Bookmark]:
+        """
+        The bookmarks created for the sent snapshots, except for those which
+        already exist.
+        """
+        existing_bookmarks = set(self.existing_bookmarks)
+
+        return [
+            Bookmark(self.source, i.name) for i in self.snapshots_to_send
+            if Bookmark(self.source, i.name) not in existing_bookmarks]
+
+    @property
+    def superseded_bookmarks(self) -> list[Bookmark]:
+        """
+        The bookmarks that are destroyed once the snapshots have been sent,
+        because a more recent bookmark exists.
+        """
+        if not self.snapshots_to_send:
+            return []
+
+        bookmarks = [
+            Bookmark(self.source, i.name) for i in self.snapshots_to_send[:-1]]
+
+        if isinstance(self.incremental_base, Bookmark):
+            bookmarks.insert(0, self.incremental_base)
+
+        kept_bookmarks = set(self.kept_bookmarks)
+
+        return [i for i in bookmarks if i not in kept_bookmarks]
+
+
+@dataclass
+class FanOutStep:
+    """
+    Sending the snapshots of a single dataset to several targets. The
+    snapshots that several targets need from the same incremental base are
+    sent using a single stream.
+    """
+    source: Dataset
+
+    # A step for each target. The bookmarks and snapshots of the source are
+    # cleaned up once for all targets, so `stale_bookmarks` and
+    # `snapshots_to_destroy` of these steps are empty.
+    sends: list[SendStep]
+
+    # Bookmarks with the prefix which are not the incremental base of any
+    # target.
+    stale_bookmarks: list[Bookmark]
+
+    # Snapshots on the source to destroy after sending to all targets.
+    snapshots_to_destroy: list[Snapshot]
+
+    @property
+    def snapshots_to_send(self) -> list[Snapshot]:
+        """
+        The snapshots sent to any of the targets, oldest first.
+        """
+        # The snapshots sent to each target are the most recent ones.
+        return max((i.snapshots_to_send for i in self.sends), key=len)
+
+    @property
+    def new_bookmarks(self) -> list[Bookmark]:
+        """
+        The bookmarks created for the sent snapshots, except for those which
+        already exist as the incremental base of one of the targets or are
+        kept for one of them.
+        """
+        existing_bookmarks = {
+            *(i.incremental_base for i in self.sends),
+            *(j for i in self.sends for j in i.existing_bookmarks)}
+
+        return [
+            Bookmark(self.source, i.name) for i in self.snapshots_to_send
+            if Bookmark(self.source, i.name) not in existing_bookmarks]
+
+    @property
+    def superseded_bookmarks(self) -> list[Bookmark]:
+        kept_bookmarks = {j for i in self.sends for j in i.kept_bookmarks}
+
+        return list(dict.fromkeys(
+            j for i in self.sends for j in i.superseded_bookmarks
+            if j not in kept_bookmarks))
+
+    def iter_streams(self, failed_targets: Container[Dataset] = ()) \
+            -> Iterator[tuple[Bookmark | Snapshot | None, Snapshot,
+                              list[Dataset]]]:
+        """
+        Yield the incremental base, the snapshot and the targets of each
+        stream, in the order in which they are sent. Targets added to
+        `failed_targets` while iterating are skipped from the next snapshot
+        on.
+        """
+        incremental_bases = {i.target: i.incremental_base for i in self.sends}
+
+        for snapshot in self.snapshots_to_send:
+            targets_by_base: \
+                dict[Bookmark | Snapshot | None, list[Dataset]] = {}
+
+            for i in self.sends:
+                if snapshot in i.snapshots_to_send \
+                        and i.target not in failed_targets:
+                    targets_by_base.setdefault(
+                        incremental_bases[i.target], []).append(i.target)
+
+            for base, targets in targets_by_base.items():
+                yield base, snapshot, targets
+
+                for target in targets:
+                    incremental_bases[target] = \
+                        Bookmark(self.source, snapshot.name)
+
+
+@dataclass
+class ReplicationStep:
+    """
+    Sending the snapshots of all datasets of a subtree to its target using a
+    single replication stream.
+    """
+    source: Dataset
+    target: Dataset
+
+    # All datasets of the subtree, including `source`.
+    datasets: list[Dataset]
+
+    # Name of the most recent snapshot that exists on all datasets and their
+    # targets, if any.
+    incremental_base: str | None
+
+    # Names of the snapshots with the prefix to send, oldest first. The stream
+    # includes all snapshots between them.
+    snapshots_to_send: list[str]
+
+    # Snapshots with the prefix destroyed after sending. The most recently
+    # sent snapshot is kept as the basis of the next replication stream.
+    snapshots_to_destroy: list[Snapshot]
+
+    estimated_size: int | None = None
+
+    @property
+    def targets(self) -> list[Dataset]:
+        """
+        The target of each dataset of the subtree.
+        """
+        return [
+            Dataset(self.target + i.removeprefix(self.source))
+            for i in self.datasets]
+
+    @property
+    def recursive_snapshots_to_destroy(self) -> list[Snapshot]:
+        """
+        The snapshots of `source` which are destroyed recursively to destroy
+        `snapshots_to_destroy`.
+        """
+        return [
+            i for i in self.snapshots_to_destroy if i.dataset == self.source]
+
+
+@dataclass
+class Plan:
+    # Snapshots to create, in a single operation.
+    snapshots: list[Snapshot] = field(default_factory=list)
+
+    # Those of `snapshots` of which all descendants are also in `snapshots` and
+    # which are created using a recursive snapshot.
+    recursive_snapshots: list[Snapshot] = field(default_factory=list)
+    sends: list[SendStep] = field(default_factory=list)
+    fan_outs: list[FanOutStep] = field(default_factory=list)
+    replications: list[ReplicationStep] = field(default_factory=list)
+
+    # Snapshots to destroy according to the keep specifications.
+    expired_snapshots: list[Snapshot] = field(default_factory=list)
+
+    # Runs of expired snapshots which are destroyed using a range.
+    expired_ranges: list[SnapshotRange] = field(default_factory=list)
+
+    # Expired snapshots which are destroyed together with the snapshots of the
+    # same name on all descendants, all of which are expired too.
+    recursive_expired_snapshots: list[Snapshot] = \
+        field(default_factory=list)
+
+    # Whether the checksums of the sent streams are computed and recorded on
+    # the received snapshots.
+    checksum_streams: bool = False
+
+    # Datasets which are not sent from or to, or not pruned, because their
+    # pool is being scrubbed or resilvered.
+    deferred_datasets: list[Dataset] = field(default_factory=list)
+
+    # Pools to and from which snapshots are sent at a limited rate and on
+    # which expired snapshots are destroyed one dataset at a time, because
+    # they are being scrubbed or resilvered.
+    throttled_pools: list[Dataset] = field(default_factory=list)
+
+    @property
+    def remaining_snapshots(self) -> list[Snapshot]:
+        """
+        The snapshots which are not created by one of the recursive snapshots.
+        """
+        recursive_datasets = {i.dataset for i in self.recursive_snapshots}
+
+        return [
+            i for i in self.snapshots
+            if not any(j in recursive_datasets for j in iter_parents(i.dataset))]
+
+    @property
+    def remaining_expired_snapshots(self) -> list[Snapshot]:
+        """
+        The expired snapshots which are not destroyed by one of the ranges or
+        recursive snapshots.
+        """
+        ranges_snapshots = {j for i in self.expired_ranges for j in i.snapshots}
+        recursive_snapshots = set(self.recursive_expired_snapshots)
+
+        return [
+            i for i in self.expired_snapshots
+            if i not in ranges_snapshots
+            and not any(
+                Snapshot(j, i.name) in recursive_snapshots
+                for j in iter_parents(i.dataset))]
+
+    @property
+    def all_sends(self) -> list[SendStep]:
+        """
+        The steps sending to a single target, including those of the
+        fan-outs.
+        """
+        return [*self.sends, *(j for i in self.fan_outs for j in i.sends)]
+
+    @property
+    def estimated_size(self) -> int | None:
+        sizes = [
+            *(i.estimated_size for i in self.all_sends),
+            *(i.estimated_size for i in self.replications)]
+
+        if None in sizes:
+            return None
+
+        return sum(i for i in sizes if i is not None)
+
+    @property
+    def destroyed_snapshots(self) -> list[Snapshot]:
+        return [
+            *(j for i in self.sends for j in i.snapshots_to_destroy),
+            *(j for i in self.fan_outs for j in i.snapshots_to_destroy),
+            *(j for i in self.replications for j in i.snapshots_to_destroy),
+            *self.expired_snapshots]
+
+    @property
+    def destroyed_bookmarks(self) -> list[Bookmark]:
+        steps: list[SendStep | FanOutStep] = [*self.sends, *self.fan_outs]
+
+        return [
+            j for i in steps
+            for j in [*i.stale_bookmarks, *i.superseded_bookmarks]]
+
+    @property
+    def snapshot_names(self) -> set[str]:
+        """
+        The names of all snapshots and bookmarks the plan refers to.
+        """
+        steps: list[SendStep | FanOutStep] = [*self.sends, *self.fan_outs]
+
+        return {
+            *(i.name for i in self.snapshots),
+            *(j.name for i in self.all_sends for j in i.snapshots_to_send),
+            *(j.name for i in self.all_sends for j in i.kept_bookmarks),
+            *(i.incremental_base.name for i in self.all_sends
+              if i.incremental_base is not None),
+            *(j.name for i in steps for j in i.stale_bookmarks),
+            *(j for i in self.replications for j in i.snapshots_to_send),
+            *(i.incremental_base for i in self.replications
+              if i.incremental_base is not None),
+            *(i.name for i in self.destroyed_snapshots),
+            *(j for i in self.expired_ranges for j in i.names)}
+
+    def rename_snapshots(self, old_name: str, new_name: str) -> None:
+        """
+        Rename the snapshots to create, wherever the plan refers to them.
+        `new_name` must not be one of `snapshot_names`.
+        """
+        def rename_send(step: SendStep) -> None:
+            step.snapshots_to_send = \
+                _rename(step.snapshots_to_send, old_name, new_name)
+            step.snapshots_to_destroy = \
+                _rename(step.snapshots_to_destroy, old_name, new_name)
+            step.kept_bookmarks = \
+                _rename(step.kept_bookmarks, old_name, new_name)
+
+        self.snapshots = _rename(self.snapshots, old_name, new_name)
+        self.recursive_snapshots = \
+            _rename(self.recursive_snapshots, old_name, new_name)
+
+        for i in self.all_sends:
+            rename_send(i)
+
+        for k in self.fan_outs:
+            k.snapshots_to_destroy = \
+                _rename(k.snapshots_to_destroy, old_name, new_name)
+
+        for j in self.replications:
+            j.snapshots_to_send = [
+                new_name if i == old_name else i for i in j.snapshots_to_send]
+            j.snapshots_to_destroy = \
+                _rename(j.snapshots_to_destroy, old_name, new_name)
+
+        self.expired_snapshots = \
+            _rename(self.expired_snapshots, old_name, new_name)
+        self.expired_ranges = [
+            replace(i, names=tuple(
+                new_name if j == old_name else j for j in i.names))
+            for i in self.expired_ranges]
+        self.recursive_expired_snapshots = \
+            _rename(self.recursive_expired_snapshots, old_name, new_name)
+
+    def count_zfs_commands(self) -> int:
+        """
+        Return the number of `zfs` processes the cli backend starts when
+        executing the plan.
+        """
+        count = int(bool(self.recursive_snapshots)) \
+            + int(bool(self.remaining_snapshots))
+
+        for i in self.sends:
+            count += int(i.move_target_away)
+            count += len(i.stale_bookmarks)
+            count += len(i.new_bookmarks)
+
+            if i.archive:
+                # Listing the guids once and sending each stream.
+                count += 1 + len(i.streams)
+            else:
+                # Estimating the size, sending and receiving.
+                count += 3 * len(i.streams)
+
+                if self.checksum_streams:
+                    count += len(i.streams)
+
+            count += len(i.superseded_bookmarks)
+            count += int(bool(i.snapshots_to_destroy))
+
+        for k in self.fan_outs:
+            count += sum(int(i.move_target_away) for i in k.sends)
+            count += len(k.stale_bookmarks)
+            count += len(k.new_bookmarks)
+
+            # Estimating the size and sending once, and receiving on each
+            # target.
+            for _, _, targets in k.iter_streams():
+                count += 2 + len(targets)
+
+                if self.checksum_streams:
+                    count += len(targets)
+
+            count += len(k.superseded_bookmarks)
+            count += int(bool(k.snapshots_to_destroy))
+
+        for j in self.replications:
+            if j.snapshots_to_send:
+                count += 3 + int(self.checksum_streams)
+
+                # Rolling back the targets.
+                if j.incremental_base is not None:
+                    count += len(j.datasets)
+
+            count += int(bool(j.recursive_snapshots_to_destroy))
+
+        count += len({i.dataset for i in self.recursive_expired_snapshots})
+        count += len({i.dataset for i in self.remaining_expired_snapshots})
+        count += len(
+            {i.dataset for i in self.expired_ranges}
+            - {i.dataset for i in self.remaining_expired_snapshots})
+
+        return count
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            'create_snapshots': [str(i) for i in self.snapshots],
+            'sends': [
+                {
+                    'source': i.source,
+                    'target': i.target,
+                    'incremental_base':
+                        None if i.incremental_base is None
+                        else str(i.incremental_base),
+                    'move_target_away': i.move_target_away,
+                    'snapshots': [str(j) for j in i.snapshots_to_send],
+                    'estimated_size': i.estimated_size}
+                for i in self.all_sends],
+            'replications': [
+                {
+                    'source': i.source,
+                    'target': i.target,
+                    'datasets': i.datasets,
+                    'incremental_base': i.incremental_base,
+                    'snapshots': i.snapshots_to_send,
+                    'estimated_size': i.estimated_size}
+                for i in self.replications],
+            'destroy_snapshots': [str(i) for i in self.destroyed_snapshots],
+            'destroy_bookmarks': [str(i) for i in self.destroyed_bookmarks],
+            'estimated_size': self.estimated_size,
+            'deferred_datasets': self.deferred_datasets,
+            'zfs_commands': self.count_zfs_commands()}
+
+    def format_table(self) -> str:
+        lines = []
+
+        def about(size: int | None) -> str:
+            if size is None:
+                return ''
+
+            return f', about {format_size(size)}'
+
+        lines.append(f'Snapshots to create: {len(self.snapshots)}')
+        lines.extend(f'  {i}' for i in self.snapshots)
+
+        sends = [i for i in self.all_sends if i.snapshots_to_send]
+        replications = [i for i in self.replications if i.snapshots_to_send]
+        sent_datasets_count = \
+            len(sends) + sum(len(i.datasets) for i in replications)
+
+        lines.append(
+            f'Datasets to send: {sent_datasets_count}'
+            f'{about(self.estimated_size)}')
+
+        for j in replications:
+            lines.append(
+                f'  {j.source} -> {j.target}: {len(j.snapshots_to_send)} '
+                f'snapshots of {len(j.datasets)} datasets in a replication '
+                f'stream{about(j.estimated_size)}')
+
+        for i in sends:
+            lines.append(
+                f'  {i.source} -> {i.target}: {len(i.snapshots_to_send)} '
+                f'snapshots{about(i.estimated_size)}')
+
+            if i.move_target_away:
+                lines.append(f'    (existing {i.target} is renamed)')
+
+        destroyed_snapshots = self.destroyed_snapshots
+        names_by_dataset: dict[Dataset, list[str]] = {}
+
+        for snapshot in destroyed_snapshots:
+            names_by_dataset.setdefault(snapshot.dataset, []).append(
+                snapshot.name)
+
+        lines.append(f'Snapshots to destroy: {len(destroyed_snapshots)}')
+        lines.extend(
+            f'  {dataset}@{",".join(names)}'
+            for dataset, names in names_by_dataset.items())
+
+        lines.append(f'Bookmarks to destroy: {len(self.destroyed_bookmarks)}')
+
+        if self.deferred_datasets:
+            lines.append(
+                f'Datasets deferred until scans finish: '
+                f'{len(self.deferred_datasets)}')
+            lines.extend(f'  {i}' for i in self.deferred_datasets)
+
+        lines.append(f'zfs commands: {self.count_zfs_commands()}')
+
+        return '\n'.join(lines)
+
+
+def format_plans(plans: list[Plan], format: PlanFormat) -> str:
+    if format == PlanFormat.json:
+        return json.dumps([i.to_json() for i in plans], indent=2)
+    else:
+        return '\n\n'.join(i.format_table() for i in plans)
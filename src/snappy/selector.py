@@ -0,0 +1,176 @@
+"""
+Selection of datasets using patterns of datasets to include and exclude.
+
+Patterns are matched component by component. A component of a pattern may be
+a glob pattern like `vm-*`, which matches a single component of a dataset
+name. If a pattern starts with `re:`, each of its components is a regular
+expression instead.
+"""
+
+from __future__ import annotations
+
+import fnmatch
+import re
+from typing import Iterator, Sequence
+
+from snappy.utils import UserError
+from snappy.zfs import Dataset, iter_parents
+
+
+_glob_chars_re = re.compile('[*?[]')
+_regex_chars_re = re.compile(r'[\\.^$*+?{}\[\]|()]')
+
+_regex_prefix = 're:'
+
+
+def _parse_pattern(pattern: str) -> list[str | re.Pattern[str]]:
+    """
+    Split a pattern into its components. Components which only match a
+    literal name are returned as strings.
+    """
+    if pattern.startswith(_regex_prefix):
+        components = pattern.removeprefix(_regex_prefix).split('/')
+        special_chars_re = _regex_chars_re
+    else:
+        components = pattern.split('/')
+        special_chars_re = _glob_chars_re
+
+    res: list[str | re.Pattern[str]] = []
+
+    for i in components:
+        if not i:
+            raise UserError(f'Invalid dataset pattern `{pattern}\'.')
+        elif not special_chars_re.search(i):
+            res.append(i)
+        elif special_chars_re is _glob_chars_re:
+            res.append(re.compile(fnmatch.translate(i)))
+        else:
+            try:
+                res.append(re.compile(i))
+            except re.error as e:
+                raise UserError(
+                    f'Invalid regular expression in dataset pattern '
+                    f'`{pattern}\': {e}')
+
+    return res
+
+
+def is_pattern(pattern: str) -> bool:
+    return any(not isinstance(i, str) for i in _parse_pattern(pattern))
+
+
+class _Node:
+    __slots__ = ('children', 'pattern_children', 'include', 'exclude')
+
+    def __init__(self) -> None:
+        self.children: dict[str, _Node] = {}
+        self.pattern_children: list[tuple[re.Pattern[str], _Node]] = []
+        self.include = False
+        self.exclude = False
+
+    def add(self, components: list[str | re.Pattern[str]]) -> _Node:
+        node = self
+
+        for i in components:
+            if isinstance(i, str):
+                node = node.children.setdefault(i, _Node())
+            else:
+                for pattern, child in node.pattern_children:
+                    if pattern == i:
+                        node = child
+                        break
+                else:
+                    child = _Node()
+                    node.pattern_children.append((i, child))
+                    node = child
+
+        return node
+
+    def iter_matching_children(self, component: str) -> Iterator[_Node]:
+        child = self.children.get(component)
+
+        if child is not None:
+            yield child
+
+        for pattern, child in self.pattern_children:
+            if pattern.fullmatch(component):
+                yield child
+
+
+class DatasetSelector:
+    """
+    Decides which datasets are selected by a list of patterns of datasets to
+    include and a list of patterns to exclude.
+
+    When matching recursively, a dataset is selected if the nearest of itself
+    and its ancestors that matches any pattern matches an include pattern. If
+    it matches both an include and an exclude pattern, it is excluded.
+    Otherwise, only datasets matching an include pattern are selected.
+    """
+
+    def __init__(
+            self, datasets: Sequence[str], exclude: Sequence[str],
+            recursive: bool) \
+            -> None:
+        self._root = _Node()
+        self._recursive = recursive
+        self._has_patterns = False
+
+        # Datasets to list to find all datasets that can possibly match.
+        roots: set[Dataset] = set()
+
+        for i in datasets:
+            components = _parse_pattern(i)
+            literal_prefix: list[str] = []
+
+            for j in components:
+                if not isinstance(j, str):
+                    self._has_patterns = True
+                    break
+
+                literal_prefix.append(j)
+
+            if not literal_prefix:
+                raise UserError(
+                    f'Dataset pattern `{i}\' must start with the name of a '
+                    f'pool.')
+
+            roots.add(Dataset('/'.join(literal_prefix)))
+            self._root.add(components).include = True
+
+        for i in exclude:
+            self._root.add(_parse_pattern(i)).exclude = True
+
+        # Only keep datasets which aren't children of other roots. Sorted, so
+        # that parents are listed before children.
+        self.roots = sorted(
+            i for i in roots
+            if not any(j in roots for j in list(iter_parents(i))[1:]))
+
+    @property
+    def has_patterns(self) -> bool:
+        """
+        Whether any of the datasets to include is specified using a pattern
+        and not by its name.
+        """
+        return self._has_patterns
+
+    def matches(self, dataset: Dataset) -> bool:
+        components = dataset.split('/')
+        nodes = [self._root]
+        selected = False
+
+        for depth, component in enumerate(components):
+            nodes = [
+                j for i in nodes for j in i.iter_matching_children(component)]
+
+            if not nodes:
+                break
+
+            if self._recursive or depth == len(components) - 1:
+                if any(i.exclude for i in nodes):
+                    selected = False
+                elif any(i.include for i in nodes):
+                    selected = True
+
+        return selected
@@ -2,14 +2,24 @@ from __future__ import annotations
 
 import logging
 from datetime import datetime
+from pathlib import Path
 from subprocess import CalledProcessError
-from typing import Iterable, TypeVar, Callable
 
-from snappy.snapshots import parse_snapshot_name
-from snappy.utils import timestamp_format
+from snappy.archive import archive_snapshot
+from snappy.config import KeepSpec, MostRecentKeepSpec
+from snappy.plan import SendStep, ReplicationStep, FanOutStep
+from snappy.snapshots import find_expired_snapshots
+from snappy.utils import timestamp_format, StreamChecksum, format_cmdline
 from snappy.zfs import send_receive_snapshot, Snapshot, Bookmark, \
-    list_snapshots, Dataset, list_snapshots_and_bookmarks, create_bookmark, \
-    destroy_bookmark, destroy_snapshots, rename_dataset
+    list_snapshots, list_snapshots_and_bookmarks, Dataset, create_bookmarks, \
+    destroy_bookmarks, destroy_snapshots, rename_dataset, rollback_snapshot, \
+    SnapshotTable, get_snapshot_info, send_receive_replication, \
+    set_user_property, send_receive_snapshot_fan_out
+
+
+# User property set on received snapshots to record the checksum and size of
+# the stream, in the form `<algorithm>:<checksum>:<bytes>`.
+stream_checksum_property = 'snappy:stream-checksum'
 
 
 class CannotMoveRootOfPoolException(Exception):
@@ -35,87 +45,556 @@ def _move_target_away(dataset: Dataset) -> None:
         f'to {new_base_name}.')
 
 
-T = TypeVar('T')
+def _probe_incremental_bookmark(
+        source_bookmarks: SnapshotTable[Bookmark], target: Dataset,
+        prefix: str,
+        target_inventory: dict[Dataset, SnapshotTable[Snapshot]] | None) \
+        -> int | None:
+    """
+    Return the index of the most recent bookmark with the specified prefix, if
+    a snapshot with the same name and guid exists on the target. If the target
+    has been listed, it also needs to be its most recent snapshot, so that
+    receiving with -F doesn't destroy any snapshots. Otherwise, the first
+    stream is received without -F to check this.
+    """
+    latest_index = None
 
+    for i in range(len(source_bookmarks)):
+        if source_bookmarks.has_prefix(i, prefix):
+            latest_index = i
 
-def _get_first(seq: Iterable[T], predicate: Callable[[T], bool]) -> T | None:
-    for i in seq:
-        if predicate(i):
-            return i
+    if latest_index is None:
+        return None
 
-    return None
+    name = source_bookmarks.names[latest_index]
 
+    if target_inventory is None:
+        info = get_snapshot_info(Snapshot(target, name))
+        guid = None if info is None else info.guid
+    else:
+        target_snapshots = target_inventory.get(target)
 
-def send_snapshots(source: Dataset, target: Dataset, prefix: str) -> None:
-    source_snapshots, source_bookmarks = list_snapshots_and_bookmarks(source)
+        if target_snapshots is None:
+            return None
 
-    try:
-        target_snapshots = list_snapshots(target, quiet=True)
-        target_exists = True
-    except CalledProcessError:
-        # We assume that if listing snapshots fails, that the target filesystem
-        # does not exist. It will be created later.
-        target_snapshots = []
-        target_exists = False
-
-    if target_snapshots:
-        # Target snapshot that will be the basis of the next incremental send.
-        most_recent_target_snapshot_guid = target_snapshots[-1].guid
-
-        # The bookmark on the source that corresponds to the most recent
-        # snapshot on the target.
-        incremental_bookmark_info = _get_first(
-            source_bookmarks,
-            lambda x: x.guid == most_recent_target_snapshot_guid)
-
-        if incremental_bookmark_info is None:
-            incremental_bookmark = None
-        else:
-            incremental_bookmark = incremental_bookmark_info.ref
+        # Planned snapshots don't have a guid yet and are received after the
+        # base.
+        index = next(
+            (i for i in reversed(range(len(target_snapshots)))
+             if target_snapshots.guids[i]), None)
+
+        if index is None or target_snapshots.names[index] != name:
+            return None
+
+        guid = target_snapshots.guids[index]
+
+    if guid != source_bookmarks.guids[latest_index]:
+        return None
+
+    return latest_index
+
+
+def _find_incremental_base(
+        source_snapshots: SnapshotTable[Snapshot],
+        source_bookmarks: SnapshotTable[Bookmark], target: Dataset,
+        prefix: str,
+        target_inventory: dict[Dataset, SnapshotTable[Snapshot]] | None) \
+        -> tuple[Bookmark | Snapshot | None, int, bool, bool]:
+    """
+    Find the bookmark or snapshot on the source corresponding to the most
+    recent snapshot on the target which the source still has a bookmark or
+    snapshot of. Snapshots on the target after it are destroyed when
+    receiving with -F.
+
+    Returns the bookmark or snapshot, if any, its createtxg, whether the
+    target exists and whether the target has only been probed instead of
+    listed.
+    """
+    # Bookmarks are named after the snapshot they were created from, so the
+    # most recent bookmark usually corresponds to the most recent snapshot on
+    # the target. Checking that snapshot directly is much cheaper than listing
+    # all snapshots of the target.
+    index = _probe_incremental_bookmark(
+        source_bookmarks, target, prefix, target_inventory)
+
+    if index is not None:
+        bookmark = source_bookmarks.ref(index)
+
+        return bookmark, source_bookmarks.createtxgs[index], True, \
+            target_inventory is None
+
+    if target_inventory is None:
+        try:
+            target_snapshots = list_snapshots(target, quiet=True)
+        except CalledProcessError:
+            # We assume that if listing snapshots fails, that the target
+            # filesystem does not exist. It will be created later.
+            return None, 0, False, False
     else:
-        most_recent_target_snapshot_guid = None
-        incremental_bookmark = None
+        if target not in target_inventory:
+            return None, 0, False, False
 
-    if incremental_bookmark is None and target_exists:
-        # The target filesystem exist, but has no snapshot/bookmark in common
-        # with the source. We assume that this is a filesystem unrelated to the
-        # source and thus rename it. This could e.g. happen if the source
-        # filesystem has been destroyed and re-created.
-        _move_target_away(target)
+        target_snapshots = target_inventory[target]
 
-    # Clean up left-over bookmarks. This might happen if the process was aborted
-    # after sending a snapshot but before removing the incremental source
-    # bookmark.
-    for i in source_bookmarks:
-        # Delete all bookmarks with the right prefix, except for the incremental
-        # source bookmark we're going to use.
-        if parse_snapshot_name(i.ref.name, prefix) is not None \
-                and i.ref != incremental_bookmark:
-            destroy_bookmark(i.ref)
-
-    for snapshot in source_snapshots:
+    # E.g. a snapshot taken on the target or a lost bookmark only means that
+    # an older snapshot is the common base, not that the target is unrelated.
+    for target_index in reversed(range(len(target_snapshots))):
+        target_guid = target_snapshots.guids[target_index]
+
+        # Planned snapshots don't have a guid yet.
+        if target_guid == 0:
+            continue
+
+        base: Bookmark | Snapshot | None = None
+        index = source_bookmarks.find_guid(target_guid)
+
+        if index is not None:
+            base = source_bookmarks.ref(index)
+            createtxg = source_bookmarks.createtxgs[index]
+        else:
+            # Snapshots sent using a replication stream are kept on the source
+            # instead of being bookmarked.
+            index = source_snapshots.find_guid(target_guid)
+
+            if index is not None:
+                base = source_snapshots.ref(index)
+                createtxg = source_snapshots.createtxgs[index]
+
+        if base is not None:
+            newer_count = len(target_snapshots) - target_index - 1
+
+            if newer_count:
+                logging.warning(
+                    f'Warning: Target {target} will be rolled back to its '
+                    f'snapshot {target_snapshots.names[target_index]}, '
+                    f'destroying {newer_count} more recent snapshot(s).')
+
+            return base, createtxg, True, False
+
+    return None, 0, True, False
+
+
+def _find_kept_bookmarks(
+        source_snapshots: SnapshotTable[Snapshot],
+        source_bookmarks: SnapshotTable[Bookmark],
+        snapshots_to_send: list[Snapshot], prefix: str,
+        keep_specs: list[KeepSpec]) \
+        -> list[Bookmark]:
+    """
+    Return the bookmarks with the prefix, including those created for
+    `snapshots_to_send`, which are selected by the keep specifications or are
+    the most recent one.
+    """
+    bookmarks = SnapshotTable(Bookmark, source_bookmarks.dataset)
+
+    for i in range(len(source_bookmarks)):
+        bookmarks.append(
+            source_bookmarks.names[i], source_bookmarks.guids[i],
+            source_bookmarks.createtxgs[i])
+
+    for snapshot in snapshots_to_send:
+        index = source_snapshots.find_name(snapshot.name)
+        assert index is not None
+
+        if bookmarks.find_name(snapshot.name) is None:
+            bookmarks.append(
+                snapshot.name, source_snapshots.guids[index],
+                source_snapshots.createtxgs[index])
+
+    expired_bookmarks = find_expired_snapshots(
+        bookmarks, keep_specs + [MostRecentKeepSpec(1)], prefix)
+
+    return [
+        bookmarks.ref(i) for i in range(len(bookmarks))
+        if bookmarks.has_prefix(i, prefix)
+        and bookmarks.ref(i) not in expired_bookmarks]
+
+
+def plan_send(
+        source: Dataset, source_snapshots: SnapshotTable[Snapshot],
+        source_bookmarks: SnapshotTable[Bookmark], target: Dataset,
+        prefix: str,
+        target_inventory: dict[Dataset, SnapshotTable[Snapshot]] | None,
+        archive: bool = False,
+        bookmark_keep_specs: list[KeepSpec] | None = None) \
+        -> SendStep:
+    """
+    Decide how to send the snapshots of the dataset `source`, which have been
+    listed by the caller, to `target`, which is the directory of an archive if
+    `archive` is true.
+
+    If `target_inventory` is None, the target is inspected as needed.
+    Otherwise, it contains the snapshots of all existing targets.
+
+    If `bookmark_keep_specs` is not None, the bookmarks selected by them are
+    kept on the source as possible incremental bases, instead of only the
+    bookmark of the most recently sent snapshot.
+    """
+    # The basis of the next incremental send.
+    incremental_base, sent_createtxg, target_exists, base_probed = \
+        _find_incremental_base(
+            source_snapshots, source_bookmarks, target, prefix,
+            target_inventory)
+
+    # Snapshots with the specified prefix, which need to be removed from the
+    # source once everything has been sent.
+    snapshots_to_destroy: list[Snapshot] = []
+    snapshots_to_send: list[Snapshot] = []
+
+    for i in range(len(source_snapshots)):
         # Ignore snapshots without the specified prefix.
-        if parse_snapshot_name(snapshot.ref.name, prefix) is None:
+        if not source_snapshots.has_prefix(i, prefix):
             continue
 
+        snapshot = source_snapshots.ref(i)
+        snapshots_to_destroy.append(snapshot)
+
         # We can skip everything and just delete the snapshot if that snapshot
         # has already been sent to the target but not yet deleted from the
         # source.
-        if snapshot.guid != most_recent_target_snapshot_guid:
-            # Create a bookmark of the snapshot we're going to send. For the
-            # logic above to work, this bookmark needs to exist before receiving
-            # the snapshot completes.
-            new_incremental_bookmark = Bookmark(source, snapshot.ref.name)
-            create_bookmark(snapshot.ref, new_incremental_bookmark)
+        if source_snapshots.createtxgs[i] > sent_createtxg:
+            snapshots_to_send.append(snapshot)
+
+    if bookmark_keep_specs is None:
+        kept_bookmarks = []
+    else:
+        kept_bookmarks = _find_kept_bookmarks(
+            source_snapshots, source_bookmarks, snapshots_to_send, prefix,
+            bookmark_keep_specs)
+
+    # Bookmarks of the snapshots to send may have been created by an aborted
+    # run. Those of a different snapshot of the same name are re-created.
+    existing_bookmarks: list[Bookmark] = []
+    mismatched_bookmarks: set[Bookmark] = set()
+
+    for snapshot in snapshots_to_send:
+        bookmark_index = source_bookmarks.find_name(snapshot.name)
+        snapshot_index = source_snapshots.find_name(snapshot.name)
+        assert snapshot_index is not None
+
+        if bookmark_index is not None:
+            bookmark = source_bookmarks.ref(bookmark_index)
+
+            if source_bookmarks.guids[bookmark_index] \
+                    == source_snapshots.guids[snapshot_index]:
+                existing_bookmarks.append(bookmark)
+            else:
+                mismatched_bookmarks.add(bookmark)
+
+    # Clean up left-over bookmarks. This might happen if the process was aborted
+    # after sending a snapshot but before removing the incremental source
+    # bookmark. Delete all bookmarks with the right prefix, except for the
+    # incremental source bookmark we're going to use and those to keep.
+    kept_bookmark_set = set(kept_bookmarks)
+    stale_bookmarks = [
+        source_bookmarks.ref(i) for i in range(len(source_bookmarks))
+        if source_bookmarks.has_prefix(i, prefix)
+        and source_bookmarks.ref(i) != incremental_base
+        and (source_bookmarks.ref(i) not in kept_bookmark_set
+             or source_bookmarks.ref(i) in mismatched_bookmarks)]
+
+    stale_bookmark_set = set(stale_bookmarks)
+
+    return SendStep(
+        source=source,
+        target=target,
+        incremental_base=incremental_base,
+        # The target filesystem exist, but has no snapshot/bookmark in common
+        # with the source. We assume that this is a filesystem unrelated to the
+        # source and thus rename it. This could e.g. happen if the source
+        # filesystem has been destroyed and re-created. In an archive, a full
+        # stream simply starts a new chain.
+        move_target_away=(
+            incremental_base is None and target_exists and not archive),
+        stale_bookmarks=stale_bookmarks,
+        snapshots_to_send=snapshots_to_send,
+        snapshots_to_destroy=snapshots_to_destroy,
+        archive=archive,
+        kept_bookmarks=kept_bookmarks,
+        base_probed=base_probed,
+        existing_bookmarks=[
+            i for i in existing_bookmarks if i not in stale_bookmark_set])
+
+
+def _is_replication_base(
+        source_snapshots: SnapshotTable[Snapshot],
+        target_snapshots: SnapshotTable[Snapshot], name: str) \
+        -> bool:
+    source_index = source_snapshots.find_name(name)
+
+    # Without -F, receiving requires that the base is the most recent snapshot
+    # on the target.
+    return bool(target_snapshots) and source_index is not None \
+        and target_snapshots.names[-1] == name \
+        and target_snapshots.guids[-1] == source_snapshots.guids[source_index]
+
+
+def plan_replication(
+        source: Dataset,
+        source_snapshots: dict[Dataset, SnapshotTable[Snapshot]],
+        target: Dataset, prefix: str,
+        target_inventory: dict[Dataset, SnapshotTable[Snapshot]]) \
+        -> ReplicationStep | None:
+    """
+    Decide how to send the subtree rooted at `source` to `target` using a
+    single replication stream. `source_snapshots` contains the snapshots of
+    all datasets of the subtree and `target_inventory` those of all existing
+    targets.
+
+    Returns None if the subtree can't be sent using a replication stream,
+    e.g. because the snapshots of the datasets or of their targets differ.
+    """
+    root_snapshots = source_snapshots[source]
+    names = [
+        root_snapshots.names[i] for i in range(len(root_snapshots))
+        if root_snapshots.has_prefix(i, prefix)]
+
+    # All datasets need the most recent snapshot, as the stream only includes
+    # datasets which have it.
+    if not names or any(
+            i.find_name(names[-1]) is None for i in source_snapshots.values()):
+        return None
+
+    targets = {
+        i: Dataset(target + i.removeprefix(source)) for i in source_snapshots}
+    existing_targets = [i for i in targets.values() if i in target_inventory]
+
+    if not existing_targets:
+        base_index = None
+    elif len(existing_targets) < len(targets):
+        return None
+    else:
+        for i in reversed(range(len(names))):
+            if all(
+                    _is_replication_base(
+                        source_snapshots[j], target_inventory[k], names[i])
+                    for j, k in targets.items()):
+                base_index = i
+                break
+        else:
+            return None
+
+    if base_index is None:
+        incremental_base = None
+        snapshots_to_send = names
+    else:
+        incremental_base = names[base_index]
+        snapshots_to_send = names[base_index + 1:]
+
+    names_to_destroy = set(names[:-1])
+
+    return ReplicationStep(
+        source=source,
+        target=target,
+        datasets=list(source_snapshots),
+        incremental_base=incremental_base,
+        snapshots_to_send=snapshots_to_send,
+        snapshots_to_destroy=[
+            i.ref(j) for i in source_snapshots.values() for j in range(len(i))
+            if i.names[j] in names_to_destroy])
+
+
+def _check_rollback(target: Dataset, base: Bookmark | Snapshot) -> bool:
+    """
+    Called when receiving the first stream from a probed incremental base
+    failed without -F. Return whether the snapshot corresponding to `base`
+    still exists on the target, so that receiving with -F can be retried,
+    after reporting the snapshots that are destroyed by doing so.
+    """
+    try:
+        target_snapshots = list_snapshots(target, quiet=True)
+    except CalledProcessError:
+        return False
+
+    index = target_snapshots.find_name(base.name)
+
+    if index is None:
+        return False
+
+    newer_count = len(target_snapshots) - index - 1
+
+    if newer_count:
+        logging.warning(
+            f'Warning: Target {target} will be rolled back to its snapshot '
+            f'{base.name}, destroying {newer_count} more recent snapshot(s).')
+
+    return True
+
+
+def _record_checksum(
+        snapshot: Snapshot, stream_checksum: StreamChecksum | None) \
+        -> None:
+    if stream_checksum is None:
+        return
+
+    logging.info(
+        f'Received {snapshot}: {stream_checksum.size} bytes, '
+        f'{stream_checksum.algorithm} {stream_checksum.value}')
+
+    set_user_property(
+        snapshot, stream_checksum_property, str(stream_checksum))
+
+
+def execute_replication(
+        step: ReplicationStep, checksum: bool = False,
+        rate_limit: int | None = None) \
+        -> None:
+    if step.snapshots_to_send:
+        if step.incremental_base is None:
+            incremental_base = None
+        else:
+            incremental_base = Snapshot(step.source, step.incremental_base)
+
+            # Receiving fails if a target has been changed since its most
+            # recent snapshot, e.g. by updating access times. The base is the
+            # most recent snapshot of all targets, so rolling back to it
+            # doesn't destroy any snapshots.
+            for i in step.targets:
+                rollback_snapshot(Snapshot(i, step.incremental_base))
+
+        name = step.snapshots_to_send[-1]
+        stream_checksum = send_receive_replication(
+            incremental_base, Snapshot(step.source, name), step.target,
+            checksum=checksum, rate_limit=rate_limit)
+
+        _record_checksum(Snapshot(step.target, name), stream_checksum)
+
+    destroy_snapshots([], step.recursive_snapshots_to_destroy)
+
+
+def execute_send(
+        step: SendStep, checksum: bool = False,
+        rate_limit: int | None = None) \
+        -> None:
+    if step.move_target_away:
+        _move_target_away(step.target)
+
+    destroy_bookmarks(step.stale_bookmarks)
+
+    # Create bookmarks of all the snapshots we're going to send. For the logic
+    # above to work, the bookmark of a snapshot needs to exist before receiving
+    # that snapshot completes.
+    create_bookmarks({
+        i: Snapshot(step.source, i.name) for i in step.new_bookmarks})
+
+    if step.archive:
+        # Provides the guids recorded in the manifest, also of the snapshots
+        # created by the same run.
+        source_snapshots, source_bookmarks = \
+            list_snapshots_and_bookmarks(step.source)
+
+    for i, (incremental_base, snapshot, intermediates) in \
+            enumerate(step.streams):
+        if step.archive:
+            archive_snapshot(
+                incremental_base, snapshot, Path(step.target),
+                source_snapshots, source_bookmarks)
+        else:
+            target_snapshot = Snapshot(step.target, snapshot.name)
+
+            # The target may have more recent snapshots than the probed base,
+            # which -F would destroy without notice.
+            force = not (step.base_probed and i == 0)
+
+            try:
+                stream_checksum = send_receive_snapshot(
+                    incremental_base, snapshot, target_snapshot,
+                    checksum=checksum, intermediates=intermediates,
+                    rate_limit=rate_limit, force=force)
+            except CalledProcessError:
+                if force:
+                    raise
+
+                assert incremental_base is not None
+
+                if not _check_rollback(step.target, incremental_base):
+                    raise
+
+                stream_checksum = send_receive_snapshot(
+                    incremental_base, snapshot, target_snapshot,
+                    checksum=checksum, intermediates=intermediates,
+                    rate_limit=rate_limit)
+
+            _record_checksum(target_snapshot, stream_checksum)
+
+    # Only now that the most recent snapshot has been received, remove the
+    # bookmarks of older snapshots and the snapshots themselves.
+    destroy_bookmarks(step.superseded_bookmarks)
+    destroy_snapshots(step.snapshots_to_destroy)
+
+
+def execute_fan_out(
+        step: FanOutStep, checksum: bool = False,
+        rate_limit: int | None = None) \
+        -> list[Dataset]:
+    """
+    Send the snapshots to all targets and return the targets on which
+    receiving failed. Sending to the other targets continues in that case,
+    but the source is only cleaned up if all targets have received all
+    snapshots, so that the next run can continue from where the failed
+    targets stopped.
+    """
+    for i in step.sends:
+        if i.move_target_away:
+            _move_target_away(i.target)
+
+    destroy_bookmarks(step.stale_bookmarks)
+
+    # As in execute_send(), the bookmarks need to exist before receiving
+    # completes.
+    create_bookmarks({
+        i: Snapshot(step.source, i.name) for i in step.new_bookmarks})
+
+    failed_targets: list[Dataset] = []
+
+    # As in execute_send(), the first stream to targets with a probed base is
+    # received without -F.
+    probed_targets = {i.target for i in step.sends if i.base_probed}
+
+    for incremental_base, snapshot, targets in \
+            step.iter_streams(failed_targets):
+        target_snapshots = [Snapshot(i, snapshot.name) for i in targets]
+
+        try:
+            stream_checksum, errors = send_receive_snapshot_fan_out(
+                incremental_base, snapshot, target_snapshots,
+                checksum=checksum, rate_limit=rate_limit,
+                force=[i not in probed_targets for i in targets])
+        except CalledProcessError as e:
+            stream_checksum = None
+            errors = {i: e for i in target_snapshots}
+
+        for target_snapshot in target_snapshots:
+            error = errors.get(target_snapshot)
+            target_checksum = stream_checksum
+
+            if error is not None \
+                    and target_snapshot.dataset in probed_targets:
+                assert incremental_base is not None
+
+                if _check_rollback(target_snapshot.dataset, incremental_base):
+                    try:
+                        target_checksum = send_receive_snapshot(
+                            incremental_base, snapshot, target_snapshot,
+                            checksum=checksum, rate_limit=rate_limit)
+                    except CalledProcessError as e:
+                        error = e
+                    else:
+                        error = None
+
+            probed_targets.discard(target_snapshot.dataset)
 
-            # Send the snapshot.
-            target_snapshot = Snapshot(target, snapshot.ref.name)
-            send_receive_snapshot(incremental_bookmark, snapshot.ref, target_snapshot)
+            if error is None:
+                _record_checksum(target_snapshot, target_checksum)
+            else:
+                logging.error(
+                    f'Failed to send {snapshot} to {target_snapshot.dataset}: '
+                    f'{format_cmdline(error.cmd)}')
 
-            # Destroy the old bookmark that we used for the incremental send.
-            if incremental_bookmark is not None:
-                destroy_bookmark(incremental_bookmark)
+                failed_targets.append(target_snapshot.dataset)
 
-            incremental_bookmark = new_incremental_bookmark
+    if not failed_targets:
+        destroy_bookmarks(step.superseded_bookmarks)
+        destroy_snapshots(step.snapshots_to_destroy)
 
-        destroy_snapshots([snapshot.ref])
+    return failed_targets
@@ -1,24 +1,60 @@
 from __future__ import annotations
 
 import logging
+import math
 import subprocess
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import ExitStack
+from datetime import datetime, timedelta
 from enum import Enum
 from pathlib import Path
 from subprocess import CalledProcessError
-from typing import Iterator, Sequence
+from typing import Sequence, Any, TypeAlias, Iterable
 
-from snappy.config import load_config, get_default_config_path, KeepSpec, \
-    MostRecentKeepSpec
-from snappy.send import send_snapshots
+from snappy.archive import is_archive_target, get_archived_snapshots, \
+    restore_archive
+from snappy.config import load_config, load_property_config, \
+    get_default_config_path, KeepSpec, MostRecentKeepSpec, SnapshotHook, \
+    ScanPolicy
+from snappy.hooks import freeze_datasets
+from snappy.locking import lock_datasets, LockTimeoutError
+from snappy.plan import Plan, SendStep, FanOutStep
+from snappy.selector import DatasetSelector, is_pattern
+from snappy.send import plan_send, execute_send, plan_replication, \
+    execute_replication, execute_fan_out
 from snappy.snapshots import make_snapshot_name, find_expired_snapshots
-from snappy.utils import UserError
+from snappy.utils import UserError, format_cmdline, datetime_to_seconds, \
+    format_size
 from snappy.zfs import create_snapshots, destroy_snapshots, Dataset, Snapshot, \
-    list_snapshots, list_children
+    iter_children, iter_snapshots, iter_snapshots_and_bookmarks, Bookmark, \
+    SnapshotTable, SnapshotRange, get_properties, estimate_send_size, \
+    get_pool_name, iter_parents, estimate_destroy_size, get_scanning_pools
 
 
 default_snapshot_name_prefix = 'snappy'
 
+# Maximum number of operations destroying expired snapshots that are run
+# concurrently on each pool.
+default_prune_jobs = 4
+
+# Minimum number of consecutive expired snapshots of a dataset to destroy using
+# the `first%last` syntax instead of listing them.
+_min_range_length = 3
+
+# Number of times creating snapshots is attempted when their name is already
+# used.
+_snapshot_attempts = 3
+
+# Rate in bytes per second to which sends from or to pools which are being
+# scrubbed or resilvered are limited with `--on-scan throttle`.
+throttled_send_rate = 32 * 1024 ** 2
+
+
+# The snapshots and bookmarks of a dataset.
+_DatasetTables: TypeAlias = \
+    tuple[SnapshotTable[Snapshot], SnapshotTable[Bookmark]]
+
 
 class AutoAction(Enum):
     snapshot = 'snapshot'
@@ -39,51 +75,46 @@ def _get_send_target(
     return Dataset(send_target + source.removeprefix(send_base))
 
 
-def _get_pool_name(dataset: Dataset) -> Dataset:
-    return Dataset(dataset.split('/', 1)[0])
+def _get_selected_datasets(
+        datasets: list[Dataset], recursive: bool, exclude: list[Dataset]) \
+        -> tuple[list[Dataset], list[Dataset]]:
+    """
+    Return the selected datasets and the minimal set of selected datasets whose
+    descendants are all selected too.
+    """
+    # Input validation should make sure that `exclude` is only set if recursive
+    # is true.
+    assert recursive or not exclude
 
+    selector = DatasetSelector(datasets, exclude, recursive)
 
-def _iter_parents(dataset: Dataset) -> Iterator[Dataset]:
-    while True:
-        yield dataset
+    if not recursive and not selector.has_patterns:
+        return datasets, []
 
-        if '/' not in dataset:
-            break
+    listed_datasets = [j for i in selector.roots for j in iter_children(i)]
+    selected_datasets = [i for i in listed_datasets if selector.matches(i)]
 
-        dataset = Dataset(dataset.rsplit('/', 1)[0])
+    if not recursive:
+        return selected_datasets, []
 
+    selected_set = set(selected_datasets)
 
-def _get_selected_datasets(
-        datasets: list[Dataset], recursive: bool, exclude: list[Dataset]) \
-        -> list[Dataset]:
-    if not recursive:
-        # Input validation should make sure that `exclude` is only set if
-        # recursive is true.
-        assert not exclude
-
-        return datasets
-
-    processed_datasets: set[Dataset] = set()
-    res: list[Dataset] = []
-
-    # Sort so that we get parents before children.
-    for i in sorted(datasets):
-        if i not in processed_datasets:
-            for j in list_children(i):
-                # Add all children to this set to that we won't call
-                # `list_children()` again even if they occur in `datasets`.
-                processed_datasets.add(j)
-
-                # Figure out if a dataset should be included by iterating
-                # looking up each prefix in `datasets` and `exclude`.
-                for k in _iter_parents(j):
-                    if k in exclude:
-                        break
-                    elif k in datasets:
-                        res.append(j)
-                        break
+    # Datasets of which not all descendants are selected. Children are listed
+    # after their parents, so when iterating in reverse, a dataset's children
+    # have all been visited before the dataset itself.
+    incomplete_datasets: set[Dataset] = set()
 
-    return res
+    for i in reversed(listed_datasets):
+        if i not in selected_set or i in incomplete_datasets:
+            incomplete_datasets.add(Dataset(i.rpartition('/')[0]))
+
+    complete_datasets = selected_set - incomplete_datasets
+    subtree_roots = [
+        i for i in selected_datasets
+        if i in complete_datasets
+        and Dataset(i.rpartition('/')[0]) not in complete_datasets]
+
+    return selected_datasets, subtree_roots
 
 
 def _run_script(script: str) -> None:
@@ -97,57 +128,1052 @@ def _run_script(script: str) -> None:
             f'Pre-snapshot script failed with exit code {e.returncode}.')
 
 
-def _snapshot(datasets: list[Dataset], prefix: str) -> None:
-    snapshot_name = make_snapshot_name(prefix, datetime.now())
-    snapshots = [Snapshot(i, snapshot_name) for i in datasets]
+def _next_createtxg(*tables: SnapshotTable[Any]) -> int:
+    return max(max(i.createtxgs, default=0) for i in tables) + 1
+
+
+def _get_expired_snapshots(
+        snapshots: SnapshotTable[Snapshot], keep_specs: list[KeepSpec],
+        prefix: str, carry_over: bool) \
+        -> list[Snapshot]:
+    expired_snapshots = find_expired_snapshots(
+        snapshots, keep_specs, prefix, carry_over)
+
+    # Keep the order of the listing so that the plan is deterministic.
+    return [i.ref for i in snapshots if i.ref in expired_snapshots]
+
+
+def _get_recursive_expired_snapshots(
+        inventory: dict[Dataset, SnapshotTable[Snapshot]],
+        expired_snapshots: dict[Dataset, list[Snapshot]], root: Dataset) \
+        -> list[Snapshot]:
+    """
+    Return those expired snapshots of `root` which are also expired on all
+    descendants which have a snapshot of the same name.
+    """
+    kept_names: set[str] = set()
+
+    for dataset, snapshots in inventory.items():
+        if dataset == root or dataset.startswith(f'{root}/'):
+            expired_names = {i.name for i in expired_snapshots[dataset]}
+            kept_names.update(
+                i for i in snapshots.names if i not in expired_names)
+
+    return [i for i in expired_snapshots[root] if i.name not in kept_names]
+
+
+def _get_expired_ranges(
+        snapshots: SnapshotTable[Snapshot], expired_snapshots: set[Snapshot]) \
+        -> list[SnapshotRange]:
+    """
+    Return the runs of consecutive snapshots in `snapshots` which are all in
+    `expired_snapshots` and are long enough to be worth destroying as a range.
+    """
+    ranges = []
+    run: list[str] = []
+
+    # A trailing empty name ends the last run.
+    for i in [*snapshots.names, '']:
+        if Snapshot(snapshots.dataset, i) in expired_snapshots:
+            run.append(i)
+        else:
+            if len(run) >= _min_range_length:
+                ranges.append(SnapshotRange(snapshots.dataset, tuple(run)))
+
+            run = []
+
+    return ranges
+
+
+def _estimate_freed_space(
+        expired_snapshots: dict[Dataset, list[Snapshot]],
+        candidates: list[Snapshot]) \
+        -> int:
+    """
+    Return the space freed by destroying the expired snapshots together with
+    the candidates.
+    """
+    return estimate_destroy_size([
+        *(j for i in expired_snapshots.values() for j in i), *candidates])
+
+
+def _add_capacity_expired_snapshots(
+        inventory: dict[Dataset, SnapshotTable[Snapshot]],
+        expired_snapshots: dict[Dataset, list[Snapshot]], prefix: str,
+        max_capacity: int) \
+        -> None:
+    """
+    Add the oldest snapshots with the prefix to `expired_snapshots` until
+    destroying them is estimated to bring the capacity of each pool down to
+    `max_capacity` percent. The most recent snapshot with the prefix of each
+    dataset and snapshots which don't exist yet are never added.
+    """
+    datasets_by_pool: dict[Dataset, list[Dataset]] = {}
+
+    for dataset in inventory:
+        datasets_by_pool.setdefault(get_pool_name(dataset), []).append(dataset)
+
+    properties = get_properties(list(datasets_by_pool), ['used', 'available'])
+
+    for pool, datasets in datasets_by_pool.items():
+        used = int(properties[pool]['used'])
+        size = used + int(properties[pool]['available'])
+        required_space = used - size * max_capacity // 100
+
+        if required_space <= 0:
+            continue
+
+        pool_expired_snapshots = {i: expired_snapshots[i] for i in datasets}
+        candidates: list[tuple[float, Snapshot]] = []
+
+        for dataset in datasets:
+            snapshots = inventory[dataset]
+            expired_set = set(expired_snapshots[dataset])
+            indices = [
+                i for i in range(len(snapshots))
+                if snapshots.has_prefix(i, prefix)][:-1]
+
+            # Snapshots which are only created by the same plan have a guid of
+            # 0.
+            candidates.extend(
+                (snapshots.timestamp(i), snapshots.ref(i)) for i in indices
+                if snapshots.ref(i) not in expired_set and snapshots.guids[i])
+
+        candidates.sort(key=lambda x: x[0])
+        candidate_snapshots = [i for _, i in candidates]
+
+        # Destroying more snapshots never frees less space, so search for the
+        # smallest number of the oldest candidates which frees enough space.
+        if _estimate_freed_space(pool_expired_snapshots, []) \
+                >= required_space:
+            continue
+
+        if _estimate_freed_space(
+                pool_expired_snapshots, candidate_snapshots) < required_space:
+            logging.warning(
+                f'Warning: Destroying all prunable snapshots on {pool} is not '
+                f'expected to free {format_size(required_space)}.')
+
+            count = len(candidate_snapshots)
+        else:
+            low, count = 0, len(candidate_snapshots)
+
+            while low + 1 < count:
+                middle = (low + count) // 2
+
+                if _estimate_freed_space(
+                        pool_expired_snapshots,
+                        candidate_snapshots[:middle]) >= required_space:
+                    count = middle
+                else:
+                    low = middle
+
+        logging.info(
+            f'Pool {pool} is above {max_capacity}% capacity, additionally '
+            f'destroying the {count} oldest snapshots.')
+
+        added_snapshots = set(candidate_snapshots[:count])
+
+        # Keep the order of the listing so that the plan is deterministic.
+        for dataset in datasets:
+            expired_snapshots[dataset] = [
+                i.ref for i in inventory[dataset]
+                if i.ref in added_snapshots
+                or i.ref in expired_snapshots[dataset]]
+
+
+def _plan_prune(
+        plan: Plan, inventory: dict[Dataset, SnapshotTable[Snapshot]],
+        keep_specs: list[KeepSpec], prefix: str, subtree_roots: list[Dataset],
+        carry_over: bool, max_capacity: int | None) \
+        -> None:
+    """
+    Add the expired snapshots of the datasets in `inventory` to the plan.
+    Snapshots of the subtrees rooted at `subtree_roots` are destroyed
+    recursively where possible, all descendants must be in `inventory`.
+
+    If `max_capacity` is not None, additional snapshots are expired on pools
+    above that capacity in percent.
+    """
+    expired_snapshots = {
+        dataset: _get_expired_snapshots(
+            snapshots, keep_specs, prefix, carry_over)
+        for dataset, snapshots in inventory.items()}
+
+    if max_capacity is not None:
+        _add_capacity_expired_snapshots(
+            inventory, expired_snapshots, prefix, max_capacity)
+
+    for snapshots in expired_snapshots.values():
+        plan.expired_snapshots.extend(snapshots)
+
+    for root in subtree_roots:
+        # A recursive destroy doesn't save anything on a single dataset.
+        if any(i.startswith(f'{root}/') for i in inventory):
+            plan.recursive_expired_snapshots.extend(
+                _get_recursive_expired_snapshots(
+                    inventory, expired_snapshots, root))
+
+    # Snapshots destroyed recursively need to be excluded from the ranges so
+    # that they aren't destroyed twice.
+    remaining_snapshots = set(plan.remaining_expired_snapshots)
+
+    for table in inventory.values():
+        plan.expired_ranges.extend(
+            _get_expired_ranges(table, remaining_snapshots))
+
+
+def _list_targets(
+        send_target: Dataset, targets: list[Dataset]) \
+        -> dict[Dataset, SnapshotTable[Snapshot]]:
+    """
+    Return the snapshots of those datasets in `targets` which exist.
+    """
+    try:
+        existing_datasets = set(iter_children(send_target, quiet=True))
+    except CalledProcessError:
+        # Nothing has been sent to the target yet.
+        return {}
+
+    return dict(iter_snapshots([i for i in targets if i in existing_datasets]))
+
+
+def _get_received_snapshots(
+        step: SendStep, source_snapshots: SnapshotTable[Snapshot],
+        source_bookmarks: SnapshotTable[Bookmark],
+        target_snapshots: SnapshotTable[Snapshot] | None) \
+        -> SnapshotTable[Snapshot] | None:
+    """
+    Return the snapshots the target will have after executing `step`, or None
+    if it won't exist.
+    """
+    if step.move_target_away:
+        target_snapshots = None
+
+    if not step.snapshots_to_send:
+        return target_snapshots
 
-    create_snapshots(snapshots)
+    if target_snapshots is None:
+        target_snapshots = SnapshotTable(Snapshot, step.target)
+    elif step.incremental_base is not None:
+        # Receiving with -F destroys the snapshots on the target created after
+        # the incremental base.
+        if isinstance(step.incremental_base, Bookmark):
+            base_table: SnapshotTable[Any] = source_bookmarks
+        else:
+            base_table = source_snapshots
 
+        base_index = base_table.find_name(step.incremental_base.name)
+        assert base_index is not None
 
-def _send(
-        datasets: list[Dataset], prefix: str, send_target: Dataset,
-        send_base: str) \
+        target_base_index = \
+            target_snapshots.find_guid(base_table.guids[base_index])
+
+        if target_base_index is not None:
+            target_snapshots.truncate(target_base_index + 1)
+
+    createtxg = _next_createtxg(target_snapshots)
+
+    for incremental_base, snapshot, intermediates in step.streams:
+        if intermediates:
+            assert incremental_base is not None
+
+            # The stream also carries the snapshots without the prefix, which
+            # must not be destroyed as part of a range on the target.
+            start = source_snapshots.find_name(incremental_base.name)
+            end = source_snapshots.find_name(snapshot.name)
+            assert start is not None and end is not None
+
+            names = source_snapshots.names[start + 1:end + 1]
+        else:
+            names = [snapshot.name]
+
+        for name in names:
+            target_snapshots.append(name, 0, createtxg)
+            createtxg += 1
+
+    return target_snapshots
+
+
+def _update_target_inventory(
+        step: SendStep, snapshots: SnapshotTable[Snapshot],
+        bookmarks: SnapshotTable[Bookmark],
+        target_inventory: dict[Dataset, SnapshotTable[Snapshot]] | None) \
+        -> None:
+    if target_inventory is not None:
+        received_snapshots = _get_received_snapshots(
+            step, snapshots, bookmarks,
+            target_inventory.pop(step.target, None))
+
+        if received_snapshots is not None:
+            target_inventory[step.target] = received_snapshots
+
+
+def _add_send_step(
+        plan: Plan, dataset: Dataset, snapshots: SnapshotTable[Snapshot],
+        bookmarks: SnapshotTable[Bookmark], target: Dataset, prefix: str,
+        target_inventory: dict[Dataset, SnapshotTable[Snapshot]] | None,
+        keep_latest_snapshot: bool, archive: bool = False,
+        intermediates: bool = False,
+        bookmark_keep_specs: list[KeepSpec] | None = None) \
+        -> None:
+    step = plan_send(
+        dataset, snapshots, bookmarks, target, prefix, target_inventory,
+        archive, bookmark_keep_specs)
+
+    step.intermediates = intermediates
+
+    if keep_latest_snapshot:
+        step.snapshots_to_destroy = step.snapshots_to_destroy[:-1]
+
+    plan.sends.append(step)
+    _update_target_inventory(step, snapshots, bookmarks, target_inventory)
+
+
+def _add_fan_out_step(
+        plan: Plan, dataset: Dataset, snapshots: SnapshotTable[Snapshot],
+        bookmarks: SnapshotTable[Bookmark], targets: list[Dataset],
+        prefix: str,
+        target_inventory: dict[Dataset, SnapshotTable[Snapshot]] | None,
+        bookmark_keep_specs: list[KeepSpec] | None) \
+        -> None:
+    steps = [
+        plan_send(
+            dataset, snapshots, bookmarks, i, prefix, target_inventory,
+            bookmark_keep_specs=bookmark_keep_specs)
+        for i in targets]
+
+    # Each target may still need the bookmark it was last sent from, or keep
+    # a different set of bookmarks.
+    stale_bookmark_sets = [set(i.stale_bookmarks) for i in steps]
+
+    plan.fan_outs.append(FanOutStep(
+        source=dataset,
+        sends=steps,
+        stale_bookmarks=[
+            i for i in steps[0].stale_bookmarks
+            if all(i in j for j in stale_bookmark_sets)],
+        snapshots_to_destroy=steps[0].snapshots_to_destroy))
+
+    for step in steps:
+        step.stale_bookmarks = []
+        step.snapshots_to_destroy = []
+        _update_target_inventory(step, snapshots, bookmarks, target_inventory)
+
+
+def _add_replication_step(
+        plan: Plan, root: Dataset,
+        tables: dict[Dataset, _DatasetTables],
+        target: Dataset, prefix: str,
+        target_inventory: dict[Dataset, SnapshotTable[Snapshot]]) \
+        -> None:
+    step = plan_replication(
+        root, {k: v for k, (v, _) in tables.items()}, target, prefix,
+        target_inventory)
+
+    if step is None:
+        # Send the datasets separately, but keep their most recent snapshot
+        # so that the next run can use it as the base of a replication
+        # stream.
+        for dataset, (snapshots, bookmarks) in tables.items():
+            _add_send_step(
+                plan, dataset, snapshots, bookmarks,
+                Dataset(target + dataset.removeprefix(root)), prefix,
+                target_inventory, keep_latest_snapshot=True)
+
+        return
+
+    plan.replications.append(step)
+
+    if not step.snapshots_to_send:
+        return
+
+    for dataset, (snapshots, _) in tables.items():
+        dataset_target = Dataset(target + dataset.removeprefix(root))
+        received_snapshots = target_inventory.setdefault(
+            dataset_target, SnapshotTable(Snapshot, dataset_target))
+        createtxg = _next_createtxg(received_snapshots)
+        end = snapshots.find_name(step.snapshots_to_send[-1])
+        assert end is not None
+
+        # The stream includes all snapshots after the base, also those without
+        # the prefix, and all snapshots of datasets sent in full.
+        start = None
+
+        if step.incremental_base is not None:
+            start = snapshots.find_name(step.incremental_base)
+
+        start = 0 if start is None else start + 1
+
+        for i, name in enumerate(snapshots.names[start:end + 1]):
+            received_snapshots.append(name, 0, createtxg + i)
+
+
+def _plan_send(
+        plan: Plan, datasets: list[Dataset], subtree_roots: list[Dataset],
+        prefix: str, send_targets: list[Dataset], send_base: str,
+        keep_specs: list[KeepSpec] | None, replicate: bool, carry_over: bool,
+        max_capacity: int | None, high_frequency: bool,
+        bookmark_keep_specs: list[KeepSpec] | None) \
         -> None:
-    for dataset in datasets:
-        target_dataset = _get_send_target(dataset, send_target, send_base)
+    targets = [
+        _get_send_target(i, j, send_base) for j in send_targets
+        for i in datasets]
+
+    # Archives and replication streams only support a single target.
+    archive = is_archive_target(send_targets[0])
+
+    # We only need to know all snapshots on the targets up-front when we're
+    # going to prune them or use replication streams. Otherwise, we only
+    # inspect the targets as needed. Reading the manifests of archives is
+    # cheap.
+    if archive:
+        target_inventory = get_archived_snapshots(targets)
+    elif keep_specs is None and not replicate:
+        target_inventory = None
+    else:
+        target_inventory = {}
+
+        for i in send_targets:
+            target_inventory.update(_list_targets(i, targets))
+
+    replication_roots = set(subtree_roots if replicate else [])
+    new_snapshots = {i.dataset: i.name for i in plan.snapshots}
+
+    # Pruning by capacity needs the snapshots of all targets on a pool.
+    # Otherwise, the targets of each dataset are pruned as soon as all steps
+    # sending to them are planned, so that only the snapshots of the targets
+    # which are still needed are kept in memory.
+    prune_early = keep_specs is not None and max_capacity is None
+
+    # Snapshots and bookmarks of the datasets of each subtree sent using a
+    # replication stream, which are only planned once the whole subtree has
+    # been listed.
+    subtree_tables: dict[Dataset, dict[Dataset, _DatasetTables]] = {}
+
+    # List the snapshots of all datasets in one go but process them one
+    # dataset at a time.
+    for dataset, snapshots, bookmarks in iter_snapshots_and_bookmarks(datasets):
+        snapshot_name = new_snapshots.get(dataset)
+
+        if snapshot_name is not None:
+            # Include the snapshot that will be created before sending.
+            snapshots.append(
+                snapshot_name, 0, _next_createtxg(snapshots, bookmarks))
+
+        root = next(
+            (i for i in iter_parents(dataset) if i in replication_roots), None)
+
+        if root is not None:
+            subtree_tables.setdefault(root, {})[dataset] = snapshots, bookmarks
+        elif len(send_targets) > 1:
+            _add_fan_out_step(
+                plan, dataset, snapshots, bookmarks,
+                [_get_send_target(dataset, i, send_base) for i in send_targets],
+                prefix, target_inventory, bookmark_keep_specs)
+        else:
+            _add_send_step(
+                plan, dataset, snapshots, bookmarks,
+                _get_send_target(dataset, send_targets[0], send_base), prefix,
+                target_inventory, keep_latest_snapshot=False, archive=archive,
+                # A backlog of many snapshots is sent in a single stream.
+                intermediates=high_frequency and not archive,
+                bookmark_keep_specs=bookmark_keep_specs)
+
+        if root is None and prune_early:
+            assert keep_specs is not None and target_inventory is not None
+
+            _prune_targets(
+                plan, target_inventory,
+                [_get_send_target(dataset, i, send_base) for i in send_targets],
+                keep_specs, prefix, carry_over, None)
 
-        send_snapshots(dataset, target_dataset, prefix)
+    for root in list(subtree_tables):
+        assert target_inventory is not None
 
+        # Drop the snapshots of each subtree once its step is planned.
+        tables = subtree_tables.pop(root)
+        target = _get_send_target(root, send_targets[0], send_base)
 
-def _prune(
-        datasets: list[Dataset], prefix: str, keep_specs: list[KeepSpec]) \
+        _add_replication_step(
+            plan, root, tables, target, prefix, target_inventory)
+
+        if prune_early:
+            assert keep_specs is not None
+
+            _prune_targets(
+                plan, target_inventory,
+                [Dataset(target + i.removeprefix(root)) for i in tables],
+                keep_specs, prefix, carry_over, None)
+
+    if keep_specs is not None and not prune_early:
+        assert target_inventory is not None
+
+        _prune_targets(
+            plan, target_inventory, targets, keep_specs, prefix, carry_over,
+            max_capacity)
+
+
+def _prune_targets(
+        plan: Plan, target_inventory: dict[Dataset, SnapshotTable[Snapshot]],
+        targets: list[Dataset], keep_specs: list[KeepSpec], prefix: str,
+        carry_over: bool, max_capacity: int | None) \
         -> None:
-    # The most recent snapshot should never be deleted by this tool.
-    keep_specs = keep_specs + [MostRecentKeepSpec(1)]
+    """
+    Add the expired snapshots of those of the targets which exist to the plan
+    and drop them from `target_inventory`.
+    """
+    # The targets may have descendants which aren't sent to, so their
+    # snapshots are never destroyed recursively.
+    _plan_prune(
+        plan,
+        {i: target_inventory.pop(i) for i in targets if i in target_inventory},
+        keep_specs, prefix, [], carry_over, max_capacity)
+
+
+def _get_changed_datasets(
+        datasets: list[Dataset], prefix: str, now: datetime, min_written: int,
+        max_snapshot_age: timedelta | None) \
+        -> list[Dataset]:
+    """
+    Return those datasets to which at least `min_written` bytes have been
+    written since their most recent snapshot, or whose most recent snapshot
+    with the prefix is older than `max_snapshot_age`.
+    """
+    properties = get_properties(datasets, ['written'])
+    changed_datasets = {
+        i for i in datasets if int(properties[i]['written']) >= min_written}
+
+    if max_snapshot_age is not None:
+        min_timestamp = datetime_to_seconds(now - max_snapshot_age)
+        unchanged_datasets = [i for i in datasets if i not in changed_datasets]
+
+        for dataset, snapshots in iter_snapshots(unchanged_datasets):
+            timestamps = [
+                snapshots.timestamp(i) for i in range(len(snapshots))
+                if snapshots.has_prefix(i, prefix)]
+
+            if max(timestamps, default=-math.inf) <= min_timestamp:
+                changed_datasets.add(dataset)
+
+    return [i for i in datasets if i in changed_datasets]
+
+
+def _get_complete_subtree_roots(
+        datasets: list[Dataset], subtree_roots: list[Dataset],
+        included: set[Dataset]) \
+        -> list[Dataset]:
+    """
+    Return the minimal set of datasets within the subtrees rooted at
+    `subtree_roots` of which all descendants are in `included`. `datasets`
+    must contain all datasets of those subtrees, parents before children.
+    """
+    roots = set(subtree_roots)
+    incomplete_datasets: set[Dataset] = set()
 
-    for dataset in datasets:
-        snapshots = list_snapshots(dataset)
-        expired_snapshot = find_expired_snapshots(snapshots, keep_specs, prefix)
+    for i in reversed(datasets):
+        if i not in included or i in incomplete_datasets:
+            incomplete_datasets.add(Dataset(i.rpartition('/')[0]))
 
-        destroy_snapshots(expired_snapshot)
+    complete_datasets = {
+        i for i in datasets
+        if i in included and i not in incomplete_datasets
+        and any(j in roots for j in iter_parents(i))}
+
+    return [
+        i for i in datasets
+        if i in complete_datasets
+        and Dataset(i.rpartition('/')[0]) not in complete_datasets]
+
+
+def _make_plan(
+        datasets: list[Dataset], subtree_roots: list[Dataset], prefix: str,
+        take_snapshot: bool,
+        send_targets: list[Dataset], send_base: str | None,
+        keep_specs: list[KeepSpec] | None, replicate: bool = False,
+        min_written: int | None = None,
+        max_snapshot_age: timedelta | None = None,
+        max_capacity: int | None = None, high_frequency: bool = False,
+        bookmark_keep_specs: list[KeepSpec] | None = None) \
+        -> Plan:
+    plan = Plan()
+
+    if take_snapshot:
+        now = datetime.now()
+        snapshot_name = make_snapshot_name(
+            prefix, now, milliseconds=high_frequency)
+
+        if min_written is None:
+            snapshot_datasets = datasets
+            snapshot_roots = subtree_roots
+        else:
+            snapshot_datasets = _get_changed_datasets(
+                datasets, prefix, now, min_written, max_snapshot_age)
+            snapshot_roots = _get_complete_subtree_roots(
+                datasets, subtree_roots, set(snapshot_datasets))
+
+        plan.snapshots = [Snapshot(i, snapshot_name) for i in snapshot_datasets]
+
+        # This keeps the length of the command line independent of the size of
+        # the subtrees.
+        plan.recursive_snapshots = \
+            [Snapshot(i, snapshot_name) for i in snapshot_roots]
+
+    # Snapshots are skipped on unchanged datasets, which the keep
+    # specifications need to take into account.
+    carry_over = min_written is not None
+
+    if keep_specs is not None:
+        # The most recent snapshot should never be deleted by this tool.
+        keep_specs = keep_specs + [MostRecentKeepSpec(1)]
+
+    if send_targets:
+        assert send_base is not None
+
+        _plan_send(
+            plan, datasets, subtree_roots, prefix, send_targets, send_base,
+            keep_specs, replicate, carry_over, max_capacity, high_frequency,
+            bookmark_keep_specs)
+    elif keep_specs is not None:
+        # Unlike when sending, all snapshots are kept in memory, because
+        # destroying them recursively and pruning by capacity need those of
+        # all datasets of a subtree or pool.
+        inventory = dict(iter_snapshots(datasets))
+
+        for snapshot in plan.snapshots:
+            table = inventory[snapshot.dataset]
+            table.append(snapshot.name, 0, _next_createtxg(table))
+
+        _plan_prune(
+            plan, inventory, keep_specs, prefix, subtree_roots, carry_over,
+            max_capacity)
+
+    return plan
+
+
+def _estimate_send_sizes(plan: Plan) -> None:
+    new_snapshots = set(plan.snapshots)
+    properties = get_properties(
+        [*(i.source for i in plan.all_sends
+           if any(j in new_snapshots for j in i.snapshots_to_send)),
+         *(j for i in plan.replications
+           if Snapshot(i.source, i.snapshots_to_send[-1]) in new_snapshots
+           for j in i.datasets)],
+        ['written', 'referenced'])
+
+    for i in plan.all_sends:
+        existing_snapshots = [
+            j for j in i.snapshots_to_send if j not in new_snapshots]
+
+        size = 0
+
+        # Two estimates per dataset: One for the first snapshot, which may be
+        # sent from a bookmark, and one for all the following snapshots.
+        if existing_snapshots:
+            size += estimate_send_size(
+                i.incremental_base, existing_snapshots[0])
+
+            if len(existing_snapshots) > 1:
+                size += estimate_send_size(
+                    existing_snapshots[0], existing_snapshots[-1],
+                    intermediates=True)
+
+        # Snapshots that don't exist yet will contain the data written since
+        # the most recent snapshot.
+        if len(existing_snapshots) < len(i.snapshots_to_send):
+            if existing_snapshots or i.incremental_base is not None:
+                size += int(properties[i.source]['written'])
+            else:
+                size += int(properties[i.source]['referenced'])
+
+        i.estimated_size = size
+
+    for step in plan.replications:
+        existing_names = [
+            j for j in step.snapshots_to_send
+            if Snapshot(step.source, j) not in new_snapshots]
+
+        size = 0
+
+        if existing_names:
+            if step.incremental_base is None:
+                incremental_base = None
+            else:
+                incremental_base = Snapshot(step.source, step.incremental_base)
+
+            size += estimate_send_size(
+                incremental_base, Snapshot(step.source, existing_names[-1]),
+                intermediates=True, replicate=True)
+
+        if len(existing_names) < len(step.snapshots_to_send):
+            if existing_names or step.incremental_base is not None:
+                size_property = 'written'
+            else:
+                size_property = 'referenced'
+
+            size += sum(
+                int(properties[j][size_property]) for j in step.datasets)
+
+        step.estimated_size = size
+
+
+# The expired snapshots of a dataset, and those destroyed recursively.
+_ExpiredSnapshots: TypeAlias = \
+    tuple[list[Snapshot | SnapshotRange], list[Snapshot]]
+
+
+def _group_expired_snapshots(plan: Plan) -> dict[Dataset, _ExpiredSnapshots]:
+    res: dict[Dataset, _ExpiredSnapshots] = {}
+
+    for i in plan.remaining_expired_snapshots:
+        res.setdefault(i.dataset, ([], []))[0].append(i)
+
+    for k in plan.expired_ranges:
+        res.setdefault(k.dataset, ([], []))[0].append(k)
+
+    for j in plan.recursive_expired_snapshots:
+        res.setdefault(j.dataset, ([], []))[1].append(j)
+
+    return res
+
+
+class _Pruner:
+    """
+    Destroys the expired snapshots of each dataset of a plan using a separate
+    operation in the background, as soon as it is requested, e.g. when the
+    snapshots have been sent to a target. Up to `prune_jobs` operations are
+    run concurrently on each pool. The executors are registered with `stack`,
+    so that leaving it waits for all operations.
+    """
+
+    def __init__(self, plan: Plan, prune_jobs: int, stack: ExitStack) -> None:
+        self._snapshots_by_dataset = _group_expired_snapshots(plan)
+        self._prune_jobs = prune_jobs
+        self._throttled_pools = set(plan.throttled_pools)
+        self._stack = stack
+        self._executors: dict[Dataset, ThreadPoolExecutor] = {}
+        self._futures: dict[Dataset, Future[None]] = {}
+
+    @property
+    def remaining_datasets(self) -> list[Dataset]:
+        """
+        The datasets with expired snapshots which haven't been pruned yet.
+        """
+        return list(self._snapshots_by_dataset)
+
+    def prune(self, datasets: Iterable[Dataset]) -> None:
+        """
+        Start destroying the expired snapshots of those datasets which have
+        any.
+        """
+        for dataset in datasets:
+            expired_snapshots = self._snapshots_by_dataset.pop(dataset, None)
+
+            if expired_snapshots is None:
+                continue
+
+            # Destroying snapshots mostly waits for the pool to sync, which is
+            # independent for each pool.
+            pool = get_pool_name(dataset)
+
+            if pool not in self._executors:
+                if pool in self._throttled_pools:
+                    max_workers = 1
+                else:
+                    max_workers = self._prune_jobs
+
+                self._executors[pool] = self._stack.enter_context(
+                    ThreadPoolExecutor(max_workers=max_workers))
+
+            self._futures[dataset] = self._executors[pool].submit(
+                destroy_snapshots, *expired_snapshots)
+
+    def wait(self) -> list[Dataset]:
+        """
+        Wait for all started operations, report those which failed and return
+        their datasets.
+        """
+        failed_datasets = []
+
+        for dataset, future in self._futures.items():
+            try:
+                future.result()
+            except CalledProcessError as e:
+                logging.error(
+                    f'Failed to destroy snapshots of {dataset}: '
+                    f'{format_cmdline(e.cmd)}')
+
+                failed_datasets.append(dataset)
+
+        return failed_datasets
+
+
+def _apply_scan_policy(plan: Plan, scan_policy: ScanPolicy) -> None:
+    """
+    Check whether any of the pools the plan sends from, sends to, or prunes
+    on are being scrubbed or resilvered, using a single operation. Depending
+    on `scan_policy`, sends and pruning on those pools are throttled, or the
+    affected sends and pruning are removed from the plan and reported as
+    deferred.
+    """
+    if scan_policy is ScanPolicy.ignore:
+        return
+
+    datasets = [
+        *(i.source for i in plan.all_sends),
+        *(i.target for i in plan.all_sends if not i.archive),
+        *(j for i in plan.replications for j in [i.source, i.target]),
+        *(i.dataset for i in plan.expired_snapshots)]
+
+    pools = list(dict.fromkeys(map(get_pool_name, datasets)))
+    scanning_pools = get_scanning_pools(pools) if pools else {}
+
+    for pool, scan in scanning_pools.items():
+        logging.warning(
+            f'Warning: A {scan} is in progress on pool {pool}.')
+
+    if scan_policy is ScanPolicy.throttle:
+        plan.throttled_pools = list(scanning_pools)
+
+        return
+
+    def is_affected(dataset: Dataset) -> bool:
+        return get_pool_name(dataset) in scanning_pools
+
+    # Sent datasets and targets whose pruning needs to wait for the send.
+    deferred_datasets: list[Dataset] = []
+    deferred_targets: set[Dataset] = set()
+    sends = []
+    fan_outs = []
+    replications = []
+
+    for i in plan.sends:
+        if is_affected(i.source) or not i.archive and is_affected(i.target):
+            deferred_datasets.append(i.source)
+            deferred_targets.add(i.target)
+        else:
+            sends.append(i)
+
+    for k in plan.fan_outs:
+        targets = [i.target for i in k.sends]
+
+        # The bookmarks of the source are shared by all targets.
+        if any(is_affected(i) for i in [k.source, *targets]):
+            deferred_datasets.append(k.source)
+            deferred_targets.update(targets)
+        else:
+            fan_outs.append(k)
+
+    for j in plan.replications:
+        if is_affected(j.source) or is_affected(j.target):
+            deferred_datasets.extend(j.datasets)
+            deferred_targets.update(j.targets)
+        else:
+            replications.append(j)
+
+    def is_deferred(dataset: Dataset) -> bool:
+        return is_affected(dataset) or dataset in deferred_targets
+
+    deferred_datasets.extend(
+        i.dataset for i in plan.expired_snapshots if is_deferred(i.dataset))
+
+    plan.sends = sends
+    plan.fan_outs = fan_outs
+    plan.replications = replications
+    plan.expired_snapshots = [
+        i for i in plan.expired_snapshots if not is_deferred(i.dataset)]
+    plan.expired_ranges = [
+        i for i in plan.expired_ranges if not is_deferred(i.dataset)]
+    plan.recursive_expired_snapshots = [
+        i for i in plan.recursive_expired_snapshots
+        if not is_deferred(i.dataset)]
+    plan.deferred_datasets = list(dict.fromkeys(deferred_datasets))
+
+    if plan.deferred_datasets:
+        logging.warning(
+            f'Warning: Deferring sending or pruning '
+            f'{len(plan.deferred_datasets)} dataset(s) until the scans have '
+            f'finished.')
+
+
+def _get_send_rate_limit(plan: Plan, datasets: list[Dataset]) -> int | None:
+    """
+    Return the rate limit of a send from or to the datasets, which is only
+    limited if any of them is on a throttled pool.
+    """
+    if any(get_pool_name(i) in plan.throttled_pools for i in datasets):
+        return throttled_send_rate
+
+    return None
+
+
+class SnapshotNameCollisionError(UserError):
+    pass
+
+
+def _rename_plan_snapshots(plan: Plan, name: str) -> None:
+    """
+    Rename the snapshots to create. Raise SnapshotNameCollisionError if the
+    plan already refers to other snapshots or bookmarks of the same name.
+    """
+    old_name = plan.snapshots[0].name
+
+    if name != old_name:
+        if name in plan.snapshot_names:
+            raise SnapshotNameCollisionError(
+                f'Snapshots named {name} already exist.')
+
+        plan.rename_snapshots(old_name, name)
+
+
+def _create_plan_snapshots(
+        plan: Plan, prefix: str, high_frequency: bool, rename: bool) -> None:
+    """
+    Create the snapshots of the plan. If `rename` is true, they are first
+    renamed to the current time.
+
+    If creating them fails, e.g. because the name has been used by a run in
+    the same second, or millisecond if `high_frequency` is true, it is retried
+    with a new name, without inspecting the datasets again.
+    """
+    if not plan.snapshots:
+        return
+
+    for attempt in range(1, _snapshot_attempts + 1):
+        try:
+            if rename or attempt > 1:
+                _rename_plan_snapshots(
+                    plan, make_snapshot_name(
+                        prefix, datetime.now(), milliseconds=high_frequency))
+
+            create_snapshots(plan.remaining_snapshots, plan.recursive_snapshots)
+            break
+        except (CalledProcessError, SnapshotNameCollisionError):
+            # Nothing has been created, as the backend creates the snapshots
+            # of each pool atomically and destroys those of the other pools
+            # again.
+            if attempt == _snapshot_attempts:
+                raise
+
+            logging.warning(
+                'Warning: Failed to create the snapshots. Retrying with a new '
+                'name.')
+
+            # Wait until the clock has advanced past the resolution of the
+            # snapshot names.
+            time.sleep(0.001 if high_frequency else 1)
+
+
+def execute_plan(plan: Plan, prune_jobs: int = 1) -> None:
+    """
+    Send and prune as planned, once the snapshots have been created.
+    """
+    failed_targets: list[Dataset] = []
+
+    with ExitStack() as stack:
+        pruner = _Pruner(plan, prune_jobs, stack)
+
+        try:
+            # Each target is pruned while the following datasets are sent.
+            for i in plan.sends:
+                execute_send(
+                    i, plan.checksum_streams,
+                    _get_send_rate_limit(plan, [i.source, i.target]))
+                pruner.prune([i.target])
+
+            for k in plan.fan_outs:
+                failed_fan_out_targets = execute_fan_out(
+                    k, plan.checksum_streams,
+                    _get_send_rate_limit(
+                        plan, [k.source, *(i.target for i in k.sends)]))
+                failed_targets.extend(failed_fan_out_targets)
+                pruner.prune(
+                    i.target for i in k.sends
+                    if i.target not in failed_fan_out_targets)
+
+            for j in plan.replications:
+                execute_replication(
+                    j, plan.checksum_streams,
+                    _get_send_rate_limit(plan, [j.source, j.target]))
+                pruner.prune(j.targets)
+
+            # Failed targets would be pruned as if they had received the
+            # snapshots.
+            pruner.prune(
+                i for i in pruner.remaining_datasets
+                if i not in failed_targets)
+        finally:
+            # When sending fails, the operations already started are still
+            # reported, before the error of sending is raised.
+            failed_datasets = pruner.wait()
+
+    if failed_datasets:
+        raise UserError(
+            f'Failed to destroy snapshots of {len(failed_datasets)} '
+            f'dataset(s).')
+
+    if failed_targets:
+        raise UserError(
+            f'Failed to send snapshots to {len(failed_targets)} target(s).')
+
+
+def _get_locked_datasets(
+        datasets: list[Dataset], recursive: bool, exclude: list[Dataset],
+        send_targets: list[Dataset], send_base: str | None) \
+        -> list[Dataset]:
+    """
+    Return the datasets whose subtrees need to be locked to operate on the
+    specified datasets and their send targets, without listing any datasets.
+    """
+    roots = DatasetSelector(datasets, exclude, recursive).roots
+
+    if not send_targets:
+        return roots
+
+    assert send_base is not None
+
+    # A pattern may select datasets above the send base, which are rejected
+    # later. Locking the whole target is good enough until then.
+    targets = [
+        _get_send_target(i, j, send_base) if i.startswith(send_base) else j
+        for j in send_targets for i in roots]
+
+    return [*roots, *targets]
 
 
 def cli_command(
         *, datasets: list[Dataset], recursive: bool, exclude: list[Dataset],
         prefix: str | None, take_snapshot: bool,
         pre_snapshot_script: str | None, keep_specs: list[KeepSpec] | None,
-        send_target: Dataset | None, send_base: Dataset | None,
-        do_snapshot: bool, do_send: bool) \
-        -> None:
-    if prefix is None:
-        prefix = default_snapshot_name_prefix
+        send_targets: list[Dataset], send_base: Dataset | None,
+        do_snapshot: bool, do_send: bool, dry_run: bool = False,
+        snapshot_hooks: Sequence[SnapshotHook] = (), replicate: bool = False,
+        checksum_streams: bool = False, min_written: int | None = None,
+        max_snapshot_age: timedelta | None = None,
+        max_capacity: int | None = None, high_frequency: bool = False,
+        bookmark_keep_specs: list[KeepSpec] | None = None,
+        scan_policy: ScanPolicy = ScanPolicy.ignore,
+        lock_timeout: float | None = None, skip_if_busy: bool = False,
+        prune_jobs: int = default_prune_jobs) \
+        -> Plan:
+    """
+    Plan and execute the operations. If `dry_run` is true, only the plan is
+    made, including estimates of the sizes of the sent data.
 
-    if do_snapshot and pre_snapshot_script is not None:
-        _run_script(pre_snapshot_script)
+    If the name of the new snapshots is already used, e.g. by a run in the
+    same second, or millisecond if `high_frequency` is true, creating them is
+    retried with a new name.
 
-    selected_datasets = _get_selected_datasets(datasets, recursive, exclude)
-
-    if do_snapshot and take_snapshot:
-        _snapshot(selected_datasets, prefix)
+    The affected datasets are locked while doing so. If `skip_if_busy` is
+    true and the locks can't be acquired within `lock_timeout` seconds
+    (immediately, if None), nothing is done and an empty plan is returned.
+    """
+    if prefix is None:
+        prefix = default_snapshot_name_prefix
 
     # Depending on whether we have a send target or not, pruning is disabled by
     # setting one of the `do_*` flags to False.
-    if send_target is None:
+    if not send_targets:
         do_prune = do_snapshot
     else:
         do_prune = do_send
@@ -157,28 +1183,125 @@ def cli_command(
             # source dataset is used as the base.
             send_base, = datasets
 
-        if do_send:
-            _send(selected_datasets, prefix, send_target, send_base)
+            if is_pattern(send_base):
+                raise UserError(
+                    'A send base is required when selecting datasets using a '
+                    'pattern.')
 
-        # We want to prune snapshots on the target datasets when sending
-        # snapshots.
-        selected_datasets = [
-            _get_send_target(i, send_target, send_base)
-            for i in selected_datasets]
+        if any(is_archive_target(i) for i in send_targets) \
+                and (keep_specs or replicate or len(send_targets) > 1):
+            raise UserError(
+                'Pruning, replication streams and multiple targets are not '
+                'supported when sending to a directory.')
 
-    if do_prune and keep_specs is not None:
-        _prune(selected_datasets, prefix, keep_specs)
+        if replicate and len(send_targets) > 1:
+            raise UserError(
+                'Replication streams are not supported with multiple send '
+                'targets.')
 
+    if not do_send:
+        send_targets = []
 
-def auto_command(
-        config_path: Path | None, auto_actions: Sequence[AutoAction]) \
+    locked_datasets = _get_locked_datasets(
+        datasets, recursive, exclude, send_targets, send_base)
+
+    if skip_if_busy and lock_timeout is None:
+        lock_timeout = 0
+
+    # A dry run only needs to prevent other runs from making changes while the
+    # datasets are inspected.
+    if dry_run:
+        locks = lock_datasets([], locked_datasets, lock_timeout)
+    else:
+        locks = lock_datasets(locked_datasets, [], lock_timeout)
+
+    try:
+        with locks:
+            selected_datasets, subtree_roots = \
+                _get_selected_datasets(datasets, recursive, exclude)
+
+            plan = _make_plan(
+                selected_datasets, subtree_roots, prefix,
+                take_snapshot=do_snapshot and take_snapshot,
+                send_targets=send_targets,
+                send_base=send_base,
+                keep_specs=keep_specs if do_prune else None,
+                replicate=replicate,
+                min_written=min_written,
+                max_snapshot_age=max_snapshot_age,
+                max_capacity=max_capacity,
+                high_frequency=high_frequency,
+                bookmark_keep_specs=bookmark_keep_specs)
+
+            plan.checksum_streams = checksum_streams
+            _apply_scan_policy(plan, scan_policy)
+
+            if not dry_run:
+                snapshot_datasets = {i.dataset for i in plan.snapshots}
+                hooks = [
+                    i for i in snapshot_hooks if i.dataset in snapshot_datasets]
+                run_script = do_snapshot and pre_snapshot_script is not None
+
+                # Run the script only after planning, so that the time between
+                # the script and taking the snapshots is as short as possible.
+                if do_snapshot and pre_snapshot_script is not None:
+                    _run_script(pre_snapshot_script)
+
+                # The datasets stay frozen while retrying with a new name.
+                with freeze_datasets(hooks):
+                    # The name reflects when the snapshots are taken, not when
+                    # the script and hooks started running.
+                    _create_plan_snapshots(
+                        plan, prefix, high_frequency,
+                        rename=run_script or bool(hooks))
+
+            if dry_run:
+                _estimate_send_sizes(plan)
+            else:
+                execute_plan(plan, prune_jobs)
+    except LockTimeoutError as e:
+        if not skip_if_busy:
+            raise
+
+        logging.info(f'Skipping: {e}')
+
+        return Plan()
+
+    return plan
+
+
+def restore_command(
+        directory: Path, target: Dataset, lock_timeout: float | None = None) \
         -> None:
-    if config_path is None:
-        config_path = get_default_config_path()
+    """
+    Receive the snapshots archived in `directory` into `target`.
+    """
+    with lock_datasets([target], [], lock_timeout):
+        restore_archive(directory, target)
+
+
+def auto_command(
+        config_path: Path | None, auto_actions: Sequence[AutoAction],
+        dry_run: bool = False, lock_timeout: float | None = None,
+        skip_if_busy: bool = False, prune_jobs: int = default_prune_jobs,
+        property_roots: list[Dataset] | None = None) \
+        -> list[Plan]:
+    """
+    Run the entries of the config file at `config_path`, or, if
+    `property_roots` is given, those read from the user properties of these
+    datasets and their descendants.
+    """
+    if property_roots is not None:
+        config = load_property_config(property_roots)
+    else:
+        if config_path is None:
+            config_path = get_default_config_path()
 
-    config = load_config(config_path)
+        config = load_config(config_path)
 
-    for i in config.snapshot:
+    # Each entry is planned only after the previous one has been executed, as
+    # they might affect the same datasets.
+    return [
         cli_command(
             datasets=i.datasets,
             recursive=i.recursive,
@@ -186,8 +1309,22 @@ def auto_command(
             prefix=i.prefix,
             take_snapshot=i.take_snapshot,
             pre_snapshot_script=i.pre_snapshot_script,
+            snapshot_hooks=i.snapshot_hooks,
             keep_specs=i.prune_keep,
-            send_target=i.send_target,
+            send_targets=i.send_target or [],
             send_base=i.send_base,
+            replicate=i.replicate,
+            checksum_streams=i.checksum_streams,
+            min_written=i.min_written,
+            max_snapshot_age=i.max_snapshot_age,
+            max_capacity=i.max_capacity,
+            high_frequency=i.high_frequency,
+            bookmark_keep_specs=i.bookmark_keep,
+            scan_policy=i.on_scan,
             do_snapshot=AutoAction.snapshot in auto_actions,
-            do_send=AutoAction.send in auto_actions)
+            do_send=AutoAction.send in auto_actions,
+            dry_run=dry_run,
+            lock_timeout=lock_timeout,
+            skip_if_busy=skip_if_busy,
+            prune_jobs=prune_jobs)
+        for i in config.snapshot]
@@ -1,68 +1,113 @@
 from __future__ import annotations
 
+import math
 from datetime import datetime
-from typing import Sequence
 
 from snappy.config import KeepSpec, IntervalKeepSpec
-from snappy.utils import timestamp_format
-from snappy.zfs import Snapshot, SnapshotInfo
+from snappy.utils import timestamp_format, datetime_to_seconds
+from snappy.zfs import SnapshotTable, SnapshotOrBookmarkT
 
 
 # Using this day, because that year incidentally starts with a monday.
-_keep_interval_time_base = datetime(2001, 1, 1)
+_keep_interval_time_base = datetime_to_seconds(datetime(2001, 1, 1))
 
 
-def make_snapshot_name(prefix: str, timestamp: datetime) -> str:
-    return f'{prefix}-{timestamp:{timestamp_format}}'
+def make_snapshot_name(
+        prefix: str, timestamp: datetime, milliseconds: bool = False) \
+        -> str:
+    name = f'{prefix}-{timestamp:{timestamp_format}}'
 
+    if milliseconds:
+        name += f'.{timestamp.microsecond // 1000:03}'
 
-def parse_snapshot_name(name: str, prefix: str) -> datetime | None:
-    full_prefix = f'{prefix}-'
+    return name
 
-    if not name.startswith(full_prefix):
-        return None
 
-    timestamp_str = name.removeprefix(full_prefix)
+def _select_per_interval(
+        snapshots_with_timestamps: list[tuple[int, float]], interval: float,
+        count: int | None, carry_over: bool) \
+        -> list[int]:
+    """
+    Select the oldest snapshot within each interval, newest interval first,
+    for up to `count` intervals.
 
-    try:
-        return datetime.strptime(timestamp_str, timestamp_format)
-    except ValueError:
-        return None
+    If `carry_over` is true, intervals without a snapshot are counted as
+    well, and are represented by the most recent snapshot before them.
+    """
+    # Because we're iterating form newest to the oldest snapshot, this will
+    # keep the oldest snapshot within each bucket defined by the keep
+    # specification.
+    first_in_bucket: dict[float, int] = {}
+    last_in_bucket: dict[float, int] = {}
 
+    for s, t in snapshots_with_timestamps:
+        bucket = (t - _keep_interval_time_base) // interval
+        first_in_bucket[bucket] = s
+        last_in_bucket.setdefault(bucket, s)
 
-def find_expired_snapshots(
-        snapshots: Sequence[SnapshotInfo], keep_specs: list[KeepSpec],
-        prefix: str) \
-        -> set[Snapshot]:
-    snapshots_with_timestamps: list[tuple[Snapshot, datetime]] = []
+    if not carry_over:
+        return list(first_in_bucket.values())[:count]
 
-    # Sort the list from newest to oldest so that we keep newer snapshots before
-    # older ones.
-    for i in sorted(snapshots, key=lambda x: x.createtxg, reverse=True):
-        timestamp = parse_snapshot_name(i.ref.name, prefix)
+    selected_snapshots = []
+    remaining_count = math.inf if count is None else count
+    newer_bucket = None
+
+    for bucket, s in first_in_bucket.items():
+        if newer_bucket is not None and remaining_count > 0:
+            empty_buckets = newer_bucket - bucket - 1
+
+            if empty_buckets:
+                selected_snapshots.append(last_in_bucket[bucket])
+                remaining_count -= empty_buckets
+
+        if remaining_count <= 0:
+            break
+
+        selected_snapshots.append(s)
+        remaining_count -= 1
+        newer_bucket = bucket
 
-        if timestamp is not None:
-            snapshots_with_timestamps.append((i.ref, timestamp))
+    return selected_snapshots
 
-    def get_selected_snapshots(spec: KeepSpec) -> list[Snapshot]:
+
+def find_expired_snapshots(
+        snapshots: SnapshotTable[SnapshotOrBookmarkT],
+        keep_specs: list[KeepSpec], prefix: str, carry_over: bool = False) \
+        -> set[SnapshotOrBookmarkT]:
+    """
+    Return the snapshots (or bookmarks) with the prefix which are not selected
+    by any of the keep specifications.
+
+    If `carry_over` is true, snapshots are assumed to have been skipped when
+    the dataset had not changed. The interval specifications then select the
+    snapshots as if a snapshot had been created in each interval since the
+    oldest one.
+    """
+    # Indices and timestamps of the snapshots with the right prefix.
+    snapshots_with_timestamps: list[tuple[int, float]] = []
+
+    # Iterate from newest to oldest so that we keep newer snapshots before
+    # older ones.
+    for i in sorted(
+            range(len(snapshots)), key=snapshots.createtxgs.__getitem__,
+            reverse=True):
+        if snapshots.has_prefix(i, prefix):
+            snapshots_with_timestamps.append((i, snapshots.timestamp(i)))
+
+    def get_selected_snapshots(spec: KeepSpec) -> list[int]:
         # Select a subset of snapshots unless we're using a
         # MostRecentKeepSpec.
         if isinstance(spec, IntervalKeepSpec):
-            # Because we're iterating form newest to the oldest snapshot, this
-            # will keep the oldest snapshot within each bucket defined by the
-            # keep specification.
-            first_in_bucket = {
-                (t - _keep_interval_time_base) // spec.interval: s
-                for s, t in snapshots_with_timestamps}
-
-            selected_snapshots = list(first_in_bucket.values())
-        else:
-            selected_snapshots = [s for s, _ in snapshots_with_timestamps]
+            return _select_per_interval(
+                snapshots_with_timestamps, spec.interval.total_seconds(),
+                spec.count, carry_over)
 
-        return selected_snapshots[:spec.count]
+        return [s for s, _ in snapshots_with_timestamps][:spec.count]
 
     all_selected_snapshots = {
         snapshot for keep_spec in keep_specs
         for snapshot in get_selected_snapshots(keep_spec)}
 
-    return {s for s, _ in snapshots_with_timestamps} - all_selected_snapshots
+    return {
+        snapshots.ref(s) for s, _ in snapshots_with_timestamps
+        if s not in all_selected_snapshots}
@@ -1,17 +1,101 @@
+import io
+import re
 import shlex
 import textwrap
+import time
+import zlib
 from argparse import HelpFormatter
-from subprocess import check_call
-from typing import Any
+from contextlib import contextmanager, ExitStack
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from subprocess import check_call, Popen, PIPE, CalledProcessError
+from typing import Any, Generator, Iterator, IO, TypeAlias
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 
 timestamp_format = '%Y-%m-%d-%H%M%S'
 
+# Maximum length of a single command line argument on Linux (MAX_ARG_STRLEN),
+# including the terminating null byte.
+max_arg_length = 128 * 1024
+
+# Size of the buffer used to relay send streams. Large enough that the
+# overhead per read and write is negligible.
+_relay_buffer_size = 1024 * 1024
+
+# Matches names of the form `<prefix>-<timestamp>` using the format above,
+# optionally followed by milliseconds, e.g. `.123`.
+_timestamped_name_re = re.compile(
+    '(.*)-([0-9]{4})-([0-9]{2})-([0-9]{2})-([0-9]{2})([0-9]{2})([0-9]{2})'
+    '(?:\\.([0-9]{3}))?')
+
 
 class UserError(Exception):
     pass
 
 
+def datetime_to_seconds(timestamp: datetime) -> float:
+    """
+    Convert a naive datetime into a number of seconds, treating it as if it
+    were in UTC. Only used to compare and bucket timestamps.
+    """
+    return timestamp.replace(tzinfo=timezone.utc).timestamp()
+
+
+def split_timestamped_name(name: str) -> tuple[str, float] | None:
+    """
+    Split a name consisting of a prefix and a timestamp into the prefix and
+    the timestamp, converted using `datetime_to_seconds()`. Return None if the
+    name does not end in a valid timestamp.
+    """
+    match = _timestamped_name_re.fullmatch(name)
+
+    if match is None:
+        return None
+
+    prefix, *fields, milliseconds_str = match.groups()
+    year, month, day, hour, minute, second = map(int, fields)
+    milliseconds = int(milliseconds_str or 0)
+
+    try:
+        timestamp = datetime(
+            year, month, day, hour, minute, second, milliseconds * 1000)
+    except ValueError:
+        return None
+
+    return prefix, datetime_to_seconds(timestamp)
+
+
+def format_size(size: int) -> str:
+    """
+    Format a number of bytes the way the `zfs` command does, e.g. `1.40G'.
+    """
+    if size < 1024:
+        return f'{size}B'
+
+    for exponent, unit in enumerate('KMGTPE', 1):
+        if size < 1024 ** (exponent + 1):
+            break
+
+    value = size / 1024 ** exponent
+
+    if size % 1024 ** exponent == 0:
+        return f'{size // 1024 ** exponent}{unit}'
+
+    # Use at most 3 significant digits.
+    for digits in [2, 1, 0]:
+        value_str = f'{value:.{digits}f}'
+
+        if len(value_str) <= 4:
+            break
+
+    return f'{value_str}{unit}'
+
+
 def _wrap_paragraphs(text: str, width: int, indent: str) -> list[str]:
     """
     Wrapper around `textwrap.wrap()` which keeps newlines in the input string
@@ -41,6 +125,44 @@ class BetterHelpFormatter(HelpFormatter):
         return '\n'.join(_wrap_paragraphs(text, width, indent))
 
 
+def chunk_joined_args(
+        items: list[str], separator: str, prefix_length: int = 0) \
+        -> Iterator[list[str]]:
+    """
+    Split `items` into chunks, so that each chunk, when joined using
+    `separator` and appended to a prefix of length `prefix_length`, fits into a
+    single command line argument.
+    """
+    chunk: list[str] = []
+    length = prefix_length + 1
+
+    for i in items:
+        item_length = len(i.encode()) + len(separator.encode()) * bool(chunk)
+
+        if chunk and length + item_length > max_arg_length:
+            yield chunk
+
+            chunk = []
+            length = prefix_length + 1
+            item_length = len(i.encode())
+
+        chunk.append(i)
+        length += item_length
+
+    if chunk:
+        yield chunk
+
+
+def format_cmdline(cmdline: Any) -> str:
+    """
+    Format the command line of a CalledProcessError for error messages.
+    """
+    if isinstance(cmdline, (str, bytes)):
+        return str(cmdline)
+
+    return shlex.join(map(str, cmdline))
+
+
 def check_call_pipeline(*cmdlines: list[str], **kwargs: Any) -> None:
     """
     subprocess.check_call() for pipelines. Each element of cmdlines is a list
@@ -48,3 +170,271 @@ def check_call_pipeline(*cmdlines: list[str], **kwargs: Any) -> None:
     processes are joined in a pipeline.
     """
     check_call(' | '.join(shlex.join(i) for i in cmdlines), shell=True, **kwargs)
+
+
+class _Crc32:
+    """
+    Same interface as the hash objects of `hashlib` and `xxhash`.
+    """
+    name = 'crc32'
+
+    def __init__(self) -> None:
+        self._value = 0
+
+    def update(self, data: bytes | memoryview) -> None:
+        self._value = zlib.crc32(data, self._value)
+
+    def hexdigest(self) -> str:
+        return f'{self._value:08x}'
+
+
+class _Xxh3:
+    name = 'xxh3'
+
+    def __init__(self) -> None:
+        self._hash = xxhash.xxh3_64()
+
+    def update(self, data: bytes | memoryview) -> None:
+        self._hash.update(data)
+
+    def hexdigest(self) -> str:
+        return str(self._hash.hexdigest())
+
+
+Hasher: TypeAlias = _Crc32 | _Xxh3
+
+
+@dataclass(frozen=True)
+class StreamChecksum:
+    algorithm: str
+    value: str
+    size: int
+
+    def __str__(self) -> str:
+        return f'{self.algorithm}:{self.value}:{self.size}'
+
+
+def create_hasher(algorithm: str | None = None) -> Hasher:
+    """
+    Return a hash object for the named algorithm, or for the fastest
+    available one if `algorithm` is None.
+    """
+    if algorithm is None:
+        algorithm = 'crc32' if xxhash is None else 'xxh3'
+
+    if algorithm == 'crc32':
+        return _Crc32()
+    elif algorithm == 'xxh3':
+        if xxhash is None:
+            raise UserError(
+                'Checksums using xxh3 require the xxhash module, which is not '
+                'installed.')
+
+        return _Xxh3()
+    else:
+        raise UserError(f'Unknown checksum algorithm `{algorithm}\'.')
+
+
+def write_all(file: IO[bytes], data: bytes | memoryview) -> None:
+    """
+    Write all of `data` to an unbuffered file, which may accept only part of
+    it at a time.
+    """
+    while data:
+        data = memoryview(data)[file.write(data) or 0:]
+
+
+def _limit_rate(start: float, size: int, rate_limit: int | None) -> None:
+    """
+    Wait until relaying `size` bytes since `start` doesn't exceed `rate_limit`
+    bytes per second, if it is not None.
+    """
+    if rate_limit is not None:
+        delay = start + size / rate_limit - time.monotonic()
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+def check_call_relay(
+        source_cmdline: list[str], sink_cmdline: list[str], *,
+        checksum: bool, rate_limit: int | None = None) \
+        -> StreamChecksum | None:
+    """
+    Like check_call_pipeline() with two commands, but the data is passed
+    through this process, to count the bytes and compute a checksum, which is
+    returned if `checksum` is true. Unlike with a shell pipeline, a failure of
+    either process is reported. If `rate_limit` is not None, the data is
+    relayed at no more than that many bytes per second.
+    """
+    hasher = create_hasher() if checksum else None
+    buffer = bytearray(_relay_buffer_size)
+    view = memoryview(buffer)
+    size = 0
+    sink_failed = False
+    start = time.monotonic()
+
+    # Unbuffered, so that the data is read into and written from the same
+    # buffer, without copying it.
+    with Popen(source_cmdline, stdout=PIPE, bufsize=0) as source_process, \
+            Popen(sink_cmdline, stdin=PIPE, bufsize=0) as sink_process:
+        assert isinstance(source_process.stdout, io.FileIO)
+        assert isinstance(sink_process.stdin, io.FileIO)
+
+        try:
+            while length := source_process.stdout.readinto(buffer):
+                if hasher is not None:
+                    hasher.update(view[:length])
+                write_all(sink_process.stdin, view[:length])
+                size += length
+                _limit_rate(start, size, rate_limit)
+
+            sink_process.stdin.close()
+        except BrokenPipeError:
+            # The sink exited early, there's no use in producing more data.
+            sink_failed = True
+            source_process.kill()
+
+    processes = [(source_process, source_cmdline), (sink_process, sink_cmdline)]
+
+    # If the sink exited early, the source has been killed because of that.
+    if sink_failed:
+        processes.reverse()
+
+    for process, cmdline in processes:
+        if process.returncode:
+            raise CalledProcessError(process.returncode, cmdline)
+
+    if hasher is None:
+        return None
+
+    return StreamChecksum(hasher.name, hasher.hexdigest(), size)
+
+
+def check_call_fan_out(
+        source_cmdline: list[str], sink_cmdlines: list[list[str]], *,
+        checksum: bool, rate_limit: int | None = None) \
+        -> tuple[StreamChecksum | None, list[CalledProcessError | None]]:
+    """
+    Like check_call_relay(), but the data is passed to several sinks. Each
+    block is read from the source once and written to all sinks from the same
+    buffer. A sink that fails doesn't affect the others, instead of raising an
+    exception, the errors of the sinks are returned, with None for each sink
+    which succeeded. The checksum is only computed if `checksum` is true.
+    `rate_limit` limits the rate like with check_call_relay().
+
+    Raises CalledProcessError if the source fails.
+    """
+    hasher = create_hasher() if checksum else None
+    buffer = bytearray(_relay_buffer_size)
+    view = memoryview(buffer)
+    size = 0
+    source_killed = False
+    start = time.monotonic()
+
+    with ExitStack() as stack:
+        source_process = stack.enter_context(
+            Popen(source_cmdline, stdout=PIPE, bufsize=0))
+        sink_processes = [
+            stack.enter_context(Popen(i, stdin=PIPE, bufsize=0))
+            for i in sink_cmdlines]
+
+        assert isinstance(source_process.stdout, io.FileIO)
+
+        # The sinks which are still reading.
+        active_sinks = list(sink_processes)
+
+        while active_sinks \
+                and (length := source_process.stdout.readinto(buffer)):
+            if hasher is not None:
+                hasher.update(view[:length])
+
+            for process in list(active_sinks):
+                assert isinstance(process.stdin, io.FileIO)
+
+                try:
+                    write_all(process.stdin, view[:length])
+                except BrokenPipeError:
+                    active_sinks.remove(process)
+
+            size += length
+            _limit_rate(start, size, rate_limit)
+
+        for process in active_sinks:
+            assert process.stdin is not None
+            process.stdin.close()
+
+        if not active_sinks:
+            # All sinks exited early, there's no use in producing more data.
+            source_killed = True
+            source_process.kill()
+
+    if source_process.returncode and not source_killed:
+        raise CalledProcessError(source_process.returncode, source_cmdline)
+
+    errors = [
+        CalledProcessError(process.returncode, cmdline)
+        if process.returncode else None
+        for process, cmdline in zip(sink_processes, sink_cmdlines)]
+
+    if hasher is None:
+        return None, errors
+
+    return StreamChecksum(hasher.name, hasher.hexdigest(), size), errors
+
+
+def iter_output_lines(cmdline: list[str], **kwargs: Any) \
+        -> Generator[str, None, None]:
+    """
+    Like subprocess.check_output(), but yields the lines of the output as they
+    are read instead of reading the whole output into memory.
+    """
+    with Popen(cmdline, stdout=PIPE, text=True, **kwargs) as process:
+        assert process.stdout is not None
+
+        try:
+            for line in process.stdout:
+                yield line.removesuffix('\n')
+        except GeneratorExit:
+            # Don't wait for the process to write output no one is reading.
+            process.kill()
+            raise
+
+    if process.returncode:
+        raise CalledProcessError(process.returncode, cmdline)
+
+
+@contextmanager
+def open_process_pipe(cmdline: list[str], *, write: bool) \
+        -> Iterator[IO[bytes]]:
+    """
+    Start a process and yield an unbuffered pipe connected to its stdin, if
+    `write` is true, or its stdout otherwise. Like subprocess.check_call(),
+    raise CalledProcessError if the process fails. The process is killed if
+    the caller raises an exception.
+    """
+    if write:
+        process = Popen(cmdline, stdin=PIPE, bufsize=0)
+        pipe = process.stdin
+    else:
+        process = Popen(cmdline, stdout=PIPE, bufsize=0)
+        pipe = process.stdout
+
+    assert pipe is not None
+
+    with process:
+        try:
+            yield pipe
+        except BrokenPipeError as e:
+            # The process exited before reading everything, report its exit
+            # code instead.
+            if process.wait():
+                raise CalledProcessError(process.returncode, cmdline) from e
+
+            raise
+        except BaseException:
+            process.kill()
+            raise
+
+    if process.returncode:
+        raise CalledProcessError(process.returncode, cmdline)
@@ -1,12 +1,24 @@
 from __future__ import annotations
 
+import itertools
 import logging
+import math
+import re
+import sys
 import time
+from array import array
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
 from dataclasses import dataclass
+from enum import Enum
 from subprocess import check_call, check_output, DEVNULL, CalledProcessError
-from typing import NewType, Iterable, TypeAlias, TypeVar, Generic, Sequence
+from typing import NewType, Iterable, TypeAlias, TypeVar, Generic, Sequence, \
+    Iterator, overload, ContextManager, IO
 
-from snappy.utils import check_call_pipeline
+from snappy.test_utils import mockable_fn
+from snappy.utils import check_call_pipeline, iter_output_lines, \
+    split_timestamped_name, chunk_joined_args, format_size, check_call_relay, \
+    StreamChecksum, open_process_pipe, check_call_fan_out
 
 
 # Sadly a misnomer as this is only used to refer to filesystems and volumes, but
@@ -15,7 +27,7 @@ from snappy.utils import check_call_pipeline
 Dataset = NewType('Dataset', str)
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Snapshot:
     dataset: Dataset
     name: str
@@ -24,7 +36,7 @@ class Snapshot:
         return f'{self.dataset}@{self.name}'
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Bookmark:
     dataset: Dataset
     name: str
@@ -33,6 +45,36 @@ class Bookmark:
         return f'{self.dataset}#{self.name}'
 
 
+@dataclass(frozen=True)
+class SnapshotRange:
+    """
+    Consecutive snapshots of a dataset, without any other snapshots created
+    between them, referred to using the `first%last` syntax.
+    """
+    dataset: Dataset
+    names: tuple[str, ...]
+
+    @property
+    def name(self) -> str:
+        return f'{self.names[0]}%{self.names[-1]}'
+
+    @property
+    def snapshots(self) -> list[Snapshot]:
+        return [Snapshot(self.dataset, i) for i in self.names]
+
+    def __str__(self) -> str:
+        return f'{self.dataset}@{self.name}'
+
+
+@dataclass(frozen=True)
+class InheritedProperty:
+    value: str
+
+    # The dataset on which the property is set, the dataset itself or one of
+    # its ancestors.
+    source: Dataset
+
+
 SnapshotOrBookmarkT = \
     TypeVar('SnapshotOrBookmarkT', Snapshot, Bookmark, covariant=True)
 
@@ -48,139 +90,1016 @@ SnapshotInfo: TypeAlias = _Info[Snapshot]
 BookmarkInfo: TypeAlias = _Info[Bookmark]
 
 
-def rename_dataset(dataset: Dataset, new_name: Dataset) -> None:
-    # Renaming often fails with `cannot unmount '...': unmount failed`. Retry a
-    # bunch of times to get around this.
-    for _ in range(5):
-        try:
-            check_call(['zfs', 'rename', '--', dataset, new_name])
-        except CalledProcessError as e:
-            error = e
-            time.sleep(1)
-        else:
+class SnapshotTable(Sequence[_Info[SnapshotOrBookmarkT]]):
+    """
+    The snapshots or bookmarks of a single dataset, stored column-wise to keep
+    memory usage low when there are a lot of them. Indexing and iterating
+    produce `_Info` instances on the fly.
+
+    The timestamps parsed from the names as well as the indexes used to look
+    up entries by guid and name are only built when first used.
+    """
+
+    __slots__ = (
+        'dataset', '_ref_type', 'names', 'guids', 'createtxgs', '_prefixes',
+        '_timestamps', '_guid_index', '_name_index')
+
+    def __init__(
+            self, ref_type: type[SnapshotOrBookmarkT], dataset: Dataset) \
+            -> None:
+        self.dataset = dataset
+        self._ref_type: type[SnapshotOrBookmarkT] = ref_type
+        self.names: list[str] = []
+        self.guids = array('Q')
+        self.createtxgs = array('Q')
+        self._prefixes: list[str | None] | None = None
+        self._timestamps: array[float] | None = None
+        self._guid_index: dict[int, int] | None = None
+        self._name_index: dict[str, int] | None = None
+
+    def append(self, name: str, guid: int, createtxg: int) -> None:
+        # Snapshots created recursively have the same name on many datasets.
+        self.names.append(sys.intern(name))
+        self.guids.append(guid)
+        self.createtxgs.append(createtxg)
+        self._invalidate()
+
+    def sort(self) -> None:
+        """
+        Sort the entries by createtxg.
+        """
+        order = sorted(range(len(self)), key=self.createtxgs.__getitem__)
+
+        self.names = [self.names[i] for i in order]
+        self.guids = array('Q', (self.guids[i] for i in order))
+        self.createtxgs = array('Q', (self.createtxgs[i] for i in order))
+        self._invalidate()
+
+    def truncate(self, length: int) -> None:
+        """
+        Remove all entries after the first `length` entries.
+        """
+        del self.names[length:]
+        del self.guids[length:]
+        del self.createtxgs[length:]
+        self._invalidate()
+
+    def _invalidate(self) -> None:
+        self._prefixes = None
+        self._timestamps = None
+        self._guid_index = None
+        self._name_index = None
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @overload
+    def __getitem__(self, index: int) -> _Info[SnapshotOrBookmarkT]:
+        ...
+
+    @overload
+    def __getitem__(self, index: slice) -> list[_Info[SnapshotOrBookmarkT]]:
+        ...
+
+    def __getitem__(self, index: int | slice) \
+            -> _Info[SnapshotOrBookmarkT] | list[_Info[SnapshotOrBookmarkT]]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(len(self))[index]]
+
+        return _Info(self.ref(index), self.guids[index], self.createtxgs[index])
+
+    def ref(self, index: int) -> SnapshotOrBookmarkT:
+        return self._ref_type(self.dataset, self.names[index])
+
+    def find_guid(self, guid: int) -> int | None:
+        """
+        Return the index of the most recent entry with the specified guid.
+        """
+        if self._guid_index is None:
+            self._guid_index = {x: i for i, x in enumerate(self.guids)}
+
+        return self._guid_index.get(guid)
+
+    def find_name(self, name: str) -> int | None:
+        if self._name_index is None:
+            self._name_index = {x: i for i, x in enumerate(self.names)}
+
+        return self._name_index.get(name)
+
+    def _parse_names(self) -> None:
+        self._prefixes = []
+        self._timestamps = array('d')
+
+        for i in self.names:
+            parsed = split_timestamped_name(i)
+
+            if parsed is None:
+                self._prefixes.append(None)
+                self._timestamps.append(math.nan)
+            else:
+                prefix, timestamp = parsed
+                self._prefixes.append(sys.intern(prefix))
+                self._timestamps.append(timestamp)
+
+    def has_prefix(self, index: int, prefix: str) -> bool:
+        """
+        Return whether the name of the entry consists of the specified prefix
+        and a timestamp.
+        """
+        if self._prefixes is None:
+            self._parse_names()
+            assert self._prefixes is not None
+
+        return self._prefixes[index] == prefix
+
+    def timestamp(self, index: int) -> float:
+        """
+        Return the timestamp from the entry's name in seconds since the epoch,
+        or NaN if the name does not contain a timestamp.
+        """
+        if self._timestamps is None:
+            self._parse_names()
+            assert self._timestamps is not None
+
+        return self._timestamps[index]
+
+
+def get_pool_name(dataset: Dataset) -> Dataset:
+    return Dataset(dataset.split('/', 1)[0])
+
+
+# Types of datasets whose properties are read by `get_inherited_properties()`.
+# Snapshots and bookmarks inherit user properties too, but aren't configured
+# separately.
+property_dataset_types = ['filesystem', 'volume']
+
+
+def iter_parents(dataset: Dataset) -> Iterator[Dataset]:
+    """
+    Yield the dataset itself and all its ancestors.
+    """
+    while True:
+        yield dataset
+
+        if '/' not in dataset:
             break
-    else:
-        raise error
 
+        dataset = Dataset(dataset.rsplit('/', 1)[0])
 
-def create_snapshots(snapshots: list[Snapshot]) -> None:
-    snapshot_args = [str(i) for i in snapshots]
 
-    logging.info(f'Creating snapshots: {", ".join(snapshot_args)}')
-    check_call(['zfs', 'snapshot', '--', *snapshot_args])
+class ZfsBackend(ABC):
+    """
+    The operations snappy performs on ZFS datasets. Operations which take a
+    list of snapshots or bookmarks may be passed items from multiple datasets
+    and pools. Implementations are free to split such a list into multiple
+    operations where the underlying interface can't handle it at once.
 
+    Errors are reported by raising `CalledProcessError`, regardless of whether
+    an actual process was involved, so that callers can handle them uniformly.
+    """
 
-def create_bookmark(snapshot: Snapshot, bookmark: Bookmark) -> None:
-    logging.info(f'Creating bookmark: {bookmark}')
-    check_call(['zfs', 'bookmark', '--', f'{snapshot}', f'{bookmark}'])
+    @abstractmethod
+    def iter_children(self, dataset: Dataset, *, quiet: bool) \
+            -> Iterator[Dataset]:
+        """
+        Yield the specified dataset and all its descendant filesystems and
+        volumes, parents before children.
+        """
 
+    @abstractmethod
+    def iter_snapshots_and_bookmarks(
+            self, datasets: list[Dataset], *, snapshots: bool,
+            bookmarks: bool, quiet: bool) \
+            -> Iterator[tuple[
+                Dataset, SnapshotTable[Snapshot], SnapshotTable[Bookmark]]]:
+        """
+        Yield the snapshots and bookmarks of each of the specified datasets,
+        one dataset at a time and each ordered by createtxg. Datasets may be
+        yielded in any order. If `quiet` is set, don't print an error message
+        when a dataset does not exist.
+        """
 
-def list_children(dataset: Dataset) -> list[Dataset]:
-    output = check_output(
-        ['zfs', 'list', '-H', '-r', '-t', 'filesystem,volume', '-o', 'name',
-         '--', dataset],
-        text=True)
+    @abstractmethod
+    def get_snapshot_info(self, snapshot: Snapshot) -> SnapshotInfo | None:
+        """
+        Return the guid and createtxg of a single snapshot, or None if it does
+        not exist.
+        """
 
-    return [Dataset(i) for i in output.splitlines()]
+    @abstractmethod
+    def get_properties(
+            self, datasets: list[Dataset], properties: list[str]) \
+            -> dict[Dataset, dict[str, str]]:
+        """
+        Return the values of the specified properties of each dataset, in
+        their parsable form.
+        """
 
+    @abstractmethod
+    def get_inherited_properties(
+            self, roots: list[Dataset], properties: list[str]) \
+            -> dict[Dataset, dict[str, InheritedProperty]]:
+        """
+        Return the values of those of the specified properties which are set
+        on or inherited by each of the roots and their descendants. Datasets
+        without any of them are omitted.
+        """
 
-def _list_snapshots_and_bookmarks(
-        dataset: Dataset, types: str, quiet: bool) \
-        -> tuple[Sequence[SnapshotInfo], Sequence[BookmarkInfo]]:
+    @abstractmethod
+    def get_scanning_pools(self, pools: list[Dataset]) -> dict[Dataset, str]:
+        """
+        Return those of the pools on which a scrub or resilver is in
+        progress, together with the kind of scan, `scrub' or `resilver'.
+        """
+
+    @abstractmethod
+    def estimate_send_size(
+            self, incremental_base: Bookmark | Snapshot | None,
+            source: Snapshot, *, intermediates: bool, replicate: bool) \
+            -> int:
+        """
+        Return the estimated size of the stream sent by
+        `send_receive_snapshot()`. If `intermediates` is true, the estimate
+        covers all snapshots between `incremental_base` (which must then be a
+        snapshot) and `source`. If `replicate` is true, it covers the
+        replication stream sent by `send_receive_replication()`.
+        """
+
+    @abstractmethod
+    def create_snapshots(
+            self, snapshots: list[Snapshot],
+            recursive_snapshots: list[Snapshot]) \
+            -> None:
+        """
+        Create the snapshots in `snapshots`, and the snapshots in
+        `recursive_snapshots` together with snapshots of the same name of all
+        descendants of their dataset.
+        """
+
+    @abstractmethod
+    def create_bookmarks(self, bookmarks: dict[Bookmark, Snapshot]) -> None:
+        pass
+
+    @abstractmethod
+    def destroy_snapshots(
+            self, snapshots: list[Snapshot | SnapshotRange],
+            recursive_snapshots: list[Snapshot]) \
+            -> None:
+        """
+        Destroy the snapshots in `snapshots` and the snapshots in
+        `recursive_snapshots` together with the snapshots of the same name of
+        all descendants of their dataset.
+        """
+
+    @abstractmethod
+    def estimate_destroy_size(self, snapshots: list[Snapshot]) -> int:
+        """
+        Return the number of bytes freed by destroying the snapshots of each
+        dataset in `snapshots` together.
+        """
+
+    @abstractmethod
+    def destroy_bookmarks(self, bookmarks: list[Bookmark]) -> None:
+        pass
+
+    @abstractmethod
+    def rename_dataset(self, dataset: Dataset, new_name: Dataset) -> None:
+        pass
+
+    @abstractmethod
+    def rollback_snapshot(self, snapshot: Snapshot) -> None:
+        """
+        Discard the changes made to the dataset of `snapshot` since it was
+        taken. Fails if the dataset has more recent snapshots.
+        """
+
+    @abstractmethod
+    def set_user_property(
+            self, snapshot: Snapshot, property: str, value: str) \
+            -> None:
+        pass
+
+    @abstractmethod
+    def send_receive_snapshot(
+            self, incremental_base: Bookmark | Snapshot | None,
+            source: Snapshot, target: Snapshot, *, checksum: bool,
+            intermediates: bool, rate_limit: int | None, force: bool) \
+            -> StreamChecksum | None:
+        """
+        Send the snapshot `source` and receive it as `target`, incrementally
+        from `incremental_base` if it is not None. If `intermediates` is
+        true, the stream also contains all snapshots between
+        `incremental_base`, which must then be a snapshot, and `source`. If
+        `checksum` is true, the checksum of the stream is computed and
+        returned. If `rate_limit` is not None, the stream is sent at no more
+        than that many bytes per second. If `force` is true, the target is
+        rolled back to the incremental base before receiving, destroying
+        changes and more recent snapshots. Otherwise, receiving fails if
+        there are any.
+        """
+
+    @abstractmethod
+    def send_receive_snapshot_fan_out(
+            self, incremental_base: Bookmark | Snapshot | None,
+            source: Snapshot, targets: list[Snapshot], *, checksum: bool,
+            rate_limit: int | None, force: list[bool]) \
+            -> tuple[StreamChecksum | None, dict[Snapshot, CalledProcessError]]:
+        """
+        Like `send_receive_snapshot()`, but the stream is sent once and
+        received as each snapshot in `targets`, forced according to the
+        corresponding element of `force`. Returns the checksum of the
+        stream, if `checksum` is true, and the errors of those targets on
+        which receiving failed, which doesn't affect the other targets.
+        Raises CalledProcessError if sending fails.
+        """
+
+    @abstractmethod
+    def send_receive_replication(
+            self, incremental_base: Snapshot | None, source: Snapshot,
+            target: Dataset, *, checksum: bool, rate_limit: int | None) \
+            -> StreamChecksum | None:
+        """
+        Send the snapshot `source`, the snapshots of the same name of all its
+        descendants and all snapshots since `incremental_base` in a single
+        replication stream and receive it into `target`.
+        """
+
+    @abstractmethod
+    def send_stream(
+            self, incremental_base: Bookmark | Snapshot | None,
+            source: Snapshot) \
+            -> ContextManager[IO[bytes]]:
+        """
+        Return a context manager yielding the stream of the snapshot `source`,
+        incrementally from `incremental_base` if it is not None, which needs
+        to be read to its end.
+        """
+
+    @abstractmethod
+    def receive_stream(self, target: Snapshot) -> ContextManager[IO[bytes]]:
+        """
+        Return a context manager yielding a pipe to which a stream produced by
+        `send_stream()` is written to receive it as `target`.
+        """
+
+
+class CliBackend(ZfsBackend):
     """
-    Return a list of snapshots of the specified dataset, ordered by createtxg.
+    Implementation of ZfsBackend which runs the `zfs` command line tool.
     """
-    if quiet:
-        stderr = DEVNULL
-    else:
-        stderr = None
 
-    output = check_output(
-        ['zfs', 'list', '-Hpd1', '-t', types, '-o', 'name,guid,createtxg',
-         '-s', 'createtxg', '--', dataset],
-        stderr=stderr,
-        text=True)
+    def iter_children(self, dataset: Dataset, *, quiet: bool) \
+            -> Iterator[Dataset]:
+        for i in iter_output_lines(
+                ['zfs', 'list', '-H', '-r', '-t', 'filesystem,volume', '-o',
+                 'name', '--', dataset],
+                stderr=DEVNULL if quiet else None):
+            yield Dataset(i)
+
+    def iter_snapshots_and_bookmarks(
+            self, datasets: list[Dataset], *, snapshots: bool,
+            bookmarks: bool, quiet: bool) \
+            -> Iterator[tuple[
+                Dataset, SnapshotTable[Snapshot], SnapshotTable[Bookmark]]]:
+        types = ','.join(
+            name for name, selected
+            in [('snapshot', snapshots), ('bookmark', bookmarks)] if selected)
+
+        if quiet:
+            stderr = DEVNULL
+        else:
+            stderr = None
+
+        remaining_datasets = dict.fromkeys(datasets)
+
+        for i in range(0, len(datasets), _list_datasets_per_call):
+            # Not using `-s createtxg` here, because that would sort the
+            # entries of all datasets together. Without it, `zfs list` outputs
+            # the entries of each dataset consecutively, which allows us to
+            # process the output one dataset at a time.
+            lines = iter_output_lines(
+                ['zfs', 'list', '-Hpd1', '-t', types, '-o',
+                 'name,guid,createtxg', '--',
+                 *datasets[i:i + _list_datasets_per_call]],
+                stderr=stderr)
+
+            for dataset, group_lines in itertools.groupby(
+                    lines, lambda x: Dataset(re.split('[@#]', x, 1)[0])):
+                remaining_datasets.pop(dataset, None)
+
+                yield dataset, *_parse_list_output(dataset, group_lines)
+
+        # Datasets without any snapshots or bookmarks don't appear in the
+        # output at all.
+        for dataset in remaining_datasets:
+            yield dataset, SnapshotTable(Snapshot, dataset), \
+                SnapshotTable(Bookmark, dataset)
+
+    def get_snapshot_info(self, snapshot: Snapshot) -> SnapshotInfo | None:
+        try:
+            output = check_output(
+                ['zfs', 'get', '-Hp', '-o', 'property,value',
+                 'guid,createtxg', '--', f'{snapshot}'],
+                stderr=DEVNULL,
+                text=True)
+        except CalledProcessError:
+            return None
+
+        values = dict(i.split('\t') for i in output.splitlines())
+
+        return SnapshotInfo(
+            snapshot, int(values['guid']), int(values['createtxg']))
+
+    def get_properties(
+            self, datasets: list[Dataset], properties: list[str]) \
+            -> dict[Dataset, dict[str, str]]:
+        res: dict[Dataset, dict[str, str]] = {}
+
+        for i in range(0, len(datasets), _list_datasets_per_call):
+            for line in iter_output_lines(
+                    ['zfs', 'get', '-Hp', '-o', 'name,property,value',
+                     ','.join(properties), '--',
+                     *datasets[i:i + _list_datasets_per_call]]):
+                name, property, value = line.split('\t')
+                res.setdefault(Dataset(name), {})[property] = value
+
+        return res
+
+    def get_inherited_properties(
+            self, roots: list[Dataset], properties: list[str]) \
+            -> dict[Dataset, dict[str, InheritedProperty]]:
+        res: dict[Dataset, dict[str, InheritedProperty]] = {}
+
+        for i in range(0, len(roots), _list_datasets_per_call):
+            for line in iter_output_lines(
+                    ['zfs', 'get', '-Hp', '-r', '-t',
+                     ','.join(property_dataset_types), '-s', 'local,inherited',
+                     '-o', 'name,property,value,source', ','.join(properties),
+                     '--', *roots[i:i + _list_datasets_per_call]]):
+                name, property, value, source = line.split('\t')
+
+                # The source is either `local' or `inherited from <dataset>'.
+                source_dataset = source.removeprefix('inherited from ')
+
+                if source_dataset == 'local':
+                    source_dataset = name
+
+                res.setdefault(Dataset(name), {})[property] = \
+                    InheritedProperty(value, Dataset(source_dataset))
+
+        return res
+
+    def get_scanning_pools(self, pools: list[Dataset]) -> dict[Dataset, str]:
+        res: dict[Dataset, str] = {}
+        pool = None
+
+        # The state of the scan is only reported in the human-readable output,
+        # e.g. `  scan: scrub in progress since Sun Jul 25 16:07:49 2021'.
+        for line in iter_output_lines(['zpool', 'status', '--', *pools]):
+            key, _, value = line.strip().partition(': ')
+
+            if key == 'pool':
+                pool = Dataset(value)
+            elif key == 'scan' and pool is not None \
+                    and ' in progress ' in value:
+                res[pool] = value.split()[0]
+
+        return res
+
+    def estimate_send_size(
+            self, incremental_base: Bookmark | Snapshot | None,
+            source: Snapshot, *, intermediates: bool, replicate: bool) \
+            -> int:
+        replicate_args = ['--replicate'] if replicate else []
+
+        if incremental_base is None:
+            incremental_args = []
+        elif intermediates:
+            incremental_args = ['-I', f'{incremental_base}']
+        else:
+            incremental_args = ['-i', f'{incremental_base}']
+
+        output = check_output(
+            ['zfs', 'send', '--raw', '--props', '--dryrun', '--parsable',
+             *replicate_args, *incremental_args, '--', f'{source}'],
+            text=True)
+
+        # The last line is of the form `size\t<bytes>`.
+        return int(output.split()[-1])
+
+    def create_snapshots(
+            self, snapshots: list[Snapshot],
+            recursive_snapshots: list[Snapshot]) \
+            -> None:
+        pools: dict[Dataset, tuple[list[Snapshot], list[Snapshot]]] = {}
+
+        for i in snapshots:
+            pools.setdefault(get_pool_name(i.dataset), ([], []))[0].append(i)
+
+        for i in recursive_snapshots:
+            pools.setdefault(get_pool_name(i.dataset), ([], []))[1].append(i)
+
+        created: list[tuple[list[Snapshot], list[Snapshot]]] = []
+
+        try:
+            for pool_snapshots, pool_recursive_snapshots in pools.values():
+                self._create_pool_snapshots(
+                    pool_snapshots, pool_recursive_snapshots)
+                created.append((pool_snapshots, pool_recursive_snapshots))
+        except CalledProcessError:
+            # Snapshots can only be created atomically within a single pool.
+            # Destroy those already created on other pools, so that e.g. a
+            # name that is already used doesn't leave a partial set behind.
+            for pool_snapshots, pool_recursive_snapshots in created:
+                self.destroy_snapshots(
+                    [*pool_snapshots], pool_recursive_snapshots)
+
+            raise
+
+    def _create_pool_snapshots(
+            self, snapshots: list[Snapshot],
+            recursive_snapshots: list[Snapshot]) \
+            -> None:
+        """
+        Create the snapshots of a single pool in one atomic operation.
+        """
+        if snapshots and recursive_snapshots:
+            # `-r` applies to all snapshots passed to the command, and
+            # separate calls wouldn't be atomic, so the descendants are passed
+            # explicitly.
+            snapshots = snapshots + [
+                Snapshot(j, i.name) for i in recursive_snapshots
+                for j in self.iter_children(i.dataset, quiet=False)]
+            recursive_snapshots = []
+
+        if recursive_snapshots:
+            check_call(
+                ['zfs', 'snapshot', '-r', '--',
+                 *(str(i) for i in recursive_snapshots)])
+        else:
+            check_call(['zfs', 'snapshot', '--', *(str(i) for i in snapshots)])
+
+    def create_bookmarks(self, bookmarks: dict[Bookmark, Snapshot]) -> None:
+        # `zfs bookmark` only accepts a single bookmark.
+        for bookmark, snapshot in bookmarks.items():
+            check_call(['zfs', 'bookmark', '--', f'{snapshot}', f'{bookmark}'])
 
-    snapshots: list[SnapshotInfo] = []
-    bookmarks: list[BookmarkInfo] = []
+    def destroy_snapshots(
+            self, snapshots: list[Snapshot | SnapshotRange],
+            recursive_snapshots: list[Snapshot]) \
+            -> None:
+        # `zfs destroy` accepts multiple snapshots, but only of a single
+        # dataset. Split the list if the argument would get too long.
+        args: list[tuple[list[str], Sequence[Snapshot | SnapshotRange]]] = \
+            [(['-r'], recursive_snapshots), ([], snapshots)]
 
-    for line in output.splitlines():
+        for recursive_args, refs in args:
+            for dataset, names in _group_names_by_dataset(refs).items():
+                for chunk in chunk_joined_args(
+                        names, ',', len(f'{dataset}@')):
+                    check_call(
+                        ['zfs', 'destroy', *recursive_args, '--',
+                         f'{dataset}@{",".join(chunk)}'])
+
+    def estimate_destroy_size(self, snapshots: list[Snapshot]) -> int:
+        size = 0
+
+        # Snapshots split into separate chunks are estimated separately, which
+        # can underestimate the space freed by destroying them together.
+        for dataset, names in _group_names_by_dataset(snapshots).items():
+            for chunk in chunk_joined_args(names, ',', len(f'{dataset}@')):
+                for line in iter_output_lines(
+                        ['zfs', 'destroy', '-nvp', '--',
+                         f'{dataset}@{",".join(chunk)}']):
+                    key, _, value = line.partition('\t')
+
+                    if key == 'reclaim':
+                        size += int(value)
+
+        return size
+
+    def destroy_bookmarks(self, bookmarks: list[Bookmark]) -> None:
+        for i in bookmarks:
+            check_call(['zfs', 'destroy', '--', f'{i}'])
+
+    def rename_dataset(self, dataset: Dataset, new_name: Dataset) -> None:
+        # Renaming often fails with `cannot unmount '...': unmount failed`.
+        # Retry a bunch of times to get around this.
+        for _ in range(5):
+            try:
+                check_call(['zfs', 'rename', '--', dataset, new_name])
+            except CalledProcessError as e:
+                error = e
+                time.sleep(1)
+            else:
+                break
+        else:
+            raise error
+
+    def rollback_snapshot(self, snapshot: Snapshot) -> None:
+        check_call(['zfs', 'rollback', '--', f'{snapshot}'])
+
+    def set_user_property(
+            self, snapshot: Snapshot, property: str, value: str) \
+            -> None:
+        check_call(['zfs', 'set', f'{property}={value}', '--', f'{snapshot}'])
+
+    def send_receive_snapshot(
+            self, incremental_base: Bookmark | Snapshot | None,
+            source: Snapshot, target: Snapshot, *, checksum: bool,
+            intermediates: bool, rate_limit: int | None, force: bool) \
+            -> StreamChecksum | None:
+        if incremental_base is None:
+            incremental_args = []
+        elif intermediates:
+            incremental_args = ['-I', f'{incremental_base}']
+        else:
+            incremental_args = ['-i', f'{incremental_base}']
+
+        def send_cmdline(*opts: str) -> list[str]:
+            return ['zfs', 'send', '--raw', '--props', *incremental_args, *opts,
+                    '--', f'{source}']
+
+        dry_run_output = \
+            check_output(send_cmdline('--dryrun', '--verbose'), text=True)
+
+        # I know I could use `--parsable` to get a stable output format to
+        # parse, but then I'd have to convert the number of bytes to an output
+        # format myself, trying to imitate a format that ZFS uses. `--verbose`
+        # prints a line of the form `total estimated size is 1.40G`.
+        size_estimate_str = dry_run_output.split()[-1]
+
+        logging.info(f'Sending snapshot: {source} (about {size_estimate_str})')
+
+        # Using -F on the receive side to prevent receiving to fail if the
+        # target filesystem has been modified since the last receive. This will
+        # only make a difference for incremental sends, i.e. when we know that
+        # the target filesystem has actually been created as a back of the
+        # source we're sending. If the target filesystem is unrelated, it won't
+        # be overwritten. Without `force`, the caller hasn't checked yet that
+        # no snapshots would be destroyed.
+        return _send_receive(
+            send_cmdline(), _receive_cmdline(target, force), checksum,
+            rate_limit)
+
+    def send_receive_snapshot_fan_out(
+            self, incremental_base: Bookmark | Snapshot | None,
+            source: Snapshot, targets: list[Snapshot], *, checksum: bool,
+            rate_limit: int | None, force: list[bool]) \
+            -> tuple[StreamChecksum | None, dict[Snapshot, CalledProcessError]]:
+        size = self.estimate_send_size(
+            incremental_base, source, intermediates=False, replicate=False)
+
+        logging.info(
+            f'Sending snapshot: {source} to {len(targets)} targets (about '
+            f'{format_size(size)})')
+
+        if incremental_base is None:
+            incremental_args = []
+        else:
+            incremental_args = ['-i', f'{incremental_base}']
+
+        stream_checksum, errors = check_call_fan_out(
+            ['zfs', 'send', '--raw', '--props', *incremental_args, '--',
+             f'{source}'],
+            [_receive_cmdline(i, j) for i, j in zip(targets, force)],
+            checksum=checksum, rate_limit=rate_limit)
+
+        return stream_checksum, {
+            i: e for i, e in zip(targets, errors) if e is not None}
+
+    def send_receive_replication(
+            self, incremental_base: Snapshot | None, source: Snapshot,
+            target: Dataset, *, checksum: bool, rate_limit: int | None) \
+            -> StreamChecksum | None:
+        if incremental_base is None:
+            incremental_args = []
+        else:
+            incremental_args = ['-I', f'{incremental_base}']
+
+        size = self.estimate_send_size(
+            incremental_base, source, intermediates=True, replicate=True)
+
+        logging.info(
+            f'Sending replication stream: {source} (about {format_size(size)})')
+
+        # Not using -F here, as it would also destroy snapshots on the target
+        # which have already been destroyed on the source. The caller rolls
+        # back the targets instead.
+        return _send_receive(
+            ['zfs', 'send', '--raw', '--replicate', *incremental_args, '--',
+             f'{source}'],
+            ['zfs', 'receive', '--', f'{target}'],
+            checksum, rate_limit)
+
+    def send_stream(
+            self, incremental_base: Bookmark | Snapshot | None,
+            source: Snapshot) \
+            -> ContextManager[IO[bytes]]:
+        if incremental_base is None:
+            incremental_args = []
+        else:
+            incremental_args = ['-i', f'{incremental_base}']
+
+        return open_process_pipe(
+            ['zfs', 'send', '--raw', '--props', *incremental_args, '--',
+             f'{source}'],
+            write=False)
+
+    def receive_stream(self, target: Snapshot) -> ContextManager[IO[bytes]]:
+        return open_process_pipe(
+            ['zfs', 'receive', '-F', '--', f'{target}'], write=True)
+
+
+def _receive_cmdline(target: Snapshot, force: bool) -> list[str]:
+    force_args = ['-F'] if force else []
+
+    return ['zfs', 'receive', *force_args, '--', f'{target}']
+
+
+def _send_receive(
+        send_cmdline: list[str], receive_cmdline: list[str], checksum: bool,
+        rate_limit: int | None) \
+        -> StreamChecksum | None:
+    # Limiting the rate requires passing the stream through this process.
+    if checksum or rate_limit is not None:
+        return check_call_relay(
+            send_cmdline, receive_cmdline, checksum=checksum,
+            rate_limit=rate_limit)
+
+    check_call_pipeline(send_cmdline, receive_cmdline)
+
+    return None
+
+
+# Maximum number of datasets passed to a single `zfs list` invocation to keep the
+# command line reasonably short.
+_list_datasets_per_call = 1000
+
+
+def _parse_list_output(dataset: Dataset, lines: Iterable[str]) \
+        -> tuple[SnapshotTable[Snapshot], SnapshotTable[Bookmark]]:
+    snapshots = SnapshotTable(Snapshot, dataset)
+    bookmarks = SnapshotTable(Bookmark, dataset)
+
+    for line in lines:
         full_name, guid_str, createtxg_str = line.split('\t')
         guid = int(guid_str)
         createtxg = int(createtxg_str)
 
         if '@' in full_name:
             dataset_name, name = full_name.split('@')
-
-            snapshots.append(_Info(Snapshot(dataset, name), guid, createtxg))
+            snapshots.append(name, guid, createtxg)
         else:
             dataset_name, name = full_name.split('#')
+            bookmarks.append(name, guid, createtxg)
 
-            bookmarks.append(_Info(Bookmark(dataset, name), guid, createtxg))
+    snapshots.sort()
+    bookmarks.sort()
 
     return snapshots, bookmarks
 
 
+def _group_names_by_dataset(
+        refs: Iterable[Snapshot | SnapshotRange | Bookmark]) \
+        -> dict[Dataset, list[str]]:
+    res: dict[Dataset, list[str]] = {}
+
+    for i in refs:
+        res.setdefault(i.dataset, []).append(i.name)
+
+    return res
+
+
+class ZfsBackendType(Enum):
+    cli = 'cli'
+    lzc = 'lzc'
+
+
+@mockable_fn
+def create_backend(backend_type: ZfsBackendType) -> ZfsBackend:
+    if backend_type is ZfsBackendType.lzc:
+        # Imported here because the module depends on an optional library.
+        from snappy.lzc import LzcBackend
+
+        return LzcBackend()
+    else:
+        return CliBackend()
+
+
+_backend: ZfsBackend | None = None
+
+
+def set_backend(backend_type: ZfsBackendType) -> None:
+    global _backend
+
+    _backend = create_backend(backend_type)
+
+
+@contextmanager
+def use_backend(backend: ZfsBackend) -> Iterator[None]:
+    """
+    Use `backend` instead of the current backend until the context is left.
+    """
+    global _backend
+
+    previous_backend = _backend
+    _backend = backend
+
+    try:
+        yield
+    finally:
+        _backend = previous_backend
+
+
+def get_backend() -> ZfsBackend:
+    global _backend
+
+    if _backend is None:
+        _backend = create_backend(ZfsBackendType.cli)
+
+    return _backend
+
+
+def rename_dataset(dataset: Dataset, new_name: Dataset) -> None:
+    get_backend().rename_dataset(dataset, new_name)
+
+
+def rollback_snapshot(snapshot: Snapshot) -> None:
+    get_backend().rollback_snapshot(snapshot)
+
+
+def create_snapshots(
+        snapshots: list[Snapshot], recursive_snapshots: list[Snapshot]) \
+        -> None:
+    if recursive_snapshots:
+        logging.info(
+            f'Creating recursive snapshots: '
+            f'{", ".join(str(i) for i in recursive_snapshots)}')
+
+    if snapshots:
+        logging.info(
+            f'Creating snapshots: {", ".join(str(i) for i in snapshots)}')
+
+    get_backend().create_snapshots(snapshots, recursive_snapshots)
+
+
+def create_bookmarks(bookmarks: dict[Bookmark, Snapshot]) -> None:
+    if not bookmarks:
+        return
+
+    for i in bookmarks:
+        logging.info(f'Creating bookmark: {i}')
+
+    get_backend().create_bookmarks(bookmarks)
+
+
+def iter_children(
+        dataset: Dataset, *, quiet: bool = False) -> Iterator[Dataset]:
+    return get_backend().iter_children(dataset, quiet=quiet)
+
+
+def iter_snapshots_and_bookmarks(
+        datasets: list[Dataset], *, quiet: bool = False) \
+        -> Iterator[tuple[
+            Dataset, SnapshotTable[Snapshot], SnapshotTable[Bookmark]]]:
+    return get_backend().iter_snapshots_and_bookmarks(
+        datasets, snapshots=True, bookmarks=True, quiet=quiet)
+
+
+def iter_snapshots(
+        datasets: list[Dataset], *, quiet: bool = False) \
+        -> Iterator[tuple[Dataset, SnapshotTable[Snapshot]]]:
+    for dataset, snapshots, _ in get_backend().iter_snapshots_and_bookmarks(
+            datasets, snapshots=True, bookmarks=False, quiet=quiet):
+        yield dataset, snapshots
+
+
 def list_snapshots_and_bookmarks(
         dataset: Dataset, *, quiet: bool = False) \
-        -> tuple[Sequence[SnapshotInfo], Sequence[BookmarkInfo]]:
-    return _list_snapshots_and_bookmarks(dataset, 'snapshot,bookmark', quiet)
+        -> tuple[SnapshotTable[Snapshot], SnapshotTable[Bookmark]]:
+    (_, snapshots, bookmarks), = \
+        iter_snapshots_and_bookmarks([dataset], quiet=quiet)
+
+    return snapshots, bookmarks
 
 
 def list_snapshots(
         dataset: Dataset, *, quiet: bool = False) \
-        -> Sequence[SnapshotInfo]:
-    return _list_snapshots_and_bookmarks(dataset, 'snapshot', quiet)[0]
+        -> SnapshotTable[Snapshot]:
+    (_, snapshots), = iter_snapshots([dataset], quiet=quiet)
 
+    return snapshots
 
-def list_bookmarks(
-        dataset: Dataset, *, quiet: bool = False) \
-        -> Sequence[BookmarkInfo]:
-    return _list_snapshots_and_bookmarks(dataset, 'bookmark', quiet)[1]
 
+def get_snapshot_info(snapshot: Snapshot) -> SnapshotInfo | None:
+    return get_backend().get_snapshot_info(snapshot)
 
-def destroy_snapshots(snapshots: Iterable[Snapshot]) -> None:
-    if not snapshots:
+
+def get_properties(
+        datasets: list[Dataset], properties: list[str]) \
+        -> dict[Dataset, dict[str, str]]:
+    return get_backend().get_properties(datasets, properties)
+
+
+def get_inherited_properties(
+        roots: list[Dataset], properties: list[str]) \
+        -> dict[Dataset, dict[str, InheritedProperty]]:
+    return get_backend().get_inherited_properties(roots, properties)
+
+
+def get_scanning_pools(pools: list[Dataset]) -> dict[Dataset, str]:
+    return get_backend().get_scanning_pools(pools)
+
+
+def estimate_send_size(
+        incremental_base: Bookmark | Snapshot | None, source: Snapshot, *,
+        intermediates: bool = False, replicate: bool = False) \
+        -> int:
+    return get_backend().estimate_send_size(
+        incremental_base, source, intermediates=intermediates,
+        replicate=replicate)
+
+
+def destroy_snapshots(
+        snapshots: Iterable[Snapshot | SnapshotRange],
+        recursive_snapshots: Sequence[Snapshot] = ()) \
+        -> None:
+    snapshots = list(snapshots)
+
+    for dataset, names in _group_names_by_dataset(recursive_snapshots).items():
+        logging.info(
+            f'Destroying recursive snapshots: {dataset}@{",".join(names)}')
+
+    for dataset, names in _group_names_by_dataset(snapshots).items():
+        logging.info(f'Destroying snapshots: {dataset}@{",".join(names)}')
+
+    if snapshots or recursive_snapshots:
         # We can't call `zfs destroy` with an empty list of snapshots.
+        get_backend().destroy_snapshots(snapshots, list(recursive_snapshots))
+
+
+def estimate_destroy_size(snapshots: list[Snapshot]) -> int:
+    if not snapshots:
+        return 0
+
+    return get_backend().estimate_destroy_size(snapshots)
+
+
+def destroy_bookmarks(bookmarks: Iterable[Bookmark]) -> None:
+    bookmarks = list(bookmarks)
+
+    if not bookmarks:
         return
 
-    dataset, = {i.dataset for i in snapshots}
-    snapshots_arg = f'{dataset}@{",".join(i.name for i in snapshots)}'
+    for i in bookmarks:
+        logging.info(f'Removing bookmark: {i}')
 
-    logging.info(f'Destroying snapshots: {snapshots_arg}')
-    check_call(['zfs', 'destroy', '--', snapshots_arg])
+    get_backend().destroy_bookmarks(bookmarks)
 
 
-def destroy_bookmark(bookmark: Bookmark) -> None:
-    logging.info(f'Removing bookmark: {bookmark}')
-    check_call(['zfs', 'destroy', '--', f'{bookmark}'])
+def set_user_property(snapshot: Snapshot, property: str, value: str) -> None:
+    get_backend().set_user_property(snapshot, property, value)
 
 
 def send_receive_snapshot(
         incremental_base_snapshot: Bookmark | Snapshot | None, source: Snapshot,
-        target: Snapshot) -> None:
-    if incremental_base_snapshot is None:
-        incremental_args = []
-    else:
-        incremental_args = ['-i', f'{incremental_base_snapshot}']
+        target: Snapshot, *, checksum: bool = False,
+        intermediates: bool = False, rate_limit: int | None = None,
+        force: bool = True) \
+        -> StreamChecksum | None:
+    return get_backend().send_receive_snapshot(
+        incremental_base_snapshot, source, target, checksum=checksum,
+        intermediates=intermediates, rate_limit=rate_limit, force=force)
+
+
+def send_receive_snapshot_fan_out(
+        incremental_base: Bookmark | Snapshot | None, source: Snapshot,
+        targets: list[Snapshot], *, checksum: bool = False,
+        rate_limit: int | None = None, force: list[bool] | None = None) \
+        -> tuple[StreamChecksum | None, dict[Snapshot, CalledProcessError]]:
+    if force is None:
+        force = [True] * len(targets)
+
+    return get_backend().send_receive_snapshot_fan_out(
+        incremental_base, source, targets, checksum=checksum,
+        rate_limit=rate_limit, force=force)
+
 
-    def send_cmdline(*opts: str) -> list[str]:
-        return ['zfs', 'send', '--raw', '--props', *incremental_args, *opts,
-                '--', f'{source}']
+def send_receive_replication(
+        incremental_base: Snapshot | None, source: Snapshot, target: Dataset, *,
+        checksum: bool = False, rate_limit: int | None = None) \
+        -> StreamChecksum | None:
+    return get_backend().send_receive_replication(
+        incremental_base, source, target, checksum=checksum,
+        rate_limit=rate_limit)
 
-    dry_run_output = check_output(send_cmdline('--dryrun', '--verbose'), text=True)
 
-    # I know I could use `--parsable` to get a stable output format to parse,
-    # but then I'd have to convert the number of bytes to an output format
-    # myself, trying to imitate a format that ZFS uses. `--verbose` prints a
-    # line of the form `total estimated size is 1.40G`.
-    size_estimate_str = dry_run_output.split()[-1]
+def send_stream(
+        incremental_base: Bookmark | Snapshot | None, source: Snapshot) \
+        -> ContextManager[IO[bytes]]:
+    return get_backend().send_stream(incremental_base, source)
 
-    logging.info(f'Sending snapshot: {source} (about {size_estimate_str})')
 
-    # Using -F on the receive side to prevent receiving to fail if the target
-    # filesystem has been modified since the last receive. This will only make a
-    # difference for incremental sends, i.e. when we know that the target
-    # filesystem has actually been created as a back of the source we're
-    # sending. If the target filesystem is unrelated, it won't be overwritten.
-    check_call_pipeline(send_cmdline(), ['zfs', 'receive', '-F', '--', f'{target}'])
+def receive_stream(target: Snapshot) -> ContextManager[IO[bytes]]:
+    return get_backend().receive_stream(target)
@@ -7,7 +7,7 @@ import subprocess
 import sys
 from contextlib import contextmanager
 from pathlib import Path
-from typing import Callable, Iterator, ContextManager
+from typing import Callable, Iterator, ContextManager, TYPE_CHECKING
 
 import pytest
 import toml
@@ -16,6 +16,9 @@ from pytest import MonkeyPatch
 
 from snappy.test_utils import mockable_fn
 
+if TYPE_CHECKING:
+    from snappy.fake_zfs import FakeZfsBackend
+
 
 temp_zpool_vdev_path = Path('/dev/shm/snappy-test-vdev')
 temp_zpool_name = 'snappy-test-zpool'
@@ -177,6 +180,19 @@ def mocked_datetime_now(monkeypatch):
     return set_current_time
 
 
+@pytest.fixture(autouse=True)
+def lock_dir(monkeypatch: MonkeyPatch, tmp_path: Path) -> Path:
+    """
+    Keep the lock files of each test separate and out of /run.
+    """
+    import snappy.locking
+
+    lock_dir = tmp_path / 'locks'
+    monkeypatch.setattr(snappy.locking, 'lock_dir', lock_dir)
+
+    return lock_dir
+
+
 @pytest.fixture
 def mocked_config_file(monkeypatch: MonkeyPatch, tmp_path: Path) -> Path:
     import snappy
@@ -193,3 +209,29 @@ def mocked_config_file(monkeypatch: MonkeyPatch, tmp_path: Path) -> Path:
     monkeypatch.setattr(snappy.config.load_config, '__wrapped__', mock_load_config)
 
     return config_path
+
+
+@pytest.fixture
+def fake_zfs(monkeypatch: MonkeyPatch) -> FakeZfsBackend:
+    """
+    Replace the backend used to perform ZFS operations with an in-memory fake
+    so that tests can run without a pool.
+    """
+    import snappy.zfs
+    from snappy.fake_zfs import FakeZfsBackend
+
+    backend = FakeZfsBackend()
+
+    monkeypatch.setattr(
+        snappy.zfs.create_backend, '__wrapped__', lambda backend_type: backend)
+    monkeypatch.setattr(snappy.zfs, '_backend', backend)
+
+    return backend
+
+
+@pytest.fixture
+def fake_filesystem(fake_zfs: FakeZfsBackend) -> str:
+    fake_zfs.create_dataset('pool')
+    fake_zfs.create_dataset('pool/fs')
+
+    return 'pool/fs'
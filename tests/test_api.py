@@ -0,0 +1,65 @@
+import pytest
+
+from snappy.api import Engine
+from snappy.config import MostRecentKeepSpec
+from snappy.utils import UserError
+from snappy.zfs import Snapshot, Dataset
+
+
+@pytest.fixture
+def engine(fake_zfs):
+    return Engine(fake_zfs)
+
+
+def test_snapshot_send_prune(engine, fake_zfs, fake_filesystem):
+    fake_zfs.create_dataset(f'{fake_filesystem}/a')
+    fake_zfs.create_dataset('pool/target')
+
+    for _ in range(2):
+        plan = engine.snapshot([Dataset(fake_filesystem)], recursive=True)
+
+    assert plan.recursive_snapshots == \
+           [Snapshot(Dataset(fake_filesystem), 'snappy-2001-02-03-091500')]
+
+    plan = engine.plan(
+        [Dataset(fake_filesystem)], recursive=True, take_snapshot=False,
+        send_targets=[Dataset('pool/target')], send_base=Dataset('pool'))
+
+    # Planning doesn't change anything.
+    assert [len(i.snapshots_to_send) for i in plan.sends] == [2, 2]
+    assert 'pool/target/fs' not in fake_zfs.datasets
+
+    plan = engine.send(
+        [Dataset(fake_filesystem)], [Dataset('pool/target')],
+        send_base=Dataset('pool'), recursive=True)
+
+    assert [len(i.snapshots_to_send) for i in plan.sends] == [2, 2]
+    assert fake_zfs.get_snapshots('pool/target/fs/a') == \
+           ['snappy-2001-02-03-081500', 'snappy-2001-02-03-091500']
+
+    plan = engine.prune(
+        [Dataset('pool/target')], [MostRecentKeepSpec(1)], recursive=True)
+
+    assert len(plan.expired_snapshots) == 2
+    assert fake_zfs.get_snapshots('pool/target/fs/a') == \
+           ['snappy-2001-02-03-091500']
+
+
+def test_inventory(engine, fake_zfs, fake_filesystem):
+    fake_zfs.create_dataset(f'{fake_filesystem}/a')
+    engine.snapshot([Dataset(fake_filesystem)], recursive=True)
+
+    inventory = engine.inventory(
+        [Dataset(fake_filesystem)], recursive=True,
+        exclude=[Dataset(f'{fake_filesystem}/a')])
+
+    assert list(inventory) == [fake_filesystem]
+    assert inventory[Dataset(fake_filesystem)].snapshots.names == \
+           ['snappy-2001-02-03-081500']
+    assert len(inventory[Dataset(fake_filesystem)].bookmarks) == 0
+
+
+def test_errors(engine, fake_filesystem):
+    with pytest.raises(UserError, match='send base is required'):
+        engine.send(
+            [Dataset(fake_filesystem), Dataset('pool')], [Dataset('pool/x')])
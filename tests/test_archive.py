@@ -0,0 +1,162 @@
+import json
+
+import pytest
+
+import snappy.archive
+from snappy.zfs import Snapshot, Dataset
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    # The streams of the fake backend are only a few dozen bytes long.
+    monkeypatch.setattr(snappy.archive, 'chunk_size', 16)
+
+
+def read_manifest(directory):
+    return json.loads((directory / '@manifest.json').read_text())
+
+
+def test_archive(
+        snappy_command, fake_zfs, fake_filesystem, tmp_path, small_chunks):
+    archive_dir = tmp_path / 'archive'
+
+    snappy_command(f'-s {archive_dir} {fake_filesystem}')
+    snappy_command(f'-s {archive_dir} {fake_filesystem}')
+
+    streams = read_manifest(archive_dir)['streams']
+
+    assert [i['snapshot'] for i in streams] == \
+           ['snappy-2001-02-03-081500', 'snappy-2001-02-03-091500']
+    assert streams[0]['base_guid'] is None
+    assert streams[1]['base_guid'] == streams[0]['guid']
+
+    for i in streams:
+        assert len(i['chunks']) > 1
+        assert sum(j['size'] for j in i['chunks']) == i['size']
+
+        for j in i['chunks']:
+            assert (archive_dir / j['file']).stat().st_size == j['size']
+
+    # Only the bookmark of the most recent snapshot is kept on the source.
+    assert fake_zfs.get_snapshots(fake_filesystem) == []
+    assert fake_zfs.get_bookmarks(fake_filesystem) == \
+           ['snappy-2001-02-03-091500']
+
+    snappy_command(f'--restore-from {archive_dir} pool/restored')
+
+    assert fake_zfs.get_snapshots('pool/restored') == \
+           ['snappy-2001-02-03-081500', 'snappy-2001-02-03-091500']
+
+    # Only the streams not restored yet are received.
+    snappy_command(f'-s {archive_dir} {fake_filesystem}')
+    snappy_command(f'--restore-from {archive_dir} pool/restored')
+
+    assert fake_zfs.calls.count('receive_stream') == 3
+    assert fake_zfs.get_snapshots('pool/restored') == \
+           ['snappy-2001-02-03-081500', 'snappy-2001-02-03-091500',
+            'snappy-2001-02-03-101500']
+
+
+def test_archive_recursive(
+        snappy_command, fake_zfs, fake_filesystem, tmp_path):
+    fake_zfs.create_dataset(f'{fake_filesystem}/a')
+
+    snappy_command(f'-r -s {tmp_path} -b pool {fake_filesystem}')
+
+    assert read_manifest(tmp_path / 'fs')['dataset'] == fake_filesystem
+    assert read_manifest(tmp_path / 'fs' / 'a')['dataset'] == \
+           f'{fake_filesystem}/a'
+
+
+def test_restore_corrupted(
+        snappy_command, fake_zfs, fake_filesystem, tmp_path,
+        fails_with_message):
+    snappy_command(f'-s {tmp_path} {fake_filesystem}')
+
+    stream, = read_manifest(tmp_path)['streams']
+    chunk_path = tmp_path / stream['chunks'][0]['file']
+    chunk_path.write_bytes(chunk_path.read_bytes().replace(b'guid', b'GUID'))
+
+    with fails_with_message('does not match the manifest'):
+        snappy_command(f'--restore-from {tmp_path} pool/restored')
+
+    assert Dataset('pool/restored') not in fake_zfs.datasets
+
+
+def test_restore_checksum_mismatch(
+        snappy_command, fake_zfs, fake_filesystem, tmp_path,
+        fails_with_message):
+    snappy_command(f'-s {tmp_path} {fake_filesystem}')
+
+    manifest = read_manifest(tmp_path)
+    manifest['streams'][0]['checksum'] = \
+        manifest['streams'][0]['checksum'].replace(':', ':0', 1)
+    (tmp_path / '@manifest.json').write_text(json.dumps(manifest))
+
+    # The stream is verified before it has been written completely.
+    with fails_with_message('does not match the manifest'):
+        snappy_command(f'--restore-from {tmp_path} pool/restored')
+
+    assert Dataset('pool/restored') not in fake_zfs.datasets
+
+
+def test_archive_multiple_snapshots(
+        snappy_command, fake_zfs, fake_filesystem, tmp_path, small_chunks):
+    for _ in range(2):
+        snappy_command(f'{fake_filesystem}')
+
+    fake_zfs.calls.clear()
+    snappy_command(f'-s {tmp_path} {fake_filesystem}')
+
+    # The source is listed once for planning and once for archiving all
+    # streams.
+    assert fake_zfs.calls.count('send_stream') == 3
+    assert fake_zfs.calls.count('iter_snapshots_and_bookmarks') == 2
+
+
+def test_archive_new_chain(
+        snappy_command, fake_zfs, fake_filesystem, tmp_path):
+    snappy_command(f'-s {tmp_path} {fake_filesystem}')
+
+    # A re-created source has nothing in common with the archive.
+    del fake_zfs.datasets[Dataset(fake_filesystem)]
+    fake_zfs.create_dataset(fake_filesystem)
+    snappy_command(f'-s {tmp_path} {fake_filesystem}')
+
+    streams = read_manifest(tmp_path)['streams']
+
+    assert [i['base_guid'] for i in streams] == [None, None]
+
+    snappy_command(f'--restore-from {tmp_path} pool/restored')
+
+    # Only the most recent chain is restored.
+    assert fake_zfs.get_snapshots('pool/restored') == \
+           ['snappy-2001-02-03-091500']
+    assert fake_zfs.get_snapshot_info(
+        Snapshot(Dataset('pool/restored'), 'snappy-2001-02-03-091500')).guid \
+           == streams[1]['guid']
+
+
+def test_archive_conflicts(
+        snappy_command, fake_zfs, fake_filesystem, tmp_path,
+        fails_with_message):
+    with fails_with_message('not supported when sending to a directory'):
+        snappy_command(f'-k 1 -s {tmp_path} {fake_filesystem}')
+
+    with fails_with_message('--restore-from requires a single dataset'):
+        snappy_command(f'--restore-from {tmp_path} -r {fake_filesystem}')
+
+
+@pytest.mark.parametrize('option', [
+    '--min-written 1M', '--max-snapshot-age 1h', '--max-capacity 80',
+    '--high-frequency', '--from-properties', '--keep-bookmarks 3',
+    '--on-scan defer'])
+def test_restore_conflicts(
+        snappy_command, fake_zfs, fake_filesystem, tmp_path,
+        fails_with_message, option):
+    snappy_command(f'-s {tmp_path} {fake_filesystem}')
+
+    with fails_with_message('--restore-from requires a single dataset'):
+        snappy_command(f'--restore-from {tmp_path} {option} pool/restored')
+
+    assert 'pool/restored' not in fake_zfs.datasets
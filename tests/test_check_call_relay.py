@@ -0,0 +1,119 @@
+from subprocess import CalledProcessError
+
+import pytest
+
+from snappy.utils import check_call_relay, check_call_fan_out
+
+
+def test_relay(tmp_path):
+    path = tmp_path / 'out'
+    data = b'abc' * 1000000
+
+    (tmp_path / 'in').write_bytes(data)
+
+    checksum = check_call_relay(
+        ['cat', str(tmp_path / 'in')], ['sh', '-c', f'cat > {path}'],
+        checksum=True)
+
+    assert checksum is not None
+    assert path.read_bytes() == data
+    assert checksum.size == len(data)
+    assert str(checksum) == \
+           f'{checksum.algorithm}:{checksum.value}:{len(data)}'
+
+    # The checksum only depends on the data.
+    assert check_call_relay(['printf', 'abc'], ['cat'], checksum=True) == \
+           check_call_relay(['printf', 'abc'], ['cat'], checksum=True)
+
+    # Without a checksum, only the data is relayed.
+    path.unlink()
+
+    assert check_call_relay(
+        ['printf', 'abc'], ['sh', '-c', f'cat > {path}'],
+        checksum=False) is None
+    assert path.read_bytes() == b'abc'
+
+
+def test_source_fails():
+    with pytest.raises(CalledProcessError) as e:
+        check_call_relay(
+            ['sh', '-c', 'printf abc; exit 3'], ['cat'], checksum=False)
+
+    assert e.value.returncode == 3
+
+
+def test_sink_fails():
+    with pytest.raises(CalledProcessError) as e:
+        check_call_relay(['yes'], ['sh', '-c', 'exit 4'], checksum=False)
+
+    assert e.value.returncode == 4
+
+
+def test_fan_out(tmp_path):
+    paths = [tmp_path / 'a', tmp_path / 'b']
+    data = b'abc' * 1000000
+
+    (tmp_path / 'in').write_bytes(data)
+
+    checksum, errors = check_call_fan_out(
+        ['cat', str(tmp_path / 'in')],
+        [['sh', '-c', f'cat > {i}'] for i in paths],
+        checksum=True)
+
+    assert errors == [None, None]
+    assert all(i.read_bytes() == data for i in paths)
+    assert checksum == check_call_relay(
+        ['cat', str(tmp_path / 'in')], ['cat'], checksum=True)
+
+    # Without a checksum, only the data is relayed.
+    assert check_call_fan_out(['printf', 'abc'], [['cat']], checksum=False) \
+           == (None, [None])
+
+
+def test_fan_out_sink_fails(tmp_path):
+    path = tmp_path / 'out'
+
+    # The other sink still receives all the data.
+    checksum, errors = check_call_fan_out(
+        ['head', '-c', '10000000', '/dev/zero'],
+        [['sh', '-c', 'exit 4'], ['sh', '-c', f'cat > {path}']],
+        checksum=False)
+
+    assert errors[0] is not None and errors[0].returncode == 4
+    assert errors[1] is None
+    assert path.stat().st_size == 10000000
+
+    # If all sinks fail, the source is stopped.
+    _, errors = check_call_fan_out(
+        ['yes'], [['sh', '-c', 'exit 5']], checksum=False)
+
+    assert errors[0] is not None and errors[0].returncode == 5
+
+
+def test_fan_out_source_fails():
+    with pytest.raises(CalledProcessError) as e:
+        check_call_fan_out(
+            ['sh', '-c', 'printf abc; exit 3'], [['cat'], ['cat']],
+            checksum=False)
+
+    assert e.value.returncode == 3
+
+
+def test_rate_limit(monkeypatch):
+    # A clock which only advances while sleeping.
+    now = 0.0
+
+    def sleep(delay):
+        nonlocal now
+        now += delay
+
+    monkeypatch.setattr('time.monotonic', lambda: now)
+    monkeypatch.setattr('time.sleep', sleep)
+
+    checksum = check_call_relay(
+        ['head', '-c', '3000000', '/dev/zero'], ['cat'], checksum=True,
+        rate_limit=1000000)
+
+    assert checksum is not None
+    assert checksum.size == 3000000
+    assert now == pytest.approx(3)
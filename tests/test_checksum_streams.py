@@ -0,0 +1,17 @@
+from snappy.zfs import Snapshot, Dataset
+
+
+def test_checksum_streams(snappy_command, fake_zfs, fake_filesystem):
+    fake_zfs.create_dataset('pool/target')
+
+    snappy_command(f'-s pool/target -b pool {fake_filesystem}')
+    assert fake_zfs.user_properties == {}
+
+    snappy_command(
+        f'--checksum-streams -s pool/target -b pool {fake_filesystem}')
+
+    snapshot = Snapshot(
+        Dataset('pool/target/fs'), 'snappy-2001-02-03-091500')
+
+    assert list(fake_zfs.user_properties) == \
+           [(snapshot, 'snappy:stream-checksum')]
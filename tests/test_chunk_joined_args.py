@@ -0,0 +1,18 @@
+from snappy.utils import chunk_joined_args, max_arg_length
+
+
+def test_single_chunk():
+    assert list(chunk_joined_args(['a', 'b', 'c'], ',')) == [['a', 'b', 'c']]
+    assert list(chunk_joined_args([], ',')) == []
+
+
+def test_split():
+    items = [f'snappy-{i:010}' for i in range(20000)]
+    chunks = list(chunk_joined_args(items, ',', len('pool/fs@')))
+
+    assert len(chunks) > 1
+    assert [j for i in chunks for j in i] == items
+
+    for i in chunks:
+        # Including the terminating null byte.
+        assert len('pool/fs@' + ','.join(i)) + 1 <= max_arg_length
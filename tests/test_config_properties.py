@@ -0,0 +1,59 @@
+from snappy.zfs import Dataset
+
+
+def test_config_from_properties(
+        snappy_command, fake_zfs, fake_filesystem, fails_with_message):
+    for i in ['pool/fs/a', 'pool/fs/b', 'pool/other', 'pool/prefixed']:
+        fake_zfs.create_dataset(i)
+
+    fake_zfs.properties[Dataset('pool/fs')] = {
+        'snappy:keep': '1', 'snappy:send-to': 'pool/target'}
+    fake_zfs.properties[Dataset('pool/fs/b')] = {
+        'snappy:snapshot': 'off', 'snappy:keep': 'none',
+        'snappy:send-to': 'none'}
+    fake_zfs.properties[Dataset('pool/other')] = {
+        'snappy:snapshot': 'on', 'snappy:prefix': 'other'}
+
+    # The prefix alone doesn't enable anything.
+    fake_zfs.properties[Dataset('pool/prefixed')] = {'snappy:prefix': 'other'}
+
+    snappy_command('--auto --from-properties pool')
+    snappy_command('--auto --from-properties pool')
+
+    # All properties are read at once and the datasets sharing their values
+    # are handled by the same entry.
+    assert fake_zfs.calls.count('get_inherited_properties') == 2
+    assert fake_zfs.calls.count('create_snapshots') == 4
+
+    # Datasets are sent relative to the dataset the target is set on.
+    assert fake_zfs.get_snapshots('pool/target') == \
+           ['snappy-2001-02-03-101500']
+    assert fake_zfs.get_snapshots('pool/target/a') == \
+           ['snappy-2001-02-03-101500']
+    assert fake_zfs.get_snapshots('pool/fs/b') == []
+    assert fake_zfs.get_snapshots('pool/other') == \
+           ['other-2001-02-03-091500', 'other-2001-02-03-111500']
+    assert fake_zfs.get_snapshots('pool/prefixed') == []
+
+    fake_zfs.properties[Dataset('pool/fs')]['snappy:keep'] = '1x'
+
+    with fails_with_message(
+            'Invalid value of property `snappy:keep\' on `pool/fs\': Unknown '
+            'unit `x\'.'):
+        snappy_command('--auto --from-properties pool')
+
+
+def test_config_from_properties_with_snapshots(
+        snappy_command, fake_zfs, fake_filesystem):
+    fake_zfs.properties[Dataset('pool/fs')] = {
+        'snappy:keep': '2', 'snappy:send-to': 'pool/target'}
+
+    for _ in range(3):
+        snappy_command('--auto --from-properties pool')
+
+    # Snapshots and bookmarks inherit the properties, but aren't configured
+    # themselves.
+    assert list(fake_zfs.get_inherited_properties(
+        [Dataset('pool')], ['snappy:keep'])) == ['pool/fs']
+    assert fake_zfs.get_snapshots('pool/target') == \
+           ['snappy-2001-02-03-091500', 'snappy-2001-02-03-101500']
@@ -0,0 +1,60 @@
+from subprocess import CalledProcessError
+
+
+def test_send_to_multiple_targets(
+        snappy_command, fake_zfs, fake_filesystem, fails_with_message,
+        monkeypatch):
+    streams = []
+    send_receive_snapshot_fan_out = fake_zfs.send_receive_snapshot_fan_out
+    receive_snapshot = fake_zfs._receive_snapshot
+
+    def record_send_receive_snapshot_fan_out(
+            incremental_base, source, targets, **kwargs):
+        streams.append((source.name, [i.dataset for i in targets]))
+
+        return send_receive_snapshot_fan_out(
+            incremental_base, source, targets, **kwargs)
+
+    def fail_receive_snapshot(target, *args):
+        if target.dataset == 'pool/b':
+            raise CalledProcessError(1, ['zfs', 'receive', str(target)])
+
+        receive_snapshot(target, *args)
+
+    monkeypatch.setattr(
+        fake_zfs, 'send_receive_snapshot_fan_out',
+        record_send_receive_snapshot_fan_out)
+
+    snappy_command(f'-s pool/a -s pool/b {fake_filesystem}')
+
+    assert streams == [('snappy-2001-02-03-081500', ['pool/a', 'pool/b'])]
+
+    # Receiving on one target fails, but the other one still receives the
+    # snapshot.
+    monkeypatch.setattr(fake_zfs, '_receive_snapshot', fail_receive_snapshot)
+
+    with fails_with_message('Failed to send snapshots to 1 target'):
+        snappy_command(f'-s pool/a -s pool/b {fake_filesystem}')
+
+    assert fake_zfs.get_snapshots('pool/a') == \
+           ['snappy-2001-02-03-081500', 'snappy-2001-02-03-091500']
+    assert fake_zfs.get_snapshots('pool/b') == ['snappy-2001-02-03-081500']
+
+    # The source keeps what the failed target still needs.
+    assert fake_zfs.get_snapshots(fake_filesystem) == \
+           ['snappy-2001-02-03-091500']
+
+    monkeypatch.setattr(fake_zfs, '_receive_snapshot', receive_snapshot)
+    streams.clear()
+    snappy_command(f'-s pool/a -s pool/b {fake_filesystem}')
+
+    # Once pool/b has caught up, both targets share the stream again.
+    assert streams == [
+        ('snappy-2001-02-03-091500', ['pool/b']),
+        ('snappy-2001-02-03-101500', ['pool/a', 'pool/b'])]
+    assert fake_zfs.get_snapshots('pool/b') == \
+           ['snappy-2001-02-03-081500', 'snappy-2001-02-03-091500',
+            'snappy-2001-02-03-101500']
+    assert fake_zfs.get_snapshots(fake_filesystem) == []
+    assert fake_zfs.get_bookmarks(fake_filesystem) == \
+           ['snappy-2001-02-03-101500']
@@ -0,0 +1,47 @@
+from snappy.zfs import Snapshot, Dataset
+
+
+def test_high_frequency(snappy_command, fake_zfs, fake_filesystem):
+    fake_zfs.create_dataset('pool/target')
+
+    # Taken by another run in the same millisecond.
+    fake_zfs.create_snapshots(
+        [Snapshot(Dataset(fake_filesystem), 'snappy-2001-02-03-081500.000')],
+        [])
+
+    snappy_command(f'--high-frequency {fake_filesystem}')
+    snappy_command(f'--high-frequency {fake_filesystem}')
+
+    names = fake_zfs.get_snapshots(fake_filesystem)
+
+    assert names == [
+        'snappy-2001-02-03-081500.000', 'snappy-2001-02-03-091500.000',
+        'snappy-2001-02-03-101500.000']
+
+    # The backlog is sent as the first snapshot and a single stream with the
+    # remaining ones.
+    snappy_command(f'--high-frequency -S -s pool/target {fake_filesystem}')
+
+    assert fake_zfs.calls.count('send_receive_snapshot') == 2
+    assert fake_zfs.get_snapshots('pool/target') == names
+    assert fake_zfs.get_bookmarks(fake_filesystem) == names[-1:]
+
+
+def test_high_frequency_prune_target(
+        snappy_command, fake_zfs, fake_filesystem):
+    fake_zfs.create_dataset('pool/target')
+
+    for i in range(2):
+        snappy_command(f'--high-frequency {fake_filesystem}')
+
+    fake_zfs.create_snapshots([Snapshot(Dataset(fake_filesystem), 'manual')], [])
+
+    for i in range(2):
+        snappy_command(f'--high-frequency {fake_filesystem}')
+
+    # The snapshot not created by snappy is sent as part of the stream and
+    # interrupts the range destroyed on the target.
+    snappy_command(f'--high-frequency -S -k 1 -s pool/target {fake_filesystem}')
+
+    assert fake_zfs.get_snapshots('pool/target') == \
+           ['manual', 'snappy-2001-02-03-111500.000']
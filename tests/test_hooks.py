@@ -0,0 +1,149 @@
+import json
+import time
+
+import pytest
+
+from snappy.zfs import Snapshot, Dataset
+
+
+def _write_config(config_path, hooks):
+    config_path.write_text(
+        '[[snapshot]]\n'
+        'datasets = ["pool/a", "pool/b"]\n'
+        + ''.join(
+            f'[[snapshot.snapshot_hooks]]\n'
+            + ''.join(f'{k} = {json.dumps(v)}\n' for k, v in i.items())
+            for i in hooks))
+
+
+def test_hooks_wrap_snapshot(
+        snappy_command, fake_zfs, mocked_config_file, tmp_path, monkeypatch):
+    for i in ['pool', 'pool/a', 'pool/b']:
+        fake_zfs.create_dataset(i)
+
+    frozen_path = tmp_path / 'frozen'
+    frozen_states = []
+    original_create_snapshots = fake_zfs.create_snapshots
+
+    def create_snapshots(snapshots, recursive_snapshots):
+        frozen_states.append(frozen_path.read_text())
+        original_create_snapshots(snapshots, recursive_snapshots)
+
+    monkeypatch.setattr(fake_zfs, 'create_snapshots', create_snapshots)
+
+    _write_config(mocked_config_file, [
+        {'dataset': 'pool/a',
+         'freeze': f'echo a >> {frozen_path}',
+         'thaw': f'echo thawed >> {frozen_path}'},
+        {'dataset': 'pool/b', 'freeze': 'sleep 0.2'},
+        # Not snapshotted, so not run.
+        {'dataset': 'pool', 'freeze': 'exit 1'}])
+
+    snappy_command('--auto')
+
+    assert frozen_states == ['a\n']
+    assert frozen_path.read_text() == 'a\nthawed\n'
+
+    # Named after the time when the datasets were frozen, not when the plan
+    # was made.
+    assert fake_zfs.get_snapshots('pool/a') == ['snappy-2001-02-03-091500']
+
+
+def test_freeze_failure(
+        snappy_command, fake_zfs, mocked_config_file, tmp_path):
+    for i in ['pool', 'pool/a', 'pool/b']:
+        fake_zfs.create_dataset(i)
+
+    thawed_path = tmp_path / 'thawed'
+
+    _write_config(mocked_config_file, [
+        {'dataset': 'pool/a',
+         'freeze': 'true',
+         'thaw': f'touch {thawed_path}'},
+        {'dataset': 'pool/b', 'freeze': 'sleep 10', 'timeout': 0.2}])
+
+    with pytest.raises(SystemExit):
+        snappy_command('--auto')
+
+    # Hooks are thawed but no snapshots are taken.
+    assert thawed_path.exists()
+    assert fake_zfs.get_snapshots('pool/a') == []
+    assert fake_zfs.get_snapshots('pool/b') == []
+
+
+def test_timeout_kills_descendants(
+        snappy_command, fake_zfs, mocked_config_file, tmp_path):
+    for i in ['pool', 'pool/a', 'pool/b']:
+        fake_zfs.create_dataset(i)
+
+    late_path = tmp_path / 'late'
+
+    _write_config(mocked_config_file, [
+        {'dataset': 'pool/a',
+         'freeze': f'(sleep 0.3; touch {late_path}) & wait',
+         'timeout': 0.1}])
+
+    with pytest.raises(SystemExit):
+        snappy_command('--auto')
+
+    # The processes started by the hook are killed together with the shell.
+    time.sleep(0.5)
+    assert not late_path.exists()
+
+
+def test_hooks_run_once_on_collision(
+        snappy_command, fake_zfs, mocked_config_file, tmp_path):
+    for i in ['pool', 'pool/a']:
+        fake_zfs.create_dataset(i)
+
+    frozen_path = tmp_path / 'frozen'
+
+    mocked_config_file.write_text(
+        '[[snapshot]]\n'
+        'datasets = ["pool/a"]\n'
+        'high_frequency = true\n'
+        '[[snapshot.snapshot_hooks]]\n'
+        'dataset = "pool/a"\n'
+        f'freeze = "echo frozen >> {frozen_path}"\n'
+        f'thaw = "echo thawed >> {frozen_path}"\n')
+
+    # Taken by another run in the same millisecond.
+    fake_zfs.create_snapshots(
+        [Snapshot(Dataset('pool/a'), 'snappy-2001-02-03-091500.000')], [])
+    fake_zfs.calls.clear()
+
+    snappy_command('--auto')
+
+    # The datasets stay frozen while retrying with a new name, and they are
+    # not inspected again.
+    assert frozen_path.read_text() == 'frozen\nthawed\n'
+    assert fake_zfs.calls.count('create_snapshots') == 2
+    assert 'iter_snapshots_and_bookmarks' not in fake_zfs.calls
+    assert fake_zfs.get_snapshots('pool/a') == \
+           ['snappy-2001-02-03-091500.000', 'snappy-2001-02-03-101500.000']
+
+
+def test_hooks_collision_renames_plan(
+        snappy_command, fake_zfs, mocked_config_file):
+    for i in ['pool', 'pool/a']:
+        fake_zfs.create_dataset(i)
+
+    mocked_config_file.write_text(
+        '[[snapshot]]\n'
+        'datasets = ["pool/a"]\n'
+        'send_target = "pool/target"\n'
+        'prune_keep = ["1"]\n'
+        '[[snapshot.snapshot_hooks]]\n'
+        'dataset = "pool/a"\n'
+        'freeze = "true"\n')
+
+    fake_zfs.create_snapshots(
+        [Snapshot(Dataset('pool/a'), 'snappy-2001-02-03-091500')], [])
+
+    snappy_command('--auto')
+
+    # The existing snapshot is sent too, and the new one is kept under its
+    # new name.
+    assert fake_zfs.calls.count('send_receive_snapshot') == 2
+    assert fake_zfs.get_snapshots('pool/target') == \
+           ['snappy-2001-02-03-101500']
@@ -0,0 +1,28 @@
+from subprocess import CalledProcessError
+
+import pytest
+
+from snappy.utils import iter_output_lines
+
+
+def test_lines():
+    assert list(iter_output_lines(['printf', 'a\\nb c\\n\\nd'])) == \
+           ['a', 'b c', '', 'd']
+
+
+def test_failure():
+    lines = iter_output_lines(['sh', '-c', 'echo a; exit 3'])
+
+    assert next(lines) == 'a'
+
+    with pytest.raises(CalledProcessError):
+        next(lines)
+
+
+def test_stop_early():
+    # Would block forever if we waited for the process to exit on its own.
+    lines = iter_output_lines(['yes'])
+
+    assert next(lines) == 'y'
+
+    lines.close()
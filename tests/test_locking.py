@@ -0,0 +1,42 @@
+import pytest
+
+from snappy.locking import lock_datasets, LockTimeoutError
+from snappy.zfs import Dataset
+
+
+def test_shared_locks():
+    with lock_datasets([], [Dataset('pool/fs')], 0):
+        with lock_datasets([Dataset('pool/fs/a')], [], 0):
+            pass
+
+
+def test_exclusive_lock_covers_subtree():
+    with lock_datasets([Dataset('pool/fs')], [], 0):
+        with pytest.raises(LockTimeoutError):
+            with lock_datasets([Dataset('pool/fs/a')], [], 0.2):
+                pass
+
+        with pytest.raises(LockTimeoutError):
+            with lock_datasets([Dataset('pool')], [], 0):
+                pass
+
+        # Siblings are not affected.
+        with lock_datasets([Dataset('pool/other')], [], 0):
+            pass
+
+
+def test_skip_if_busy(snappy_command, fake_zfs):
+    fake_zfs.create_dataset('pool')
+    fake_zfs.create_dataset('pool/fs')
+    fake_zfs.create_dataset('pool/other')
+
+    with lock_datasets([Dataset('pool/fs')], [], 0):
+        snappy_command('--skip-if-busy -r pool')
+        snappy_command('--skip-if-busy pool/other')
+
+        with pytest.raises(SystemExit):
+            snappy_command('--lock-timeout 0 pool/fs')
+
+    assert fake_zfs.get_snapshots('pool') == []
+    assert fake_zfs.get_snapshots('pool/fs') == []
+    assert fake_zfs.get_snapshots('pool/other') == ['snappy-2001-02-03-081500']
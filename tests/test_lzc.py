@@ -0,0 +1,107 @@
+from subprocess import CalledProcessError
+from types import SimpleNamespace
+
+import pytest
+
+from snappy.lzc import LzcBackend
+from snappy.utils import UserError
+from snappy.zfs import Dataset, Snapshot, Bookmark, SnapshotRange
+
+
+class _ZFSError(Exception):
+    errno = 2
+
+
+@pytest.fixture
+def libzfs_core(monkeypatch):
+    calls = []
+
+    def record(name):
+        def fn(*args):
+            calls.append((name, *args))
+
+        return fn
+
+    def lzc_snapshot(snapshots):
+        if b'pool/missing@s' in snapshots:
+            raise _ZFSError()
+
+        calls.append(('lzc_snapshot', snapshots))
+
+    module = SimpleNamespace(
+        calls=calls,
+        exceptions=SimpleNamespace(ZFSError=_ZFSError),
+        lzc_snapshot=lzc_snapshot,
+        lzc_bookmark=record('lzc_bookmark'),
+        lzc_destroy_snaps=record('lzc_destroy_snaps'),
+        lzc_destroy_bookmarks=record('lzc_destroy_bookmarks'))
+
+    monkeypatch.setattr('snappy.lzc.libzfs_core', module)
+
+    return module
+
+
+def test_lzc_backend_unavailable(
+        snappy_command, fails_with_message, monkeypatch):
+    monkeypatch.setattr('snappy.lzc.libzfs_core', None)
+
+    with fails_with_message('requires the Python bindings for libzfs_core'):
+        snappy_command('--zfs-backend lzc fishtank')
+
+
+def test_create_snapshots(libzfs_core, monkeypatch):
+    backend = LzcBackend()
+
+    # Listing the descendants is done using the `zfs' command.
+    monkeypatch.setattr(
+        backend, 'iter_children',
+        lambda dataset, *, quiet: iter([dataset, Dataset(f'{dataset}/a')]))
+
+    backend.create_snapshots(
+        [Snapshot(Dataset('pool/fs'), 's'), Snapshot(Dataset('tank/fs'), 's')],
+        [Snapshot(Dataset('pool/other'), 's')])
+
+    # A single call is made per pool.
+    assert libzfs_core.calls == [
+        ('lzc_snapshot', [b'pool/fs@s', b'pool/other@s', b'pool/other/a@s']),
+        ('lzc_snapshot', [b'tank/fs@s'])]
+
+
+def test_destroy(libzfs_core):
+    backend = LzcBackend()
+    dataset = Dataset('pool/fs')
+
+    backend.destroy_snapshots(
+        [SnapshotRange(dataset, ('a', 'b', 'c')), Snapshot(dataset, 'd')], [])
+    backend.destroy_bookmarks([Bookmark(dataset, 'a')])
+
+    assert libzfs_core.calls == [
+        ('lzc_destroy_snaps',
+         [b'pool/fs@a', b'pool/fs@b', b'pool/fs@c', b'pool/fs@d'], False),
+        ('lzc_destroy_bookmarks', [b'pool/fs#a'])]
+
+
+def test_errors(libzfs_core, monkeypatch):
+    backend = LzcBackend()
+
+    # Errors are reported like those of the `zfs' command.
+    with pytest.raises(CalledProcessError) as e:
+        backend.create_snapshots([Snapshot(Dataset('pool/missing'), 's')], [])
+
+    assert e.value.cmd == ['lzc_snapshot', 'pool/missing@s']
+
+    backend.create_bookmarks(
+        {Bookmark(Dataset('pool/fs'), 'b'): Snapshot(Dataset('pool/fs'), 's')})
+
+    assert libzfs_core.calls == [
+        ('lzc_bookmark', {b'pool/fs#b': b'pool/fs@s'})]
+
+    def lzc_destroy_bookmarks(bookmarks):
+        raise NotImplementedError
+
+    # Functions missing from the installed version of libzfs_core.
+    monkeypatch.setattr(
+        libzfs_core, 'lzc_destroy_bookmarks', lzc_destroy_bookmarks)
+
+    with pytest.raises(UserError, match=r'requires lzc_destroy_bookmarks\(\)'):
+        backend.destroy_bookmarks([Bookmark(Dataset('pool/fs'), 'b')])
@@ -0,0 +1,65 @@
+import json
+
+
+def test_plan(snappy_command, fake_zfs, fake_filesystem, capsys):
+    snappy_command(f'{fake_filesystem}')
+    capsys.readouterr()
+    fake_zfs.calls.clear()
+
+    snappy_command(f'--plan -s pool/target {fake_filesystem}')
+
+    assert capsys.readouterr().out == (
+        'Snapshots to create: 1\n'
+        '  pool/fs@snappy-2001-02-03-091500\n'
+        'Datasets to send: 1, about 0B\n'
+        '  pool/fs -> pool/target: 2 snapshots, about 0B\n'
+        'Snapshots to destroy: 2\n'
+        '  pool/fs@snappy-2001-02-03-081500,snappy-2001-02-03-091500\n'
+        'Bookmarks to destroy: 1\n'
+        'zfs commands: 11\n')
+
+    # Nothing has been changed.
+    assert fake_zfs.calls == [
+        'iter_snapshots_and_bookmarks', 'iter_snapshots_and_bookmarks',
+        'get_properties', 'estimate_send_size']
+    assert fake_zfs.get_snapshots(fake_filesystem) == ['snappy-2001-02-03-081500']
+
+
+def test_plan_json(snappy_command, fake_zfs, fake_filesystem, capsys):
+    snappy_command(f'-s pool/target {fake_filesystem}')
+    snappy_command(f'-s pool/target {fake_filesystem}')
+    capsys.readouterr()
+
+    snappy_command(f'--plan json -k 1 -s pool/target {fake_filesystem}')
+
+    plan, = json.loads(capsys.readouterr().out)
+
+    assert plan['create_snapshots'] == ['pool/fs@snappy-2001-02-03-101500']
+    assert plan['sends'] == [{
+        'source': 'pool/fs',
+        'target': 'pool/target',
+        'incremental_base': 'pool/fs#snappy-2001-02-03-091500',
+        'move_target_away': False,
+        'snapshots': ['pool/fs@snappy-2001-02-03-101500'],
+        'estimated_size': 0}]
+    assert plan['destroy_snapshots'] == [
+        'pool/fs@snappy-2001-02-03-101500',
+        'pool/target@snappy-2001-02-03-081500',
+        'pool/target@snappy-2001-02-03-091500']
+    assert plan['destroy_bookmarks'] == ['pool/fs#snappy-2001-02-03-091500']
+    assert fake_zfs.get_snapshots('pool/target') == \
+           ['snappy-2001-02-03-081500', 'snappy-2001-02-03-091500']
+
+
+def test_plan_archive(
+        snappy_command, fake_zfs, fake_filesystem, capsys, tmp_path):
+    snappy_command(f'{fake_filesystem}')
+    capsys.readouterr()
+
+    snappy_command(f'--plan json -s {tmp_path} {fake_filesystem}')
+
+    plan, = json.loads(capsys.readouterr().out)
+
+    # Creating the snapshot, creating 2 bookmarks, listing the source,
+    # sending 2 streams, destroying a bookmark and destroying the snapshots.
+    assert plan['zfs_commands'] == 8
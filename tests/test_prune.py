@@ -1,4 +1,10 @@
+import threading
+from subprocess import CalledProcessError
+
+import pytest
+
 from conftest import get_snapshots
+from snappy.zfs import Snapshot, Dataset
 
 
 def test_prune(filesystem, snappy_command):
@@ -29,3 +35,202 @@ def test_last_snapshot_kept(filesystem, snappy_command):
     # prevent losing the most recent snapshot on a received dataset.
     assert get_snapshots(filesystem) == \
            ['snappy-2001-02-03-081500', 'snappy-2001-02-03-101500']
+
+
+def _record_destroy_snapshots(fake_zfs, monkeypatch):
+    calls = []
+    original_destroy_snapshots = fake_zfs.destroy_snapshots
+
+    def destroy_snapshots(snapshots, recursive_snapshots):
+        calls.append(
+            ([str(i) for i in snapshots], [str(i) for i in recursive_snapshots]))
+        original_destroy_snapshots(snapshots, recursive_snapshots)
+
+    monkeypatch.setattr(fake_zfs, 'destroy_snapshots', destroy_snapshots)
+
+    return calls
+
+
+def test_prune_ranges(snappy_command, fake_zfs, fake_filesystem, monkeypatch):
+    for i in range(3):
+        snappy_command(f'{fake_filesystem}')
+
+    # A snapshot not created by snappy interrupts the range.
+    fake_zfs.create_snapshots([Snapshot(Dataset(fake_filesystem), 'manual')], [])
+
+    for i in range(3):
+        snappy_command(f'{fake_filesystem}')
+
+    destroy_snapshots_calls = _record_destroy_snapshots(fake_zfs, monkeypatch)
+    snappy_command(f'-S -k 1 {fake_filesystem}')
+
+    assert destroy_snapshots_calls == [
+        (['pool/fs@snappy-2001-02-03-111500',
+          'pool/fs@snappy-2001-02-03-121500',
+          'pool/fs@snappy-2001-02-03-081500%snappy-2001-02-03-101500'],
+         [])]
+
+    assert fake_zfs.get_snapshots(fake_filesystem) == \
+           ['manual', 'snappy-2001-02-03-131500']
+
+
+def test_prune_recursive(
+        snappy_command, fake_zfs, fake_filesystem, monkeypatch):
+    for i in ['a', 'b']:
+        fake_zfs.create_dataset(f'{fake_filesystem}/{i}')
+
+    for i in range(2):
+        snappy_command(f'-r {fake_filesystem}')
+
+    # Only exists on a single dataset and is kept there.
+    snappy_command(f'{fake_filesystem}/a')
+
+    destroy_snapshots_calls = _record_destroy_snapshots(fake_zfs, monkeypatch)
+    snappy_command(f'-r -S -k 1 {fake_filesystem}')
+
+    # The most recent snapshot of `a` must not be destroyed recursively.
+    assert sorted(destroy_snapshots_calls) == [
+        ([], ['pool/fs@snappy-2001-02-03-081500']),
+        (['pool/fs/a@snappy-2001-02-03-091500'], [])]
+
+    assert fake_zfs.get_snapshots(fake_filesystem) == \
+           ['snappy-2001-02-03-091500']
+    assert fake_zfs.get_snapshots(f'{fake_filesystem}/a') == \
+           ['snappy-2001-02-03-101500']
+    assert fake_zfs.get_snapshots(f'{fake_filesystem}/b') == \
+           ['snappy-2001-02-03-091500']
+
+
+def test_prune_errors(snappy_command, fake_zfs, fake_filesystem, monkeypatch):
+    for i in ['a', 'b', 'c']:
+        fake_zfs.create_dataset(f'{fake_filesystem}/{i}')
+
+    for i in range(2):
+        snappy_command(f'{fake_filesystem}/a {fake_filesystem}/b {fake_filesystem}/c')
+
+    original_destroy_snapshots = fake_zfs.destroy_snapshots
+
+    def destroy_snapshots(snapshots, recursive_snapshots):
+        if snapshots[0].dataset == f'{fake_filesystem}/b':
+            raise CalledProcessError(1, ['zfs', 'destroy'])
+
+        original_destroy_snapshots(snapshots, recursive_snapshots)
+
+    monkeypatch.setattr(fake_zfs, 'destroy_snapshots', destroy_snapshots)
+
+    # The other datasets are still pruned.
+    with pytest.raises(SystemExit):
+        snappy_command(
+            f'-S -k 1 {fake_filesystem}/a {fake_filesystem}/b '
+            f'{fake_filesystem}/c')
+
+    assert fake_zfs.get_snapshots(f'{fake_filesystem}/a') == \
+           ['snappy-2001-02-03-091500']
+    assert fake_zfs.get_snapshots(f'{fake_filesystem}/b') == \
+           ['snappy-2001-02-03-081500', 'snappy-2001-02-03-091500']
+    assert fake_zfs.get_snapshots(f'{fake_filesystem}/c') == \
+           ['snappy-2001-02-03-091500']
+
+
+def test_max_capacity(snappy_command, fake_zfs, fake_filesystem):
+    for i in range(4):
+        snappy_command(fake_filesystem)
+
+    names = fake_zfs.get_snapshots(fake_filesystem)
+
+    for i in names:
+        fake_zfs.snapshot_sizes[Snapshot(Dataset(fake_filesystem), i)] = 10
+
+    # Pool is 90% full, 20 bytes need to be freed to get to 70%.
+    fake_zfs.properties[Dataset('pool')] = {'used': '90', 'available': '10'}
+    snappy_command(f'-S -k 10 --max-capacity 70 {fake_filesystem}')
+
+    assert fake_zfs.get_snapshots(fake_filesystem) == names[2:]
+
+    # Even the most recent snapshot is not enough, so all others are destroyed.
+    fake_zfs.properties[Dataset('pool')] = {'used': '99', 'available': '1'}
+    snappy_command(f'-S -k 10 --max-capacity 10 {fake_filesystem}')
+
+    assert fake_zfs.get_snapshots(fake_filesystem) == names[3:]
+
+
+def test_prune_while_sending(
+        snappy_command, fake_zfs, fake_filesystem, monkeypatch):
+    fake_zfs.create_dataset(f'{fake_filesystem}/a')
+    fake_zfs.create_dataset('pool/target')
+
+    for _ in range(2):
+        snappy_command(f'-r -s pool/target -b pool {fake_filesystem}')
+
+    target_pruned = threading.Event()
+    destroy_snapshots = fake_zfs.destroy_snapshots
+    send_receive_snapshot = fake_zfs.send_receive_snapshot
+
+    def record_destroy_snapshots(snapshots, recursive_snapshots):
+        destroy_snapshots(snapshots, recursive_snapshots)
+
+        if any(i.dataset == 'pool/target/fs' for i in snapshots):
+            target_pruned.set()
+
+    def wait_send_receive_snapshot(incremental_base, source, target, **kwargs):
+        # The first target is pruned while the second dataset is sent.
+        if source.dataset == 'pool/fs/a':
+            assert target_pruned.wait(5)
+
+        return send_receive_snapshot(
+            incremental_base, source, target, **kwargs)
+
+    monkeypatch.setattr(fake_zfs, 'destroy_snapshots', record_destroy_snapshots)
+    monkeypatch.setattr(
+        fake_zfs, 'send_receive_snapshot', wait_send_receive_snapshot)
+
+    snappy_command(f'-r -k 1 -s pool/target -b pool {fake_filesystem}')
+
+    assert fake_zfs.get_snapshots('pool/target/fs') == \
+           ['snappy-2001-02-03-101500']
+    assert fake_zfs.get_snapshots('pool/target/fs/a') == \
+           ['snappy-2001-02-03-101500']
+
+
+def test_prune_errors_while_sending(
+        snappy_command, fake_zfs, fake_filesystem, fails_with_message,
+        monkeypatch):
+    fake_zfs.create_dataset(f'{fake_filesystem}/a')
+    fake_zfs.create_dataset('pool/target')
+
+    for _ in range(2):
+        snappy_command(f'{fake_filesystem}/a {fake_filesystem}')
+
+    destroy_snapshots = fake_zfs.destroy_snapshots
+    send_receive_snapshot = fake_zfs.send_receive_snapshot
+    errors = []
+
+    def failing_destroy_snapshots(snapshots, recursive_snapshots):
+        if snapshots[0].dataset == 'pool/target/fs':
+            raise CalledProcessError(1, ['zfs', 'destroy'])
+
+        destroy_snapshots(snapshots, recursive_snapshots)
+
+    def failing_send_receive_snapshot(
+            incremental_base, source, target, **kwargs):
+        if source.dataset == 'pool/fs/a':
+            raise CalledProcessError(1, ['zfs', 'send'])
+
+        return send_receive_snapshot(
+            incremental_base, source, target, **kwargs)
+
+    monkeypatch.setattr(fake_zfs, 'destroy_snapshots', failing_destroy_snapshots)
+    monkeypatch.setattr(
+        fake_zfs, 'send_receive_snapshot', failing_send_receive_snapshot)
+    monkeypatch.setattr('logging.error', errors.append)
+
+    # The target of the first dataset is pruned while the second one is sent.
+    with fails_with_message('Internal command failed'):
+        snappy_command(
+            f'-k 1 -s pool/target -b pool {fake_filesystem} '
+            f'{fake_filesystem}/a')
+
+    # Destroying the snapshots of the first target failed too.
+    assert errors == [
+        'Failed to destroy snapshots of pool/target/fs: zfs destroy',
+        'error: Internal command failed: zfs send']
@@ -0,0 +1,84 @@
+from snappy.zfs import Snapshot, Dataset
+
+
+def test_replicate(snappy_command, fake_zfs, fake_filesystem):
+    fake_zfs.create_dataset('pool/target')
+
+    for i in ['a', 'b']:
+        fake_zfs.create_dataset(f'{fake_filesystem}/{i}')
+
+    command = f'-r --replicate -s pool/target -b pool {fake_filesystem}'
+
+    snappy_command(command)
+    snappy_command(command)
+
+    assert fake_zfs.calls.count('send_receive_replication') == 2
+    assert fake_zfs.calls.count('send_receive_snapshot') == 0
+
+    # The most recent snapshot is kept as the base of the next stream.
+    for i in ['', '/a', '/b']:
+        assert fake_zfs.get_snapshots(f'{fake_filesystem}{i}') == \
+               ['snappy-2001-02-03-091500']
+        assert fake_zfs.get_snapshots(f'pool/target/fs{i}') == \
+               ['snappy-2001-02-03-081500', 'snappy-2001-02-03-091500']
+
+    # A new dataset has no target yet, so everything is sent separately once.
+    fake_zfs.create_dataset(f'{fake_filesystem}/c')
+    snappy_command(command)
+
+    assert fake_zfs.calls.count('send_receive_replication') == 2
+    assert fake_zfs.calls.count('send_receive_snapshot') == 4
+
+    snappy_command(command)
+
+    assert fake_zfs.calls.count('send_receive_replication') == 3
+    assert fake_zfs.calls.count('send_receive_snapshot') == 4
+
+    for i in ['', '/a', '/b', '/c']:
+        assert fake_zfs.get_snapshots(f'{fake_filesystem}{i}') == \
+               ['snappy-2001-02-03-111500']
+
+    assert fake_zfs.get_snapshots('pool/target/fs/c') == \
+           ['snappy-2001-02-03-101500', 'snappy-2001-02-03-111500']
+
+
+def test_replicate_prune_target(snappy_command, fake_zfs, fake_filesystem):
+    fake_zfs.create_dataset('pool/target')
+    fake_zfs.create_dataset(f'{fake_filesystem}/a')
+
+    for i in range(2):
+        snappy_command(f'-r {fake_filesystem}')
+
+    fake_zfs.create_snapshots(
+        [Snapshot(Dataset(i), 'manual')
+         for i in [fake_filesystem, f'{fake_filesystem}/a']],
+        [])
+
+    for i in range(2):
+        snappy_command(f'-r {fake_filesystem}')
+
+    # The snapshot not created by snappy is sent as part of the stream and
+    # interrupts the range destroyed on the targets.
+    snappy_command(f'-r --replicate -k 1 -s pool/target -b pool {fake_filesystem}')
+
+    for i in ['', '/a']:
+        assert fake_zfs.get_snapshots(f'pool/target/fs{i}') == \
+               ['manual', 'snappy-2001-02-03-121500']
+
+
+def test_replicate_modified_target(snappy_command, fake_zfs, fake_filesystem):
+    fake_zfs.create_dataset('pool/target')
+    fake_zfs.create_dataset(f'{fake_filesystem}/a')
+
+    command = f'-r --replicate -s pool/target -b pool {fake_filesystem}'
+
+    snappy_command(command)
+
+    # E.g. access times updated by reading the target.
+    fake_zfs.modified.add(Dataset('pool/target/fs/a'))
+    snappy_command(command)
+
+    assert fake_zfs.calls.count('rollback_snapshot') == 2
+    assert fake_zfs.calls.count('send_receive_replication') == 2
+    assert fake_zfs.get_snapshots('pool/target/fs/a') == \
+           ['snappy-2001-02-03-081500', 'snappy-2001-02-03-091500']
@@ -0,0 +1,42 @@
+import snappy.snappy
+from snappy.zfs import Dataset
+
+
+def test_defer_during_scan(snappy_command, fake_zfs, fake_filesystem, capsys):
+    fake_zfs.create_dataset('backup')
+    snappy_command(f'-k 1 -s backup/fs {fake_filesystem}')
+
+    fake_zfs.scans[Dataset('backup')] = 'scrub'
+    snappy_command(f'--on-scan defer -k 1 -s backup/fs {fake_filesystem}')
+
+    # The snapshot is still created, but neither sent nor pruned.
+    assert fake_zfs.calls.count('get_scanning_pools') == 1
+    assert fake_zfs.get_snapshots(fake_filesystem) == \
+           ['snappy-2001-02-03-091500']
+    assert fake_zfs.get_snapshots('backup/fs') == ['snappy-2001-02-03-081500']
+
+    capsys.readouterr()
+    snappy_command(
+        f'--plan --on-scan defer -S -k 1 -s backup/fs {fake_filesystem}')
+
+    # Pruning the target is deferred until it has received the snapshots.
+    assert 'Datasets deferred until scans finish: 2\n  pool/fs\n  backup/fs\n' \
+           in capsys.readouterr().out
+
+    del fake_zfs.scans[Dataset('backup')]
+    snappy_command(f'--on-scan defer -S -k 1 -s backup/fs {fake_filesystem}')
+
+    assert fake_zfs.get_snapshots(fake_filesystem) == []
+    assert fake_zfs.get_snapshots('backup/fs') == ['snappy-2001-02-03-091500']
+
+
+def test_throttle_during_scan(snappy_command, fake_zfs, fake_filesystem):
+    fake_zfs.create_dataset('backup')
+    fake_zfs.create_dataset('tank')
+    fake_zfs.scans[Dataset('backup')] = 'resilver'
+
+    snappy_command(f'--on-scan throttle -s backup/fs {fake_filesystem}')
+    snappy_command(f'--on-scan throttle -s tank/fs {fake_filesystem}')
+
+    # Only sends to the pool being resilvered are limited.
+    assert fake_zfs.send_rate_limits == [snappy.snappy.throttled_send_rate, None]
@@ -3,7 +3,7 @@ from datetime import datetime
 from snappy.config import parse_keep_spec
 from snappy.snapshots import find_expired_snapshots
 from snappy.utils import timestamp_format
-from snappy.zfs import Dataset, Snapshot, SnapshotInfo
+from snappy.zfs import Dataset, Snapshot, SnapshotTable
 
 
 snapshot_timestamps = [
@@ -21,20 +21,21 @@ snapshot_timestamps = [
     '2023-02-27 15:05']
 
 
-def snapshots_from_timestamps(timestamps: list[str]) -> list[SnapshotInfo]:
-    res: list[SnapshotInfo] = []
+def snapshots_from_timestamps(timestamps: list[str]) -> SnapshotTable[Snapshot]:
+    res = SnapshotTable(Snapshot, Dataset('dummy'))
 
     for i, t in enumerate(timestamps):
         name = f'foo-{datetime.fromisoformat(t):{timestamp_format}}'
 
-        res.append(SnapshotInfo(Snapshot(Dataset('dummy'), name), i, i))
+        res.append(name, i, i)
 
     return res
 
 
 def check_kept_snapshots(
         keep_spec_strs: list[str],
-        expected_selected_snapshot_names: list[str]) \
+        expected_selected_snapshot_names: list[str],
+        carry_over: bool = False) \
         -> None:
     keep_specs = [parse_keep_spec(i) for i in keep_spec_strs]
 
@@ -44,7 +45,7 @@ def check_kept_snapshots(
 
     selected_snapshots = \
         {i.ref for i in snapshots_from_timestamps(snapshot_timestamps)} \
-        - find_expired_snapshots(snapshots, keep_specs, 'foo')
+        - find_expired_snapshots(snapshots, keep_specs, 'foo', carry_over)
 
     assert selected_snapshots == expected_selected_snapshots
 
@@ -79,3 +80,20 @@ def test_keep_combined():
         ['1h:2', '1w'],
         ['2023-02-12 23:59', '2023-02-13 01:00', '2023-02-20 01:00',
          '2023-02-26 13:02', '2023-02-27 15:03'])
+
+
+def test_keep_hourly_carry_over():
+    # The hours after the snapshot at 13:03 are represented by it.
+    check_kept_snapshots(
+        ['1h:3'],
+        ['2023-02-26 13:03', '2023-02-27 15:03'],
+        carry_over=True)
+
+
+def test_keep_daily_carry_over():
+    # The days between the 20th and the 25th count as well.
+    check_kept_snapshots(
+        ['1d:5'],
+        ['2023-02-20 01:00', '2023-02-25 11:00', '2023-02-26 13:02',
+         '2023-02-27 15:03'],
+        carry_over=True)
@@ -0,0 +1,68 @@
+import pytest
+
+from snappy.selector import DatasetSelector
+from snappy.utils import UserError
+
+
+def select(datasets, exclude, candidates, recursive=True):
+    selector = DatasetSelector(datasets, exclude, recursive)
+
+    return [i for i in candidates if selector.matches(i)]
+
+
+def test_nearest_match_wins():
+    candidates = [
+        'tank', 'tank/a', 'tank/a/x', 'tank/a/x/y', 'tank/b', 'tanker']
+
+    assert select(['tank', 'tank/a/x'], ['tank/a'], candidates) == \
+           ['tank', 'tank/a/x', 'tank/a/x/y', 'tank/b']
+
+
+def test_exclude_wins_ties():
+    assert select(['tank/a'], ['tank/a'], ['tank/a', 'tank/a/b']) == []
+
+
+def test_glob():
+    candidates = [
+        'tank/vm', 'tank/vm/one', 'tank/vm/one/swap', 'tank/vm/one/root',
+        'tank/vm/two/swap', 'tank/vm/two/swap/x']
+
+    assert select(['tank/vm'], ['tank/vm/*/swap'], candidates) == \
+           ['tank/vm', 'tank/vm/one', 'tank/vm/one/root']
+
+    # Without recursion, only the datasets matching the pattern are selected.
+    assert select(['tank/vm/*/swap'], [], candidates, recursive=False) == \
+           ['tank/vm/one/swap', 'tank/vm/two/swap']
+
+
+def test_regex():
+    candidates = ['tank/vm-1', 'tank/vm-12', 'tank/vm-x', 'tank/vm-1/disk']
+
+    assert select(['re:tank/vm-[0-9]+'], [], candidates, recursive=False) == \
+           ['tank/vm-1', 'tank/vm-12']
+
+
+def test_roots():
+    selector = DatasetSelector(
+        ['tank/a/*/b', 'tank/a', 'tank/c', 're:other/.*'], [], True)
+
+    assert selector.roots == ['other', 'tank/a', 'tank/c']
+    assert selector.has_patterns
+
+
+@pytest.mark.parametrize('pattern', ['*/a', 'tank//a', 're:tank/(', 're:.*'])
+def test_invalid_patterns(pattern):
+    with pytest.raises(UserError):
+        DatasetSelector([pattern], [], True)
+
+
+def test_glob_exclude(snappy_command, fake_zfs, fake_filesystem):
+    for i in ['a', 'a/swap', 'b', 'b/swap', 'b/swap/x']:
+        fake_zfs.create_dataset(f'{fake_filesystem}/{i}')
+
+    snappy_command(f'-r -e {fake_filesystem}/*/swap {fake_filesystem}')
+
+    assert fake_zfs.get_snapshots(f'{fake_filesystem}/a')
+    assert fake_zfs.get_snapshots(f'{fake_filesystem}/b')
+    assert not fake_zfs.get_snapshots(f'{fake_filesystem}/a/swap')
+    assert not fake_zfs.get_snapshots(f'{fake_filesystem}/b/swap/x')
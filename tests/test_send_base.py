@@ -0,0 +1,154 @@
+import dataclasses
+from subprocess import CalledProcessError
+
+from snappy.zfs import Snapshot, Dataset
+
+
+def test_send_probes_target(snappy_command, fake_zfs, fake_filesystem):
+    snappy_command(f'-s pool/target {fake_filesystem}')
+    fake_zfs.calls.clear()
+    snappy_command(f'-s pool/target {fake_filesystem}')
+
+    # The incremental base is found on the target without listing it. Only the
+    # source is listed.
+    assert fake_zfs.calls.count('get_snapshot_info') == 1
+    assert fake_zfs.calls.count('iter_snapshots_and_bookmarks') == 1
+    assert fake_zfs.get_snapshots('pool/target') == \
+           ['snappy-2001-02-03-081500', 'snappy-2001-02-03-091500']
+
+
+def test_send_probe_mismatch(snappy_command, fake_zfs, fake_filesystem):
+    snappy_command(f'-s pool/target {fake_filesystem}')
+
+    # Replace the snapshot on the target with an unrelated one of the same name.
+    fake_zfs.datasets['pool/target'].snapshots[0].guid = 1
+
+    snappy_command(f'-s pool/target {fake_filesystem}')
+
+    assert 'pool/target-snappy-moved-2001-02-03-101500' in fake_zfs.datasets
+    assert fake_zfs.get_snapshots('pool/target') == ['snappy-2001-02-03-091500']
+
+
+def test_send_probe_newer_snapshot(
+        snappy_command, fake_zfs, fake_filesystem):
+    snappy_command(f'-s pool/target {fake_filesystem}')
+    fake_zfs.create_snapshots([Snapshot(Dataset('pool/target'), 'manual')], [])
+    fake_zfs.calls.clear()
+
+    snappy_command(f'-s pool/target {fake_filesystem}')
+
+    # The bookmark matches a snapshot on the target, but not its most recent
+    # one, so receiving without -F fails and the target is listed to report
+    # the rollback.
+    assert fake_zfs.calls.count('send_receive_snapshot') == 2
+    assert fake_zfs.calls.count('iter_snapshots_and_bookmarks') == 2
+    assert fake_zfs.get_snapshots('pool/target') == \
+           ['snappy-2001-02-03-081500', 'snappy-2001-02-03-091500']
+
+
+def test_send_probe_modified_target(
+        snappy_command, fake_zfs, fake_filesystem):
+    snappy_command(f'-s pool/target {fake_filesystem}')
+    fake_zfs.modified.add(Dataset('pool/target'))
+    fake_zfs.calls.clear()
+
+    snappy_command(f'-s pool/target {fake_filesystem}')
+
+    # The changes are discarded, as the base is the most recent snapshot.
+    assert fake_zfs.calls.count('send_receive_snapshot') == 2
+    assert fake_zfs.get_snapshots('pool/target') == \
+           ['snappy-2001-02-03-081500', 'snappy-2001-02-03-091500']
+
+
+def test_send_probe_fan_out(snappy_command, fake_zfs, fake_filesystem):
+    snappy_command(f'-s pool/a -s pool/b {fake_filesystem}')
+    fake_zfs.create_snapshots([Snapshot(Dataset('pool/b'), 'manual')], [])
+    fake_zfs.modified.add(Dataset('pool/a'))
+
+    snappy_command(f'-s pool/a -s pool/b {fake_filesystem}')
+
+    for i in ['pool/a', 'pool/b']:
+        assert fake_zfs.get_snapshots(i) == \
+               ['snappy-2001-02-03-081500', 'snappy-2001-02-03-091500']
+
+
+def test_send_older_common_base(snappy_command, fake_zfs, fake_filesystem):
+    snappy_command(f'-s pool/target {fake_filesystem}')
+    snappy_command(f'-s pool/target {fake_filesystem}')
+
+    # The bookmark of the most recent snapshot is lost, but one of an older
+    # snapshot was kept under a different name, and a snapshot has been taken
+    # on the target.
+    source = fake_zfs.datasets[Dataset(fake_filesystem)]
+    target = fake_zfs.datasets[Dataset('pool/target')]
+    source.bookmarks = [dataclasses.replace(target.snapshots[0], name='kept')]
+    fake_zfs.create_snapshots(
+        [Snapshot(Dataset('pool/target'), 'manual')], [])
+
+    snappy_command(f'-s pool/target {fake_filesystem}')
+
+    # The target is rolled back to the common snapshot instead of being moved
+    # away.
+    assert fake_zfs.get_snapshots('pool/target') == \
+           ['snappy-2001-02-03-081500', 'snappy-2001-02-03-101500']
+    assert not any('moved' in i for i in fake_zfs.datasets)
+
+
+def test_keep_bookmarks(snappy_command, fake_zfs, fake_filesystem):
+    for _ in range(4):
+        snappy_command(f'-s pool/target --keep-bookmarks 3 {fake_filesystem}')
+
+    assert fake_zfs.get_bookmarks(fake_filesystem) == [
+        'snappy-2001-02-03-091500', 'snappy-2001-02-03-101500',
+        'snappy-2001-02-03-111500']
+
+    # The most recent snapshots are lost on the target, an older bookmark is
+    # used as the incremental base.
+    del fake_zfs.datasets[Dataset('pool/target')].snapshots[2:]
+
+    snappy_command(f'-s pool/target --keep-bookmarks 3 {fake_filesystem}')
+
+    assert fake_zfs.get_snapshots('pool/target') == [
+        'snappy-2001-02-03-081500', 'snappy-2001-02-03-091500',
+        'snappy-2001-02-03-121500']
+    assert fake_zfs.get_bookmarks(fake_filesystem) == [
+        'snappy-2001-02-03-101500', 'snappy-2001-02-03-111500',
+        'snappy-2001-02-03-121500']
+
+
+def test_keep_bookmarks_resume(
+        snappy_command, fake_zfs, fake_filesystem, fails_with_message,
+        monkeypatch):
+    snappy_command(fake_filesystem)
+    snappy_command(fake_filesystem)
+
+    original_send_receive_snapshot = fake_zfs.send_receive_snapshot
+    sends = []
+
+    def send_receive_snapshot(*args, **kwargs):
+        sends.append(args)
+
+        if len(sends) == 2:
+            raise CalledProcessError(1, ['zfs', 'send'])
+
+        return original_send_receive_snapshot(*args, **kwargs)
+
+    monkeypatch.setattr(
+        fake_zfs, 'send_receive_snapshot', send_receive_snapshot)
+
+    # Interrupted after sending the first snapshot, leaving the bookmarks of
+    # all snapshots behind.
+    with fails_with_message('zfs send'):
+        snappy_command(f'-s pool/target --keep-bookmarks 3 {fake_filesystem}')
+
+    monkeypatch.setattr(
+        fake_zfs, 'send_receive_snapshot', original_send_receive_snapshot)
+
+    snappy_command(f'-s pool/target --keep-bookmarks 3 {fake_filesystem}')
+
+    assert fake_zfs.get_snapshots('pool/target') == [
+        'snappy-2001-02-03-081500', 'snappy-2001-02-03-091500',
+        'snappy-2001-02-03-101500', 'snappy-2001-02-03-111500']
+    assert fake_zfs.get_bookmarks(fake_filesystem) == [
+        'snappy-2001-02-03-091500', 'snappy-2001-02-03-101500',
+        'snappy-2001-02-03-111500']
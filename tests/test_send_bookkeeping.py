@@ -0,0 +1,56 @@
+from subprocess import CalledProcessError
+
+
+def test_send_batches_bookkeeping(snappy_command, fake_zfs, fake_filesystem):
+    for i in range(3):
+        snappy_command(f'{fake_filesystem}')
+
+    fake_zfs.calls.clear()
+    snappy_command(f'-S -s pool/target {fake_filesystem}')
+
+    # Bookmarks are created and destroyed and snapshots are destroyed once per
+    # dataset, regardless of the number of snapshots sent.
+    assert fake_zfs.calls.count('send_receive_snapshot') == 3
+    assert fake_zfs.calls.count('create_bookmarks') == 1
+    assert fake_zfs.calls.count('destroy_bookmarks') == 1
+    assert fake_zfs.calls.count('destroy_snapshots') == 1
+    assert fake_zfs.get_snapshots(fake_filesystem) == []
+    assert fake_zfs.get_bookmarks(fake_filesystem) == ['snappy-2001-02-03-101500']
+    assert len(fake_zfs.get_snapshots('pool/target')) == 3
+
+
+def test_send_interrupted(
+        snappy_command, fake_zfs, fake_filesystem, fails_with_message,
+        monkeypatch):
+    for i in range(3):
+        snappy_command(f'{fake_filesystem}')
+
+    original_send_receive_snapshot = fake_zfs.send_receive_snapshot
+
+    def failing_send_receive_snapshot(
+            incremental_base, source, target, **kwargs):
+        if source.name == 'snappy-2001-02-03-101500':
+            raise CalledProcessError(1, ['zfs', 'send'])
+
+        return original_send_receive_snapshot(
+            incremental_base, source, target, **kwargs)
+
+    monkeypatch.setattr(
+        fake_zfs, 'send_receive_snapshot', failing_send_receive_snapshot)
+
+    with fails_with_message('Internal command failed'):
+        snappy_command(f'-S -s pool/target {fake_filesystem}')
+
+    monkeypatch.setattr(
+        fake_zfs, 'send_receive_snapshot', original_send_receive_snapshot)
+
+    # Nothing has been removed from the source yet.
+    assert len(fake_zfs.get_snapshots(fake_filesystem)) == 3
+
+    snappy_command(f'-S -s pool/target {fake_filesystem}')
+
+    assert fake_zfs.get_snapshots(fake_filesystem) == []
+    assert fake_zfs.get_bookmarks(fake_filesystem) == ['snappy-2001-02-03-101500']
+    assert fake_zfs.get_snapshots('pool/target') == \
+           ['snappy-2001-02-03-081500', 'snappy-2001-02-03-091500',
+            'snappy-2001-02-03-101500']
@@ -1,4 +1,5 @@
 from conftest import get_snapshots, run_command
+from snappy.zfs import Snapshot, Dataset
 
 
 def test_create_snapshot(filesystem, snappy_command):
@@ -72,3 +73,82 @@ def test_multiple_filesystems(
 
     assert get_snapshots(filesystem) == ['snappy-2001-02-03-091500']
     assert get_snapshots(other_filesystem) == ['snappy-2001-02-03-091500']
+
+
+def test_recursive_snapshot_roots(
+        snappy_command, fake_zfs, fake_filesystem, monkeypatch):
+    for i in ['a', 'a/x', 'b', 'b/y']:
+        fake_zfs.create_dataset(f'{fake_filesystem}/{i}')
+
+    create_snapshots_calls = []
+    original_create_snapshots = fake_zfs.create_snapshots
+
+    def create_snapshots(snapshots, recursive_snapshots):
+        create_snapshots_calls.append(
+            ([str(i) for i in snapshots], [str(i) for i in recursive_snapshots]))
+        original_create_snapshots(snapshots, recursive_snapshots)
+
+    monkeypatch.setattr(fake_zfs, 'create_snapshots', create_snapshots)
+
+    # Only subtrees without excluded datasets are snapshotted recursively.
+    snappy_command(f'-r -e {fake_filesystem}/a/x {fake_filesystem}')
+    snappy_command(f'-r {fake_filesystem}')
+
+    assert create_snapshots_calls == [
+        (['pool/fs@snappy-2001-02-03-081500',
+          'pool/fs/a@snappy-2001-02-03-081500'],
+         ['pool/fs/b@snappy-2001-02-03-081500']),
+        ([], ['pool/fs@snappy-2001-02-03-091500'])]
+
+    assert fake_zfs.get_snapshots(f'{fake_filesystem}/b/y') == \
+           ['snappy-2001-02-03-081500', 'snappy-2001-02-03-091500']
+    assert fake_zfs.get_snapshots(f'{fake_filesystem}/a/x') == \
+           ['snappy-2001-02-03-091500']
+
+
+def test_min_written(snappy_command, fake_zfs, fake_filesystem, monkeypatch):
+    for i in ['a', 'b']:
+        fake_zfs.create_dataset(f'{fake_filesystem}/{i}')
+
+    calls = []
+    create_snapshots = fake_zfs.create_snapshots
+
+    def record_create_snapshots(snapshots, recursive_snapshots):
+        calls.append((snapshots, recursive_snapshots))
+        create_snapshots(snapshots, recursive_snapshots)
+
+    monkeypatch.setattr(fake_zfs, 'create_snapshots', record_create_snapshots)
+
+    fake_zfs.written[Dataset(f'{fake_filesystem}/a')] = 2 * 1024 ** 2
+    fake_zfs.written[Dataset(f'{fake_filesystem}/b')] = 1024
+    snappy_command(f'-r --min-written 1M {fake_filesystem}')
+
+    assert fake_zfs.get_snapshots(f'{fake_filesystem}/a') == \
+           ['snappy-2001-02-03-081500']
+    assert fake_zfs.get_snapshots(fake_filesystem) == []
+    assert fake_zfs.get_snapshots(f'{fake_filesystem}/b') == []
+
+    # No changes at all.
+    snappy_command(f'-r --min-written 1M {fake_filesystem}')
+
+    assert len(calls) == 1
+
+    # All datasets changed, so a single recursive snapshot is created.
+    for i in ['', '/a', '/b']:
+        fake_zfs.written[Dataset(f'{fake_filesystem}{i}')] = 1024 ** 2
+
+    snappy_command(f'-r --min-written 1M {fake_filesystem}')
+
+    assert calls[-1][1] == \
+           [Snapshot(Dataset('pool/fs'), 'snappy-2001-02-03-101500')]
+
+
+def test_max_snapshot_age(snappy_command, fake_zfs, fake_filesystem):
+    for i in range(3):
+        snappy_command(
+            f'--min-written 1M --max-snapshot-age 2h {fake_filesystem}')
+
+    # The first snapshot is taken because there's none yet, the second one
+    # because the first one is 2 hours old.
+    assert fake_zfs.get_snapshots(fake_filesystem) == \
+           ['snappy-2001-02-03-081500', 'snappy-2001-02-03-101500']
@@ -0,0 +1,66 @@
+import math
+from datetime import datetime
+
+from snappy.utils import datetime_to_seconds
+from snappy.zfs import Dataset, Snapshot, SnapshotTable, SnapshotInfo
+
+
+def make_table(*entries):
+    table = SnapshotTable(Snapshot, Dataset('pool/fs'))
+
+    for i in entries:
+        table.append(*i)
+
+    return table
+
+
+def test_sequence():
+    table = make_table(('a', 10, 1), ('b', 11, 2))
+
+    assert len(table) == 2
+    assert table[1] == SnapshotInfo(Snapshot(Dataset('pool/fs'), 'b'), 11, 2)
+    assert [i.ref.name for i in table] == ['a', 'b']
+    assert table[-1].guid == 11
+
+
+def test_sort():
+    table = make_table(('c', 12, 3), ('a', 10, 1), ('b', 11, 2))
+    table.find_name('a')
+    table.sort()
+
+    assert table.names == ['a', 'b', 'c']
+    assert list(table.guids) == [10, 11, 12]
+
+    # The indexes are rebuilt after sorting.
+    assert table.find_name('a') == 0
+
+
+def test_indexes():
+    table = make_table(('a', 10, 1), ('b', 11, 2))
+
+    assert table.find_guid(11) == 1
+    assert table.find_guid(12) is None
+    assert table.find_name('a') == 0
+    assert table.find_name('c') is None
+
+    # The indexes are updated when entries are added.
+    table.append('c', 12, 3)
+
+    assert table.find_guid(12) == 2
+
+
+def test_timestamps():
+    table = make_table(
+        ('foo-2023-02-12-235900', 10, 1),
+        ('foo-bar-2023-02-13-010000', 11, 2),
+        ('foo-2023-02-30-010000', 12, 3),
+        ('manual', 13, 4))
+
+    assert table.has_prefix(0, 'foo')
+    assert not table.has_prefix(1, 'foo')
+    assert table.has_prefix(1, 'foo-bar')
+    assert not table.has_prefix(2, 'foo')
+    assert not table.has_prefix(3, 'manual')
+
+    assert table.timestamp(0) == datetime_to_seconds(datetime(2023, 2, 12, 23, 59))
+    assert math.isnan(table.timestamp(3))
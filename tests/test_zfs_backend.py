@@ -0,0 +1,78 @@
+from subprocess import CalledProcessError
+
+import pytest
+
+from snappy.zfs import CliBackend, Snapshot, Dataset
+
+
+def test_snapshot_and_prune(snappy_command, fake_zfs, fake_filesystem):
+    for i in range(3):
+        snappy_command(f'{fake_filesystem}')
+
+    snappy_command(f'-S -k 1 {fake_filesystem}')
+
+    assert fake_zfs.get_snapshots(fake_filesystem) == ['snappy-2001-02-03-101500']
+
+
+def test_recursive(snappy_command, fake_zfs, fake_filesystem):
+    fake_zfs.create_dataset(f'{fake_filesystem}/child')
+    snappy_command(f'-r {fake_filesystem}')
+
+    assert fake_zfs.get_snapshots(fake_filesystem) == ['snappy-2001-02-03-081500']
+    assert fake_zfs.get_snapshots(f'{fake_filesystem}/child') == ['snappy-2001-02-03-081500']
+
+    # All snapshots are created in a single operation.
+    assert fake_zfs.calls.count('create_snapshots') == 1
+
+
+def test_send(snappy_command, fake_zfs, fake_filesystem):
+    snappy_command(f'{fake_filesystem}')
+    snappy_command(f'-s pool/target {fake_filesystem}')
+    snappy_command(f'-s pool/target {fake_filesystem}')
+
+    assert fake_zfs.get_snapshots(fake_filesystem) == []
+    assert fake_zfs.get_bookmarks(fake_filesystem) == ['snappy-2001-02-03-101500']
+    assert fake_zfs.get_snapshots('pool/target') == \
+           ['snappy-2001-02-03-081500', 'snappy-2001-02-03-091500',
+            'snappy-2001-02-03-101500']
+
+
+def test_prune_target(snappy_command, fake_zfs, fake_filesystem):
+    snappy_command(f'-s pool/target {fake_filesystem}')
+    snappy_command(f'-s pool/target {fake_filesystem}')
+    snappy_command(f'-k 1 -s pool/target {fake_filesystem}')
+
+    # The snapshot sent by the same run is taken into account when pruning.
+    assert fake_zfs.get_snapshots('pool/target') == ['snappy-2001-02-03-101500']
+
+
+def test_cli_create_snapshots_atomically(monkeypatch):
+    calls = []
+
+    def check_call(cmdline):
+        calls.append(cmdline)
+
+        if 'tank/fs@s' in cmdline:
+            raise CalledProcessError(1, cmdline)
+
+    monkeypatch.setattr('snappy.zfs.check_call', check_call)
+
+    backend = CliBackend()
+    monkeypatch.setattr(
+        backend, 'iter_children',
+        lambda dataset, *, quiet: iter([dataset, Dataset(f'{dataset}/a')]))
+
+    with pytest.raises(CalledProcessError):
+        backend.create_snapshots(
+            [Snapshot(Dataset('pool/fs'), 's')],
+            [Snapshot(Dataset('pool/other'), 's'),
+             Snapshot(Dataset('tank/fs'), 's')])
+
+    # A pool with both kinds of snapshots is snapshotted using a single
+    # command. When snapshotting another pool fails, they are destroyed again.
+    assert calls == [
+        ['zfs', 'snapshot', '--', 'pool/fs@s', 'pool/other@s',
+         'pool/other/a@s'],
+        ['zfs', 'snapshot', '-r', '--', 'tank/fs@s'],
+        ['zfs', 'destroy', '-r', '--', 'pool/other@s'],
+        ['zfs', 'destroy', '--', 'pool/fs@s']]